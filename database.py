@@ -2,19 +2,72 @@
 資料庫模組：支援 SQLite（本機，未設 DATABASE_URL）與 PostgreSQL（Supabase 等）。
 """
 
+import functools
 import ipaddress
 import json
 import os
 import re
 import socket
 import sqlite3
+import threading
+import time
 from datetime import date, datetime, timedelta, timezone
-from typing import Optional
+from enum import IntFlag
+from typing import Callable, NamedTuple, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = "diet_tracker.db"
+# 排程推播對象分頁大小（user_activity 以 user_id 游標分頁，記憶體不隨使用者數成長）
+AUDIENCE_PAGE_SIZE = max(1, int(os.getenv("CRON_AUDIENCE_PAGE_SIZE", "500")))
+# onboarding 狀態快取：完成 onboarding 後常駐；未完成者僅短暫快取（可能由其他程序更新）
+ONBOARDING_CACHE_TTL_SEC = float(os.getenv("ONBOARDING_CACHE_TTL_SEC", "60"))
+ONBOARDING_CACHE_MAX = max(1, int(os.getenv("ONBOARDING_CACHE_MAX", "20000")))
+# 未使用 Supabase 時的 SQLite 設定：tuned＝程序內共用一條連線（PRAGMA 只設一次）；basic＝每次查詢各自連線
+SQLITE_PROFILE = (os.getenv("SQLITE_PROFILE") or "tuned").strip().lower()
+SQLITE_MMAP_SIZE = max(0, int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))))
+SQLITE_CACHE_SIZE_KB = max(0, int(os.getenv("SQLITE_CACHE_SIZE_KB", "32768")))
+# 其他程序（腳本、第二個 worker）持有寫鎖時最多等待的毫秒數
+SQLITE_BUSY_TIMEOUT_MS = max(0, int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")))
+SQLITE_OPTIMIZE_INTERVAL_SEC = float(os.getenv("SQLITE_OPTIMIZE_INTERVAL_SEC", "3600"))
+
+
+class OnboardingState(IntFlag):
+    """user_profiles 的 onboarding 進度；NONE 表示無資料或尚未上傳 InBody。"""
+
+    NONE = 0
+    HAS_INBODY = 1
+    ONBOARDED = 2
+
+    @classmethod
+    def from_profile(cls, profile: Optional[dict]) -> "OnboardingState":
+        state = cls.NONE
+        if profile and profile.get("last_inbody_date"):
+            state |= cls.HAS_INBODY
+        if profile and profile.get("onboarding_complete"):
+            state |= cls.ONBOARDED
+        return state
+
+_USER_ACTIVITY_UPSERT_SQL = """
+    INSERT INTO user_activity
+        (user_id, last_message_at, last_meal_date, jitai_enabled, onboarded, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_message_at = CASE
+            WHEN excluded.last_message_at IS NOT NULL
+                 AND (user_activity.last_message_at IS NULL
+                      OR excluded.last_message_at > user_activity.last_message_at)
+            THEN excluded.last_message_at ELSE user_activity.last_message_at END,
+        last_meal_date = CASE
+            WHEN excluded.last_meal_date IS NOT NULL
+                 AND (user_activity.last_meal_date IS NULL
+                      OR excluded.last_meal_date > user_activity.last_meal_date)
+            THEN excluded.last_meal_date ELSE user_activity.last_meal_date END,
+        jitai_enabled = COALESCE(excluded.jitai_enabled, user_activity.jitai_enabled),
+        onboarded = COALESCE(excluded.onboarded, user_activity.onboarded),
+        updated_at = excluded.updated_at
+"""
 
 
 def _should_force_ipv4_for_postgres() -> bool:
@@ -252,15 +305,613 @@ def _resolve_postgres_conninfo(uri: str) -> str:
     return uri
 
 
+# psycopg 預設同一連線上同一語句執行 5 次後才改用 server-side prepared statement
+_PSYCOPG_DEFAULT_PREPARE_THRESHOLD = 5
+
+
+def _postgres_prepare_threshold(conninfo: str) -> int | None:
+    """此連線的 psycopg prepare_threshold：0＝每條語句首次執行就 prepare，None＝不用 prepared statement。
+
+    DATABASE_PREPARE=always／off 可強制；預設沿用 psycopg 的門檻。
+    Supabase Transaction pooler（port 6543）每筆交易可能換到不同後端，不支援 prepared statement，一律關閉。
+    """
+    from psycopg.conninfo import conninfo_to_dict
+
+    mode = (os.getenv("DATABASE_PREPARE") or "auto").strip().lower()
+    try:
+        port = str(conninfo_to_dict(conninfo).get("port") or "")
+    except Exception:
+        port = ""
+    if port == "6543" or mode in ("0", "off", "false", "no"):
+        return None
+    if mode in ("1", "always", "true", "on", "yes"):
+        return 0
+    return _PSYCOPG_DEFAULT_PREPARE_THRESHOLD
+
+
+# ━━━ SQLite 共用連線 ━━━
+
+
+class _SharedSQLiteConnection:
+    """tuned 模式下程序內唯一的 SQLite 連線；_connect() 取得鎖，close() 只釋放鎖。
+
+    to_thread 的寫入在程序內依序排隊，彼此不會碰到 SQLITE_BUSY；busy_timeout 只用來等其他程序。
+    最外層釋放時回滾未提交的交易、還原 isolation_level（遷移會暫時改成手動 BEGIN），
+    並每 SQLITE_OPTIMIZE_INTERVAL_SEC 秒跑一次 PRAGMA optimize。
+    """
+
+    __slots__ = ("_conn", "_lock", "_depth", "_isolation_level", "_next_optimize")
+
+    def __init__(self, conn: sqlite3.Connection):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_lock", threading.RLock())
+        object.__setattr__(self, "_depth", 0)
+        object.__setattr__(self, "_isolation_level", conn.isolation_level)
+        object.__setattr__(self, "_next_optimize", time.monotonic() + SQLITE_OPTIMIZE_INTERVAL_SEC)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def acquire(self) -> "_SharedSQLiteConnection":
+        self._lock.acquire()
+        object.__setattr__(self, "_depth", self._depth + 1)
+        return self
+
+    def close(self) -> None:
+        object.__setattr__(self, "_depth", self._depth - 1)
+        try:
+            if self._depth == 0:
+                self._reset()
+        finally:
+            self._lock.release()
+
+    def _reset(self) -> None:
+        conn = self._conn
+        if conn.in_transaction:
+            conn.rollback()
+        if conn.isolation_level != self._isolation_level:
+            conn.isolation_level = self._isolation_level
+        now = time.monotonic()
+        if now >= self._next_optimize:
+            object.__setattr__(self, "_next_optimize", now + SQLITE_OPTIMIZE_INTERVAL_SEC)
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logger.warning("SQLite PRAGMA optimize 失敗: %s", e)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            try:
+                self._conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logger.warning("SQLite PRAGMA optimize 失敗: %s", e)
+            self._conn.close()
+
+
+# ━━━ Schema 版本遷移 ━━━
+# 啟動時只讀一次 schema_version；版本已是最新就直接返回（冷啟動快速路徑）。
+# 新增欄位／資料表請「追加」一筆遷移，勿修改已發佈的版本內容。
+
+
+class _AddColumn(NamedTuple):
+    """補欄位：PostgreSQL 用 IF NOT EXISTS；SQLite 先查 PRAGMA table_info。decl 可用 {real}。"""
+
+    table: str
+    column: str
+    decl: str
+
+
+_DIALECT = {
+    "sqlite": {"id": "INTEGER PRIMARY KEY AUTOINCREMENT", "real": "REAL"},
+    "postgres": {"id": "SERIAL PRIMARY KEY", "real": "DOUBLE PRECISION"},
+}
+
+_BACKFILL_USER_ACTIVITY_SQL = """
+    INSERT INTO user_activity
+        (user_id, last_message_at, last_meal_date, jitai_enabled, onboarded, updated_at)
+    SELECT u.user_id,
+           (SELECT MAX(m.at_utc) FROM user_message_log m WHERE m.user_id = u.user_id),
+           (SELECT MAX(ml.created_date) FROM meals ml WHERE ml.user_id = u.user_id),
+           COALESCE(p.jitai_nudges_enabled, 0),
+           COALESCE(p.onboarding_complete, 0),
+           ?
+    FROM (
+        SELECT user_id FROM user_message_log
+        UNION
+        SELECT user_id FROM meals
+        UNION
+        SELECT user_id FROM user_profiles
+    ) AS u
+    LEFT JOIN user_profiles p ON p.user_id = u.user_id
+    WHERE 1 = 1
+    ON CONFLICT (user_id) DO NOTHING
+"""
+
+
+def _backfill_user_activity(db: "Database", conn) -> None:
+    """由既有訊息／餐點／檔案建立推播名冊（已存在者略過）。"""
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute(db._adapt(_BACKFILL_USER_ACTIVITY_SQL), (now,))
+
+
+_DAILY_AGGREGATE_ADD_MEAL_SQL = """
+    INSERT INTO daily_aggregates (user_id, date, calories, protein, meal_count, updated_at)
+    VALUES (?, ?, ?, ?, 1, ?)
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        calories = daily_aggregates.calories + excluded.calories,
+        protein = daily_aggregates.protein + excluded.protein,
+        meal_count = daily_aggregates.meal_count + 1,
+        updated_at = excluded.updated_at
+"""
+
+_BACKFILL_DAILY_AGGREGATES_SQL = """
+    INSERT INTO daily_aggregates (user_id, date, calories, protein, meal_count, updated_at)
+    SELECT user_id, created_date, SUM(calories), SUM(protein), COUNT(*), ?
+    FROM meals
+    WHERE 1 = 1
+    GROUP BY user_id, created_date
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        calories = excluded.calories,
+        protein = excluded.protein,
+        meal_count = excluded.meal_count,
+        updated_at = excluded.updated_at
+"""
+
+
+def _backfill_daily_aggregates(db: "Database", conn) -> None:
+    """由既有餐點重建每日彙總（已存在者以 meals 為準覆寫）。"""
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute(db._adapt(_BACKFILL_DAILY_AGGREGATES_SQL), (now,))
+
+
+# upsert_user_profile：新列用預設值建檔；既有列只覆寫呼叫端有給值（非 NULL）的欄位
+_PROFILE_UPSERT_COLUMNS = (
+    "weight", "body_fat_percentage", "muscle_mass", "bmr", "tdee",
+    "daily_calorie_target", "daily_protein_target", "onboarding_complete",
+)
+_PROFILE_UPSERT_SQL = (
+    "INSERT INTO user_profiles (user_id, " + ", ".join(_PROFILE_UPSERT_COLUMNS)
+    + ", last_inbody_date, created_at, updated_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET "
+    + "".join(f"{c} = COALESCE(?, user_profiles.{c}), " for c in _PROFILE_UPSERT_COLUMNS)
+    + "last_inbody_date = excluded.last_inbody_date, updated_at = excluded.updated_at"
+)
+
+_WEEKLY_SCORE_COLUMNS = (
+    "user_id", "week_start", "week_end",
+    "overall_grade", "protein_grade", "calorie_grade", "regularity_grade",
+    "active_days", "protein_met", "elapsed_days",
+    "avg_calories", "calorie_target", "protein_target",
+)
+_WEEKLY_SCORE_UPSERT_SQL = (
+    f"INSERT INTO weekly_scores ({', '.join(_WEEKLY_SCORE_COLUMNS)}, created_at, updated_at) "
+    f"VALUES ({', '.join('?' * (len(_WEEKLY_SCORE_COLUMNS) + 2))}) "
+    "ON CONFLICT (user_id, week_start) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in (*_WEEKLY_SCORE_COLUMNS[2:], "updated_at"))
+)
+
+_OPENAI_USAGE_SQL = """
+    SELECT user_id, prompt_id, model,
+           COUNT(*) AS calls,
+           COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+           COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+           COALESCE(SUM(cached_tokens), 0) AS cached_tokens,
+           AVG(latency_ms) AS avg_latency_ms,
+           MAX(latency_ms) AS max_latency_ms,
+           COALESCE(SUM(retries), 0) AS retries,
+           SUM(CASE WHEN outcome IN ('ok', 'text') THEN 0 ELSE 1 END) AS failures
+    FROM openai_calls
+    WHERE {where}
+    GROUP BY user_id, prompt_id, model
+    ORDER BY COALESCE(SUM(prompt_tokens), 0)
+             + COALESCE(SUM(completion_tokens), 0) DESC
+"""
+
+# ━━━ 語句表 ━━━
+# Database 方法執行的固定 SQL 都在這裡定義一次（以 ? 為參數記號）。
+# 兩種方言的文字在 import 時備妥（_STATEMENT_TEXT），執行時只查表、不再逐次組字串或 replace；
+# 同一段文字每次都相同，psycopg 才能以它為鍵重用同一連線上的 prepared statement。
+# IN 清單長度不定、欄位組合由呼叫端決定的少數查詢仍走 Database._adapt（有快取）。
+_STATEMENTS: dict[str, str] = {
+    # 餐食
+    "meal_insert": """
+        INSERT INTO meals (user_id, timestamp, calories, protein, food_description, created_date)
+        VALUES (?, ?, ?, ?, ?, ?)""",
+    "meal_day_totals": """
+        SELECT COALESCE(SUM(calories), 0) as calories,
+               COALESCE(SUM(protein), 0) as protein,
+               COUNT(*) as meal_count
+        FROM meals WHERE user_id = ? AND created_date = ?""",
+    "meals_for_day": """
+        SELECT calories, protein, food_description, timestamp
+        FROM meals WHERE user_id = ? AND created_date = ?
+        ORDER BY timestamp""",
+    "meals_delete_day": "DELETE FROM meals WHERE user_id = ? AND created_date = ?",
+    "meal_users_on_date": "SELECT DISTINCT user_id FROM meals WHERE created_date = ?",
+    "meal_in_window": """
+        SELECT 1 FROM meals
+        WHERE user_id = ? AND created_date = ?
+        AND timestamp >= ? AND timestamp < ?
+        LIMIT 1""",
+    "daily_aggregate_add_meal": _DAILY_AGGREGATE_ADD_MEAL_SQL,
+    "daily_aggregate_delete_day": "DELETE FROM daily_aggregates WHERE user_id = ? AND date = ?",
+    "daily_aggregates_range": """
+        SELECT date, calories, protein, meal_count FROM daily_aggregates
+        WHERE user_id = ? AND date >= ? AND date <= ?
+        ORDER BY date""",
+    "meal_since_audience_page": """
+        SELECT DISTINCT user_id FROM daily_aggregates
+        WHERE date >= ? AND meal_count > 0 AND user_id > ?
+        ORDER BY user_id
+        LIMIT ?""",
+    # 使用者檔案
+    "profile_get": "SELECT * FROM user_profiles WHERE user_id = ?",
+    "profile_upsert": _PROFILE_UPSERT_SQL,
+    "profile_upsert_returning": _PROFILE_UPSERT_SQL + " RETURNING onboarding_complete",
+    "profile_set_calorie_offset":
+        "UPDATE user_profiles SET calorie_offset = ?, updated_at = ? WHERE user_id = ?",
+    "profile_set_quick_items": """
+        INSERT INTO user_profiles
+        (user_id, custom_quick_items, daily_calorie_target,
+         daily_protein_target, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            custom_quick_items = excluded.custom_quick_items,
+            updated_at = excluded.updated_at""",
+    "profile_set_jitai": """
+        INSERT INTO user_profiles
+        (user_id, jitai_nudges_enabled, created_at, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            jitai_nudges_enabled = excluded.jitai_nudges_enabled,
+            updated_at = excluded.updated_at""",
+    "profile_complete_onboarding": """
+        UPDATE user_profiles
+        SET fitness_goal = ?, daily_calorie_target = ?,
+            daily_protein_target = ?, onboarding_complete = 1,
+            updated_at = ?
+        WHERE user_id = ?""",
+    "user_activity_upsert": _USER_ACTIVITY_UPSERT_SQL,
+    "jitai_audience_page": """
+        SELECT user_id FROM user_activity
+        WHERE jitai_enabled = 1 AND onboarded = 1 AND user_id > ?
+        ORDER BY user_id
+        LIMIT ?""",
+    "meal_reminder_audience_page": """
+        SELECT user_id FROM user_activity
+        WHERE user_id > ?
+        AND (last_message_at IS NOT NULL OR last_meal_date >= ?)
+        ORDER BY user_id
+        LIMIT ?""",
+    # 欺騙日
+    "cheat_day_exists": "SELECT 1 FROM cheat_days WHERE user_id = ? AND date = ? LIMIT 1",
+    "cheat_day_insert": """
+        INSERT INTO cheat_days (user_id, date, created_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, date) DO NOTHING""",
+    "cheat_day_count": """
+        SELECT COUNT(*) as cnt FROM cheat_days
+        WHERE user_id = ? AND date >= ? AND date <= ?""",
+    # 購買查詢
+    "purchase_insert": """
+        INSERT INTO purchase_queries
+        (user_id, timestamp, food_name, decision, calories, protein,
+         overall_grade, raw_data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    # 訊息時間軸與用餐提醒
+    "message_log_insert":
+        "INSERT INTO user_message_log (user_id, at_utc, message_kind) VALUES (?, ?, ?)",
+    "message_in_range": """
+        SELECT 1 FROM user_message_log
+        WHERE user_id = ? AND at_utc >= ? AND at_utc < ?
+        LIMIT 1""",
+    "photo_in_range": """
+        SELECT 1 FROM user_message_log
+        WHERE user_id = ? AND at_utc >= ? AND at_utc < ?
+        AND COALESCE(message_kind, 'text') = 'image'
+        LIMIT 1""",
+    "reminder_sent_exists": """
+        SELECT 1 FROM reminder_sent
+        WHERE user_id = ? AND local_date = ? AND slot = ? LIMIT 1""",
+    "reminder_sent_insert": """
+        INSERT INTO reminder_sent (user_id, local_date, slot, created_at)
+        VALUES (?, ?, ?, ?) ON CONFLICT (user_id, local_date, slot) DO NOTHING""",
+    # Webhook 去重
+    "webhook_event_claim": """
+        INSERT INTO webhook_events (event_id, received_at) VALUES (?, ?)
+        ON CONFLICT (event_id) DO NOTHING""",
+    "webhook_event_prune": "DELETE FROM webhook_events WHERE received_at < ?",
+    # OpenAI 呼叫遙測
+    "openai_calls_insert": """
+        INSERT INTO openai_calls
+        (created_at, local_date, user_id, prompt_id, model, image_detail,
+         prompt_tokens, completion_tokens, cached_tokens, latency_ms,
+         retries, outcome)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "openai_usage_by_day": _OPENAI_USAGE_SQL.format(where="local_date = ?"),
+    "openai_usage_by_day_user": _OPENAI_USAGE_SQL.format(where="local_date = ? AND user_id = ?"),
+    "openai_calls_prune": "DELETE FROM openai_calls WHERE created_at < ?",
+    # 背景批次工作
+    "cron_job_find_active": """
+        SELECT id FROM cron_jobs
+        WHERE dedupe_key = ? AND status IN ('queued', 'running') AND updated_at >= ?
+        ORDER BY created_at DESC LIMIT 1""",
+    "cron_job_insert": """
+        INSERT INTO cron_jobs
+        (id, kind, dedupe_key, params, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'queued', ?, ?)""",
+    "cron_job_get": "SELECT * FROM cron_jobs WHERE id = ?",
+    # 週積分
+    "weekly_score_upsert": _WEEKLY_SCORE_UPSERT_SQL,
+    "weekly_score_get": "SELECT * FROM weekly_scores WHERE user_id = ? AND week_start = ?",
+}
+
+
+def _pyformat(sql: str) -> str:
+    """SQLite 的 ? 參數記號改成 psycopg 的 %s（語句內不得有字面上的 ?）。"""
+    return sql.replace("?", "%s")
+
+
+# IN 清單的長度多半就是固定的 chunk_size，重複出現的動態語句不必每次重轉
+_pyformat_cached = functools.lru_cache(maxsize=256)(_pyformat)
+
+
+_STATEMENT_TEXT: dict[str, dict[str, str]] = {
+    "sqlite": dict(_STATEMENTS),
+    "postgres": {name: _pyformat(sql) for name, sql in _STATEMENTS.items()},
+}
+
+
+SCHEMA_MIGRATIONS: list[tuple[int, str, list]] = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS meals (
+            id {id},
+            user_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            calories {real} NOT NULL,
+            protein {real} NOT NULL,
+            food_description TEXT NOT NULL,
+            created_date TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id TEXT PRIMARY KEY,
+            weight {real},
+            body_fat_percentage {real},
+            muscle_mass {real},
+            bmr INTEGER,
+            tdee INTEGER,
+            daily_calorie_target INTEGER DEFAULT 2500,
+            daily_protein_target INTEGER DEFAULT 300,
+            last_inbody_date TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            custom_quick_items TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS cheat_days (
+            id {id},
+            user_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            created_at TEXT,
+            UNIQUE(user_id, date)
+        )""",
+        """CREATE TABLE IF NOT EXISTS purchase_queries (
+            id {id},
+            user_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            food_name TEXT NOT NULL,
+            decision TEXT,
+            calories {real},
+            protein {real},
+            overall_grade TEXT,
+            raw_data TEXT,
+            created_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS weekly_scores (
+            id {id},
+            user_id TEXT NOT NULL,
+            week_start TEXT NOT NULL,
+            week_end TEXT NOT NULL,
+            overall_grade TEXT,
+            protein_grade TEXT,
+            calorie_grade TEXT,
+            regularity_grade TEXT,
+            created_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_meals_user_date ON meals(user_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_cheat_user_date ON cheat_days(user_id, date)",
+        "CREATE INDEX IF NOT EXISTS idx_purchase_user ON purchase_queries(user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_weekly_user ON weekly_scores(user_id, week_start)",
+        """CREATE TABLE IF NOT EXISTS user_message_log (
+            id {id},
+            user_id TEXT NOT NULL,
+            at_utc TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_user_msg_log_user_at ON user_message_log(user_id, at_utc)",
+        """CREATE TABLE IF NOT EXISTS reminder_sent (
+            user_id TEXT NOT NULL,
+            local_date TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, local_date, slot)
+        )""",
+    ]),
+    # 舊資料庫補上 custom_quick_items／tdee（InBody 建議熱量）
+    (2, "user_profiles quick items and tdee", [
+        _AddColumn("user_profiles", "custom_quick_items", "TEXT"),
+        _AddColumn("user_profiles", "tdee", "INTEGER"),
+    ]),
+    # 既有 InBody 使用者視為已完成 onboarding
+    (3, "user_profiles onboarding", [
+        _AddColumn("user_profiles", "fitness_goal", "TEXT"),
+        _AddColumn("user_profiles", "onboarding_complete", "INTEGER DEFAULT 0"),
+        "UPDATE user_profiles SET onboarding_complete = 1 "
+        "WHERE last_inbody_date IS NOT NULL "
+        "AND (onboarding_complete IS NULL OR onboarding_complete = 0)",
+    ]),
+    # 智能提醒，預設關閉、需手動開啟
+    (4, "user_profiles jitai", [
+        _AddColumn("user_profiles", "jitai_nudges_enabled", "INTEGER DEFAULT 0"),
+    ]),
+    # 個人熱量微調，可為負值
+    (5, "user_profiles calorie offset", [
+        _AddColumn("user_profiles", "calorie_offset", "INTEGER DEFAULT 0"),
+    ]),
+    # text／image，供用餐提醒判斷是否已傳照片
+    (6, "user_message_log kind", [
+        _AddColumn("user_message_log", "message_kind", "TEXT DEFAULT 'text'"),
+        "UPDATE user_message_log SET message_kind = 'text' WHERE message_kind IS NULL",
+    ]),
+    (7, "user_activity roster", [
+        """CREATE TABLE IF NOT EXISTS user_activity (
+            user_id TEXT PRIMARY KEY,
+            last_message_at TEXT,
+            last_meal_date TEXT,
+            jitai_enabled INTEGER DEFAULT 0,
+            onboarded INTEGER DEFAULT 0,
+            updated_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_audience "
+        "ON user_activity(user_id, last_message_at, last_meal_date)",
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_jitai "
+        "ON user_activity(jitai_enabled, onboarded, user_id)",
+        _backfill_user_activity,
+    ]),
+    # LINE webhookEventId 去重（跨程序／重新部署後仍可辨識重送事件）
+    (8, "webhook_events", [
+        """CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            received_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_webhook_events_received ON webhook_events(received_at)",
+    ]),
+    # 每次 OpenAI 上游呼叫的 token／延遲／結果（依 prompt 調整成本與速度）
+    (9, "openai_calls telemetry", [
+        """CREATE TABLE IF NOT EXISTS openai_calls (
+            id {id},
+            created_at TEXT NOT NULL,
+            local_date TEXT NOT NULL,
+            user_id TEXT,
+            prompt_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            image_detail TEXT,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            latency_ms {real},
+            retries INTEGER DEFAULT 0,
+            outcome TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_openai_calls_date_user "
+        "ON openai_calls(local_date, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_openai_calls_created ON openai_calls(created_at)",
+    ]),
+    # usage.prompt_tokens_details.cached_tokens：確認 prompt caching 是否命中
+    (10, "openai_calls cached tokens", [
+        _AddColumn("openai_calls", "cached_tokens", "INTEGER DEFAULT 0"),
+    ]),
+    # 排程觸發的背景批次工作（cron 請求立即返回，進度寫在這裡供查詢）
+    (11, "cron_jobs", [
+        """CREATE TABLE IF NOT EXISTS cron_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            dedupe_key TEXT,
+            params TEXT,
+            status TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            ok INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            updated_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_cron_jobs_dedupe ON cron_jobs(dedupe_key, status)",
+        "CREATE INDEX IF NOT EXISTS idx_cron_jobs_created ON cron_jobs(created_at)",
+    ]),
+    # 每人每日的熱量／蛋白質／餐數（報表與積分卡改讀這張，不再逐日 SUM meals）
+    (12, "daily_aggregates", [
+        """CREATE TABLE IF NOT EXISTS daily_aggregates (
+            user_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            calories {real} NOT NULL DEFAULT 0,
+            protein {real} NOT NULL DEFAULT 0,
+            meal_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (user_id, date)
+        )""",
+        _backfill_daily_aggregates,
+    ]),
+    # 積分卡改為預先計算：同週只留最新一筆後加唯一索引（upsert 用），並存下重繪卡片所需的數字
+    (13, "weekly_scores upsert", [
+        "DELETE FROM weekly_scores WHERE id NOT IN "
+        "(SELECT MAX(id) FROM weekly_scores GROUP BY user_id, week_start)",
+        "DROP INDEX IF EXISTS idx_weekly_user",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_weekly_scores_user_week "
+        "ON weekly_scores(user_id, week_start)",
+        _AddColumn("weekly_scores", "active_days", "INTEGER"),
+        _AddColumn("weekly_scores", "protein_met", "INTEGER"),
+        _AddColumn("weekly_scores", "elapsed_days", "INTEGER"),
+        _AddColumn("weekly_scores", "avg_calories", "{real}"),
+        _AddColumn("weekly_scores", "calorie_target", "{real}"),
+        _AddColumn("weekly_scores", "protein_target", "{real}"),
+        _AddColumn("weekly_scores", "updated_at", "TEXT"),
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# pg_advisory_xact_lock 鍵：多個程序同時冷啟動時只讓一個執行遷移
+_MIGRATION_LOCK_KEY = 7_310_027
+# start_cron_job 的鎖以 (此命名空間, hashtext(dedupe_key)) 兩段式鍵表示，與上面的單一 bigint 鍵互不衝突
+_CRON_JOB_LOCK_NAMESPACE = 7_310_042
+
+
 class Database:
-    def __init__(self, db_path: str = DB_PATH, database_url: str | None = None):
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        database_url: str | None = None,
+        sqlite_profile: str | None = None,
+    ):
         self.db_path = db_path
+        self._sqlite_profile = (sqlite_profile or SQLITE_PROFILE).strip().lower()
+        self._sqlite_shared: _SharedSQLiteConnection | None = None
+        self._sqlite_shared_lock = threading.Lock()
         self._database_url = (database_url or os.getenv("DATABASE_URL") or "").strip()
-        self._pg = bool(self._database_url)
+        self._set_dialect(bool(self._database_url))
+        # user_id -> (OnboardingState, 到期 monotonic 秒；None 表示不過期)
+        self._onboarding_cache: dict[str, tuple[OnboardingState, float | None]] = {}
+        # 寫入餐食／欺騙日／目標相關欄位後通知：listener(user_id, date_str)；date_str 為 None 表示不限日期
+        self._change_listeners: list[Callable[[str, str | None], None]] = []
+
+    def add_change_listener(self, listener: Callable[[str, str | None], None]) -> None:
+        """註冊寫入後的通知（程序內快取失效用）；listener 例外只記 log，不影響寫入。"""
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, user_id: str, date_str: str | None = None) -> None:
+        for listener in self._change_listeners:
+            try:
+                listener(user_id, date_str)
+            except Exception as e:
+                logger.warning("DB 變更通知失敗 %s: %s", getattr(listener, "__name__", listener), e)
+
+    def _set_dialect(self, pg: bool) -> None:
+        self._pg = pg
+        # INSERT … RETURNING：PostgreSQL 皆可；SQLite 需 3.35+
+        self._returning = pg or sqlite3.sqlite_version_info >= (3, 35, 0)
+        # 語句表：名稱 → 該方言的 SQL（import 時已轉好）
+        self._sql = _STATEMENT_TEXT["postgres" if pg else "sqlite"]
 
     def _adapt(self, sql: str) -> str:
+        """動態組出的 SQL 用；固定語句請放進 _STATEMENTS 改用 self._sql[名稱]。"""
         if self._pg:
-            return sql.replace("?", "%s")
+            return _pyformat_cached(sql)
         return sql
 
     def _connect(self):
@@ -295,6 +946,7 @@ class Database:
                         ci,
                         row_factory=dict_row,
                         connect_timeout=timeout,
+                        prepare_threshold=_postgres_prepare_threshold(ci),
                     )
                 except OperationalError as e:
                     last_exc = e
@@ -308,12 +960,51 @@ class Database:
                     )
                 raise last_exc
             raise RuntimeError("PostgreSQL 連線：無可用候選")
-        conn = sqlite3.connect(self.db_path)
+        if self._sqlite_profile == "tuned":
+            return self._shared_sqlite().acquire()
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("PRAGMA foreign_keys=ON")
         return conn
 
+    def _shared_sqlite(self) -> _SharedSQLiteConnection:
+        shared = self._sqlite_shared
+        if shared is not None:
+            return shared
+        with self._sqlite_shared_lock:
+            if self._sqlite_shared is None:
+                conn = sqlite3.connect(
+                    self.db_path,
+                    timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                    check_same_thread=False,
+                )
+                conn.row_factory = sqlite3.Row
+                # 連線層級的設定只在開啟時套用一次
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA foreign_keys=ON")
+                # WAL 下 NORMAL 只在斷電時可能遺失最後幾筆提交，不會損毀資料庫
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+                conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+                conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+                # 長駐連線建議的開啟時 optimize（只分析需要的表，且限制掃描量）
+                conn.execute("PRAGMA optimize=0x10002")
+                self._sqlite_shared = _SharedSQLiteConnection(conn)
+                logger.info(
+                    "SQLite tuned：共用連線，mmap %s MB、cache %s MB",
+                    SQLITE_MMAP_SIZE // (1024 * 1024), SQLITE_CACHE_SIZE_KB // 1024,
+                )
+            return self._sqlite_shared
+
+    def close(self) -> None:
+        """關閉 tuned 模式的共用 SQLite 連線（先跑一次 PRAGMA optimize）；其他模式不需呼叫。"""
+        with self._sqlite_shared_lock:
+            shared, self._sqlite_shared = self._sqlite_shared, None
+        if shared is not None:
+            shared.shutdown()
+
     def init(self):
         if self._pg:
             try:
@@ -340,367 +1031,133 @@ class Database:
                     "請修正 Render 的 DATABASE_URL / SUPABASE_PROJECT_REF / SUPABASE_POOLER_PORT；"
                     "修好後可關閉 DB_STARTUP_ALLOW_SQLITE_FALLBACK。"
                 )
-                self._pg = False
+                self._set_dialect(False)
                 self._database_url = ""
         self._init_sqlite()
 
     def _init_sqlite(self):
-        conn = self._connect()
-        try:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS meals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    timestamp TEXT NOT NULL,
-                    calories REAL NOT NULL,
-                    protein REAL NOT NULL,
-                    food_description TEXT NOT NULL,
-                    created_date TEXT NOT NULL
-                );
-
-                CREATE TABLE IF NOT EXISTS user_profiles (
-                    user_id TEXT PRIMARY KEY,
-                    weight REAL,
-                    body_fat_percentage REAL,
-                    muscle_mass REAL,
-                    bmr INTEGER,
-                    tdee INTEGER,
-                    daily_calorie_target INTEGER DEFAULT 2500,
-                    daily_protein_target INTEGER DEFAULT 300,
-                    last_inbody_date TEXT,
-                    created_at TEXT,
-                    updated_at TEXT,
-                    custom_quick_items TEXT
-                );
-
-                CREATE TABLE IF NOT EXISTS cheat_days (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    date TEXT NOT NULL,
-                    created_at TEXT,
-                    UNIQUE(user_id, date)
-                );
-
-                CREATE TABLE IF NOT EXISTS purchase_queries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    timestamp TEXT NOT NULL,
-                    food_name TEXT NOT NULL,
-                    decision TEXT,
-                    calories REAL,
-                    protein REAL,
-                    overall_grade TEXT,
-                    raw_data TEXT,
-                    created_at TEXT
-                );
-
-                CREATE TABLE IF NOT EXISTS weekly_scores (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    week_start TEXT NOT NULL,
-                    week_end TEXT NOT NULL,
-                    overall_grade TEXT,
-                    protein_grade TEXT,
-                    calorie_grade TEXT,
-                    regularity_grade TEXT,
-                    created_at TEXT
-                );
-
-                CREATE INDEX IF NOT EXISTS idx_meals_user_date
-                    ON meals(user_id, created_date);
-                CREATE INDEX IF NOT EXISTS idx_cheat_user_date
-                    ON cheat_days(user_id, date);
-                CREATE INDEX IF NOT EXISTS idx_purchase_user
-                    ON purchase_queries(user_id, timestamp);
-                CREATE INDEX IF NOT EXISTS idx_weekly_user
-                    ON weekly_scores(user_id, week_start);
-
-                CREATE TABLE IF NOT EXISTS user_message_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    at_utc TEXT NOT NULL
-                );
-                CREATE INDEX IF NOT EXISTS idx_user_msg_log_user_at
-                    ON user_message_log(user_id, at_utc);
-
-                CREATE TABLE IF NOT EXISTS reminder_sent (
-                    user_id TEXT NOT NULL,
-                    local_date TEXT NOT NULL,
-                    slot TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    PRIMARY KEY (user_id, local_date, slot)
-                );
-            """)
-            conn.commit()
-            logger.info("SQLite 資料庫初始化完成")
-        finally:
-            conn.close()
-        self._migrate_user_profiles_quick_items()
-        self._migrate_user_profiles_tdee()
-        self._migrate_user_profiles_onboarding()
-        self._migrate_user_profiles_jitai()
-        self._migrate_user_profiles_calorie_offset()
-        self._migrate_user_message_log_kind()
-
-    def _migrate_user_profiles_tdee(self):
-        """補上 user_profiles.tdee（InBody 建議熱量／TDEE）。"""
-        conn = self._connect()
-        try:
-            if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS tdee INTEGER"
-                    )
-                conn.commit()
-            else:
-                try:
-                    conn.execute("ALTER TABLE user_profiles ADD COLUMN tdee INTEGER")
-                    conn.commit()
-                except sqlite3.OperationalError as e:
-                    if "duplicate column" not in str(e).lower():
-                        raise
-        finally:
-            conn.close()
+        self._migrate_schema("SQLite")
 
-    def _migrate_user_profiles_onboarding(self):
-        """補上 fitness_goal、onboarding_complete；既有 InBody 使用者視為已完成 onboarding。"""
+    def _init_postgres(self):
+        self._migrate_schema("PostgreSQL")
+
+    def _read_schema_version(self, conn) -> int:
+        try:
+            row = conn.execute("SELECT MAX(version) AS v FROM schema_version").fetchone()
+        except Exception:
+            # 尚未建立 schema_version（全新或遷移框架前的舊資料庫）
+            conn.rollback()
+            return 0
+        row = self._row_to_dict(row)
+        return int(row["v"] or 0) if row else 0
+
+    def _migrate_schema(self, label: str):
+        """單一連線：版本最新則只做一次查詢；否則在同一交易內依序套用缺少的遷移。"""
+        t0 = time.perf_counter()
         conn = self._connect()
         try:
+            current = self._read_schema_version(conn)
+            if current >= SCHEMA_VERSION:
+                logger.info(
+                    "%s schema 已是 v%s，略過遷移（%.0f ms）",
+                    label, current, (time.perf_counter() - t0) * 1000,
+                )
+                return
             if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN IF NOT EXISTS fitness_goal TEXT"
-                    )
-                    cur.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN IF NOT EXISTS onboarding_complete INTEGER DEFAULT 0"
-                    )
-                    cur.execute(
-                        "UPDATE user_profiles SET onboarding_complete = 1 "
-                        "WHERE last_inbody_date IS NOT NULL "
-                        "AND (onboarding_complete IS NULL OR onboarding_complete = 0)"
-                    )
-                conn.commit()
+                conn.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_KEY,))
             else:
-                for col, ddl in (
-                    ("fitness_goal", "ALTER TABLE user_profiles ADD COLUMN fitness_goal TEXT"),
-                    (
-                        "onboarding_complete",
-                        "ALTER TABLE user_profiles ADD COLUMN onboarding_complete INTEGER DEFAULT 0",
-                    ),
-                ):
-                    try:
-                        conn.execute(ddl)
-                        conn.commit()
-                    except sqlite3.OperationalError as e:
-                        if "duplicate column" not in str(e).lower():
-                            raise
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+            try:
                 conn.execute(
-                    "UPDATE user_profiles SET onboarding_complete = 1 "
-                    "WHERE last_inbody_date IS NOT NULL "
-                    "AND (onboarding_complete IS NULL OR onboarding_complete = 0)"
+                    """CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TEXT NOT NULL
+                    )"""
                 )
-                conn.commit()
-        finally:
-            conn.close()
-
-    def _migrate_user_message_log_kind(self):
-        """補上 user_message_log.message_kind（text／image），供用餐提醒判斷是否已傳照片。"""
-        conn = self._connect()
-        try:
-            if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_message_log "
-                        "ADD COLUMN IF NOT EXISTS message_kind TEXT DEFAULT 'text'"
-                    )
-                    cur.execute(
-                        "UPDATE user_message_log SET message_kind = 'text' "
-                        "WHERE message_kind IS NULL"
-                    )
-                conn.commit()
-            else:
-                try:
+                # 取得鎖後重讀，其他程序可能已完成遷移
+                current = self._read_schema_version(conn)
+                applied = []
+                for version, name, steps in SCHEMA_MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for step in steps:
+                        self._apply_migration_step(conn, step)
                     conn.execute(
-                        "ALTER TABLE user_message_log ADD COLUMN message_kind TEXT DEFAULT 'text'"
+                        self._adapt(
+                            "INSERT INTO schema_version (version, name, applied_at) "
+                            "VALUES (?, ?, ?)"
+                        ),
+                        (version, name, datetime.now(timezone.utc).isoformat()),
                     )
+                    applied.append(version)
+                if self._pg:
                     conn.commit()
-                except sqlite3.OperationalError as e:
-                    if "duplicate column" not in str(e).lower():
-                        raise
-                conn.execute(
-                    "UPDATE user_message_log SET message_kind = 'text' "
-                    "WHERE message_kind IS NULL"
+                else:
+                    conn.execute("COMMIT")
+            except Exception:
+                if self._pg:
+                    conn.rollback()
+                else:
+                    conn.execute("ROLLBACK")
+                raise
+            if applied:
+                logger.info(
+                    "%s schema 遷移 v%s → v%s 完成（%.0f ms）",
+                    label, current, applied[-1], (time.perf_counter() - t0) * 1000,
                 )
-                conn.commit()
         finally:
             conn.close()
 
-    def _migrate_user_profiles_quick_items(self):
-        """舊資料庫補上 user_profiles.custom_quick_items。"""
-        conn = self._connect()
-        try:
+    def _apply_migration_step(self, conn, step):
+        if isinstance(step, _AddColumn):
+            decl = step.decl.format(**_DIALECT["postgres" if self._pg else "sqlite"])
             if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS custom_quick_items TEXT"
-                    )
-                conn.commit()
-            else:
-                try:
-                    conn.execute(
-                        "ALTER TABLE user_profiles ADD COLUMN custom_quick_items TEXT"
-                    )
-                    conn.commit()
-                except sqlite3.OperationalError as e:
-                    if "duplicate column" not in str(e).lower():
-                        raise
-        finally:
-            conn.close()
-
-    def _init_postgres(self):
-        stmts = [
-            """CREATE TABLE IF NOT EXISTS meals (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                calories DOUBLE PRECISION NOT NULL,
-                protein DOUBLE PRECISION NOT NULL,
-                food_description TEXT NOT NULL,
-                created_date TEXT NOT NULL
-            )""",
-            """CREATE TABLE IF NOT EXISTS user_profiles (
-                user_id TEXT PRIMARY KEY,
-                weight DOUBLE PRECISION,
-                body_fat_percentage DOUBLE PRECISION,
-                muscle_mass DOUBLE PRECISION,
-                bmr INTEGER,
-                tdee INTEGER,
-                daily_calorie_target INTEGER DEFAULT 2500,
-                daily_protein_target INTEGER DEFAULT 300,
-                last_inbody_date TEXT,
-                created_at TEXT,
-                updated_at TEXT,
-                custom_quick_items TEXT
-            )""",
-            """CREATE TABLE IF NOT EXISTS cheat_days (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                date TEXT NOT NULL,
-                created_at TEXT,
-                UNIQUE(user_id, date)
-            )""",
-            """CREATE TABLE IF NOT EXISTS purchase_queries (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                food_name TEXT NOT NULL,
-                decision TEXT,
-                calories DOUBLE PRECISION,
-                protein DOUBLE PRECISION,
-                overall_grade TEXT,
-                raw_data TEXT,
-                created_at TEXT
-            )""",
-            """CREATE TABLE IF NOT EXISTS weekly_scores (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                week_start TEXT NOT NULL,
-                week_end TEXT NOT NULL,
-                overall_grade TEXT,
-                protein_grade TEXT,
-                calorie_grade TEXT,
-                regularity_grade TEXT,
-                created_at TEXT
-            )""",
-            "CREATE INDEX IF NOT EXISTS idx_meals_user_date ON meals(user_id, created_date)",
-            "CREATE INDEX IF NOT EXISTS idx_cheat_user_date ON cheat_days(user_id, date)",
-            "CREATE INDEX IF NOT EXISTS idx_purchase_user ON purchase_queries(user_id, timestamp)",
-            "CREATE INDEX IF NOT EXISTS idx_weekly_user ON weekly_scores(user_id, week_start)",
-            """CREATE TABLE IF NOT EXISTS user_message_log (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                at_utc TEXT NOT NULL
-            )""",
-            "CREATE INDEX IF NOT EXISTS idx_user_msg_log_user_at ON user_message_log(user_id, at_utc)",
-            """CREATE TABLE IF NOT EXISTS reminder_sent (
-                user_id TEXT NOT NULL,
-                local_date TEXT NOT NULL,
-                slot TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                PRIMARY KEY (user_id, local_date, slot)
-            )""",
-        ]
-        conn = self._connect()
-        try:
+                conn.execute(
+                    f"ALTER TABLE {step.table} ADD COLUMN IF NOT EXISTS {step.column} {decl}"
+                )
+                return
+            cols = {
+                self._row_to_dict(r)["name"]
+                for r in conn.execute(f"PRAGMA table_info({step.table})").fetchall()
+            }
+            if step.column not in cols:
+                conn.execute(f"ALTER TABLE {step.table} ADD COLUMN {step.column} {decl}")
+        elif callable(step):
+            step(self, conn)
+        else:
+            conn.execute(step.format(**_DIALECT["postgres" if self._pg else "sqlite"]))
+
+    def _touch_user_activity(
+        self,
+        conn,
+        user_id: str,
+        *,
+        message_at: str | None = None,
+        meal_date: str | None = None,
+        jitai_enabled: bool | None = None,
+        onboarded: bool | None = None,
+    ):
+        """在呼叫端的交易內更新推播名冊（只前進時間戳；旗標 None 表示不變）。"""
+        params = (
+            user_id,
+            message_at,
+            meal_date,
+            None if jitai_enabled is None else int(bool(jitai_enabled)),
+            None if onboarded is None else int(bool(onboarded)),
+            datetime.now(timezone.utc).isoformat(),
+        )
+        sql = self._sql["user_activity_upsert"]
+        if self._pg:
             with conn.cursor() as cur:
-                for s in stmts:
-                    cur.execute(s)
-            conn.commit()
-            logger.info("PostgreSQL 資料庫初始化完成")
-        finally:
-            conn.close()
-        self._migrate_user_profiles_quick_items()
-        self._migrate_user_profiles_tdee()
-        self._migrate_user_profiles_onboarding()
-        self._migrate_user_profiles_jitai()
-        self._migrate_user_profiles_calorie_offset()
-        self._migrate_user_message_log_kind()
-
-    def _migrate_user_profiles_jitai(self):
-        """補上 jitai_nudges_enabled（智能提醒，預設關閉、需手動開啟）。"""
-        conn = self._connect()
-        try:
-            if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN IF NOT EXISTS jitai_nudges_enabled INTEGER DEFAULT 0"
-                    )
-                conn.commit()
-            else:
-                try:
-                    conn.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN jitai_nudges_enabled INTEGER DEFAULT 0"
-                    )
-                    conn.commit()
-                except sqlite3.OperationalError as e:
-                    if "duplicate column" not in str(e).lower():
-                        raise
-        finally:
-            conn.close()
-
-    def _migrate_user_profiles_calorie_offset(self):
-        """補上 calorie_offset（個人熱量微調，可為負值）。"""
-        conn = self._connect()
-        try:
-            if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN IF NOT EXISTS calorie_offset INTEGER DEFAULT 0"
-                    )
-                conn.commit()
-            else:
-                try:
-                    conn.execute(
-                        "ALTER TABLE user_profiles "
-                        "ADD COLUMN calorie_offset INTEGER DEFAULT 0"
-                    )
-                    conn.commit()
-                except sqlite3.OperationalError as e:
-                    if "duplicate column" not in str(e).lower():
-                        raise
-        finally:
-            conn.close()
+                cur.execute(sql, params)
+        else:
+            conn.execute(sql, params)
 
     def set_calorie_offset(self, user_id: str, offset: int):
         now = datetime.now().isoformat()
-        sql = self._adapt(
-            "UPDATE user_profiles SET calorie_offset = ?, updated_at = ? WHERE user_id = ?"
-        )
+        sql = self._sql["profile_set_calorie_offset"]
         conn = self._connect()
         try:
             if self._pg:
@@ -711,6 +1168,7 @@ class Database:
             conn.commit()
         finally:
             conn.close()
+        self._notify_change(user_id)
 
     def _row_to_dict(self, row):
         if row is None:
@@ -721,39 +1179,46 @@ class Database:
 
     # ━━━ 餐食記錄 ━━━
 
+    def _insert_meal(
+        self,
+        conn,
+        user_id: str,
+        calories: float,
+        protein: float,
+        description: str,
+        created_date: str,
+        timestamp: str | None = None,
+    ):
+        """在呼叫端的交易內寫入一筆餐點，並同步 daily_aggregates 與推播名冊。"""
+        meal_params = (
+            user_id, timestamp or datetime.now().isoformat(), calories, protein,
+            description, created_date,
+        )
+        agg_params = (
+            user_id, created_date, calories, protein,
+            datetime.now(timezone.utc).isoformat(),
+        )
+        if self._pg:
+            with conn.cursor() as cur:
+                cur.execute(self._sql["meal_insert"], meal_params)
+                cur.execute(self._sql["daily_aggregate_add_meal"], agg_params)
+        else:
+            conn.execute(self._sql["meal_insert"], meal_params)
+            conn.execute(self._sql["daily_aggregate_add_meal"], agg_params)
+        self._touch_user_activity(conn, user_id, meal_date=created_date)
+
     def add_meal(self, user_id: str, calories: float, protein: float,
                  description: str, created_date: str):
-        sql = self._adapt(
-            """INSERT INTO meals (user_id, timestamp, calories, protein,
-               food_description, created_date)
-               VALUES (?, ?, ?, ?, ?, ?)"""
-        )
         conn = self._connect()
         try:
-            if self._pg:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        sql,
-                        (user_id, datetime.now().isoformat(), calories, protein,
-                         description, created_date),
-                    )
-            else:
-                conn.execute(
-                    sql,
-                    (user_id, datetime.now().isoformat(), calories, protein,
-                     description, created_date),
-                )
+            self._insert_meal(conn, user_id, calories, protein, description, created_date)
             conn.commit()
         finally:
             conn.close()
+        self._notify_change(user_id, created_date)
 
     def get_daily_totals(self, user_id: str, date_str: str) -> dict:
-        sql = self._adapt(
-            """SELECT COALESCE(SUM(calories), 0) as calories,
-                      COALESCE(SUM(protein), 0) as protein,
-                      COUNT(*) as meal_count
-               FROM meals WHERE user_id = ? AND created_date = ?"""
-        )
+        sql = self._sql["meal_day_totals"]
         conn = self._connect()
         try:
             if self._pg:
@@ -772,11 +1237,7 @@ class Database:
             conn.close()
 
     def get_meals_today(self, user_id: str, date_str: str) -> list[dict]:
-        sql = self._adapt(
-            """SELECT calories, protein, food_description, timestamp
-               FROM meals WHERE user_id = ? AND created_date = ?
-               ORDER BY timestamp"""
-        )
+        sql = self._sql["meals_for_day"]
         conn = self._connect()
         try:
             if self._pg:
@@ -790,25 +1251,96 @@ class Database:
             conn.close()
 
     def clear_today(self, user_id: str, date_str: str) -> int:
-        sql = self._adapt("DELETE FROM meals WHERE user_id = ? AND created_date = ?")
+        sql = self._sql["meals_delete_day"]
+        agg_sql = self._sql["daily_aggregate_delete_day"]
         conn = self._connect()
         try:
             if self._pg:
                 with conn.cursor() as cur:
                     cur.execute(sql, (user_id, date_str))
                     n = cur.rowcount
+                    cur.execute(agg_sql, (user_id, date_str))
             else:
                 cur = conn.execute(sql, (user_id, date_str))
                 n = cur.rowcount
+                conn.execute(agg_sql, (user_id, date_str))
             conn.commit()
-            return n
+        finally:
+            conn.close()
+        self._notify_change(user_id, date_str)
+        return n
+
+    def get_daily_aggregates(self, user_id: str, start_date: str, end_date: str) -> list[dict]:
+        """[start_date, end_date] 內有紀錄的日子（date, calories, protein, meal_count），依日期排序。"""
+        sql = self._sql["daily_aggregates_range"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (user_id, start_date, end_date))
+                    rows = cur.fetchall()
+            else:
+                rows = conn.execute(sql, (user_id, start_date, end_date)).fetchall()
+            return [self._row_to_dict(r) for r in rows]
+        finally:
+            conn.close()
+
+    def get_daily_aggregates_for_users(
+        self, user_ids: list[str], start_date: str, end_date: str, chunk_size: int = 500,
+    ) -> dict[str, list[dict]]:
+        """多位使用者的 get_daily_aggregates（每 chunk_size 人一次 IN 查詢）。"""
+        out: dict[str, list[dict]] = {uid: [] for uid in user_ids}
+        conn = self._connect()
+        try:
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i:i + chunk_size]
+                sql = self._adapt(
+                    f"""SELECT user_id, date, calories, protein, meal_count FROM daily_aggregates
+                        WHERE user_id IN ({', '.join('?' * len(chunk))})
+                          AND date >= ? AND date <= ?
+                        ORDER BY user_id, date"""
+                )
+                params = (*chunk, start_date, end_date)
+                if self._pg:
+                    with conn.cursor() as cur:
+                        cur.execute(sql, params)
+                        rows = cur.fetchall()
+                else:
+                    rows = conn.execute(sql, params).fetchall()
+                for r in rows:
+                    r = self._row_to_dict(r)
+                    out[r["user_id"]].append(r)
+            return out
         finally:
             conn.close()
 
+    def get_meal_since_audience_page(
+        self, since_date: str, after_user_id: str = "", limit: int = AUDIENCE_PAGE_SIZE,
+    ) -> list[str]:
+        """since_date（含）之後有餐點紀錄的使用者（daily_aggregates 主鍵範圍掃描）。"""
+        sql = self._sql["meal_since_audience_page"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (since_date, after_user_id, limit))
+                    rows = cur.fetchall()
+            else:
+                rows = conn.execute(sql, (since_date, after_user_id, limit)).fetchall()
+            return [self._row_to_dict(r)["user_id"] for r in rows]
+        finally:
+            conn.close()
+
+    def iter_user_ids_with_meals_since(
+        self, since_date: str, page_size: int = AUDIENCE_PAGE_SIZE,
+    ):
+        def fetch(after_user_id: str, limit: int) -> list[str]:
+            return self.get_meal_since_audience_page(since_date, after_user_id, limit)
+
+        return self._iter_audience(fetch, page_size)
+
     def get_active_users_today(self, date_str: str) -> list[str]:
-        sql = self._adapt(
-            "SELECT DISTINCT user_id FROM meals WHERE created_date = ?"
-        )
+        sql = self._sql["meal_users_on_date"]
         conn = self._connect()
         try:
             if self._pg:
@@ -826,65 +1358,21 @@ class Database:
     def update_custom_quick_items(self, user_id: str, items_json: str):
         """儲存使用者自訂快速記錄品項（JSON 字串）。"""
         now = datetime.now(timezone.utc).isoformat()
+        sql = self._sql["profile_set_quick_items"]
+        params = (user_id, items_json, 2500, 300, now, now)
         conn = self._connect()
         try:
-            sel = self._adapt("SELECT user_id FROM user_profiles WHERE user_id = ?")
             if self._pg:
                 with conn.cursor() as cur:
-                    cur.execute(sel, (user_id,))
-                    existing = cur.fetchone()
-                    if existing:
-                        upd = self._adapt(
-                            """UPDATE user_profiles
-                               SET custom_quick_items = ?, updated_at = ?
-                               WHERE user_id = ?"""
-                        )
-                        cur.execute(upd, (items_json, now, user_id))
-                    else:
-                        ins = self._adapt(
-                            """INSERT INTO user_profiles
-                               (user_id, custom_quick_items, daily_calorie_target,
-                                daily_protein_target, created_at, updated_at)
-                               VALUES (?, ?, ?, ?, ?, ?)"""
-                        )
-                        cur.execute(
-                            ins,
-                            (
-                                user_id,
-                                items_json,
-                                2500,
-                                300,
-                                now,
-                                now,
-                            ),
-                        )
+                    cur.execute(sql, params)
             else:
-                existing = conn.execute(sel, (user_id,)).fetchone()
-                if existing:
-                    conn.execute(
-                        self._adapt(
-                            """UPDATE user_profiles
-                               SET custom_quick_items = ?, updated_at = ?
-                               WHERE user_id = ?"""
-                        ),
-                        (items_json, now, user_id),
-                    )
-                else:
-                    conn.execute(
-                        self._adapt(
-                            """INSERT INTO user_profiles
-                               (user_id, custom_quick_items, daily_calorie_target,
-                                daily_protein_target, created_at, updated_at)
-                               VALUES (?, ?, ?, ?, ?, ?)"""
-                        ),
-                        (user_id, items_json, 2500, 300, now, now),
-                    )
+                conn.execute(sql, params)
             conn.commit()
         finally:
             conn.close()
 
     def get_user_profile(self, user_id: str) -> Optional[dict]:
-        sql = self._adapt("SELECT * FROM user_profiles WHERE user_id = ?")
+        sql = self._sql["profile_get"]
         conn = self._connect()
         try:
             if self._pg:
@@ -893,25 +1381,74 @@ class Database:
                     row = cur.fetchone()
             else:
                 row = conn.execute(sql, (user_id,)).fetchone()
-            return self._row_to_dict(row) if row else None
+            profile = self._row_to_dict(row) if row else None
+        finally:
+            conn.close()
+        self._remember_onboarding_state(user_id, OnboardingState.from_profile(profile))
+        return profile
+
+    def get_user_profiles(self, user_ids: list[str], chunk_size: int = 500) -> dict[str, dict]:
+        """批次讀取多位使用者的 profile（每批一個 IN 查詢），回傳 user_id → profile。"""
+        out: dict[str, dict] = {}
+        ids = list(dict.fromkeys(user_ids))
+        if not ids:
+            return out
+        conn = self._connect()
+        try:
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i : i + chunk_size]
+                sql = self._adapt(
+                    "SELECT * FROM user_profiles WHERE user_id IN "
+                    f"({', '.join('?' for _ in chunk)})"
+                )
+                if self._pg:
+                    with conn.cursor() as cur:
+                        cur.execute(sql, chunk)
+                        rows = cur.fetchall()
+                else:
+                    rows = conn.execute(sql, chunk).fetchall()
+                for r in rows:
+                    d = self._row_to_dict(r)
+                    out[d["user_id"]] = d
         finally:
             conn.close()
+        for uid in ids:
+            self._remember_onboarding_state(uid, OnboardingState.from_profile(out.get(uid)))
+        return out
+
+    # ━━━ Onboarding 狀態快取 ━━━
+
+    def _remember_onboarding_state(self, user_id: str, state: OnboardingState) -> None:
+        cache = self._onboarding_cache
+        if user_id not in cache and len(cache) >= ONBOARDING_CACHE_MAX:
+            # dict 保留插入順序，丟掉最舊的一筆
+            cache.pop(next(iter(cache)), None)
+        expires = (
+            None if state & OnboardingState.ONBOARDED
+            else time.monotonic() + ONBOARDING_CACHE_TTL_SEC
+        )
+        cache[user_id] = (state, expires)
+
+    def _forget_onboarding_state(self, user_id: str) -> None:
+        self._onboarding_cache.pop(user_id, None)
+
+    def onboarding_state(self, user_id: str) -> OnboardingState:
+        """路由用的 onboarding 進度；已完成 onboarding 的使用者不查 DB。"""
+        cached = self._onboarding_cache.get(user_id)
+        if cached is not None:
+            state, expires = cached
+            if expires is None or expires > time.monotonic():
+                return state
+        return OnboardingState.from_profile(self.get_user_profile(user_id))
 
     def is_onboarded(self, user_id: str) -> bool:
-        profile = self.get_user_profile(user_id)
-        if not profile:
-            return False
-        return bool(profile.get("onboarding_complete"))
+        return bool(self.onboarding_state(user_id) & OnboardingState.ONBOARDED)
 
     def needs_inbody(self, user_id: str) -> bool:
-        profile = self.get_user_profile(user_id)
-        return profile is None or not profile.get("last_inbody_date")
+        return not self.onboarding_state(user_id) & OnboardingState.HAS_INBODY
 
     def needs_fitness_goal(self, user_id: str) -> bool:
-        profile = self.get_user_profile(user_id)
-        if not profile or not profile.get("last_inbody_date"):
-            return False
-        return not bool(profile.get("onboarding_complete"))
+        return self.onboarding_state(user_id) == OnboardingState.HAS_INBODY
 
     def jitai_nudges_enabled(self, user_id: str) -> bool:
         profile = self.get_user_profile(user_id)
@@ -921,70 +1458,43 @@ class Database:
 
     def set_jitai_nudges_enabled(self, user_id: str, enabled: bool) -> None:
         now = datetime.now().isoformat()
+        sql = self._sql["profile_set_jitai"]
+        params = (user_id, 1 if enabled else 0, now, now)
         conn = self._connect()
         try:
-            sel = self._adapt("SELECT user_id FROM user_profiles WHERE user_id = ?")
             if self._pg:
                 with conn.cursor() as cur:
-                    cur.execute(sel, (user_id,))
-                    exists = cur.fetchone()
-                    if exists:
-                        cur.execute(
-                            self._adapt(
-                                "UPDATE user_profiles SET jitai_nudges_enabled = ?, "
-                                "updated_at = ? WHERE user_id = ?"
-                            ),
-                            (1 if enabled else 0, now, user_id),
-                        )
-                    else:
-                        cur.execute(
-                            self._adapt(
-                                """INSERT INTO user_profiles
-                                   (user_id, jitai_nudges_enabled, created_at, updated_at)
-                                   VALUES (?, ?, ?, ?)"""
-                            ),
-                            (user_id, 1 if enabled else 0, now, now),
-                        )
+                    cur.execute(sql, params)
             else:
-                exists = conn.execute(sel, (user_id,)).fetchone()
-                if exists:
-                    conn.execute(
-                        self._adapt(
-                            "UPDATE user_profiles SET jitai_nudges_enabled = ?, "
-                            "updated_at = ? WHERE user_id = ?"
-                        ),
-                        (1 if enabled else 0, now, user_id),
-                    )
-                else:
-                    conn.execute(
-                        self._adapt(
-                            """INSERT INTO user_profiles
-                               (user_id, jitai_nudges_enabled, created_at, updated_at)
-                               VALUES (?, ?, ?, ?)"""
-                        ),
-                        (user_id, 1 if enabled else 0, now, now),
-                    )
+                conn.execute(sql, params)
+            self._touch_user_activity(conn, user_id, jitai_enabled=enabled)
             conn.commit()
         finally:
             conn.close()
 
-    def get_user_ids_with_jitai_enabled(self) -> list[str]:
-        sql = self._adapt(
-            """SELECT user_id FROM user_profiles
-               WHERE jitai_nudges_enabled = 1 AND onboarding_complete = 1"""
-        )
+    def get_jitai_audience_page(
+        self, after_user_id: str = "", limit: int = AUDIENCE_PAGE_SIZE,
+    ) -> list[str]:
+        """已開啟智能提醒且完成 onboarding 的使用者（idx_user_activity_jitai 範圍掃描）。"""
+        sql = self._sql["jitai_audience_page"]
         conn = self._connect()
         try:
             if self._pg:
                 with conn.cursor() as cur:
-                    cur.execute(sql)
+                    cur.execute(sql, (after_user_id, limit))
                     rows = cur.fetchall()
             else:
-                rows = conn.execute(sql).fetchall()
+                rows = conn.execute(sql, (after_user_id, limit)).fetchall()
             return [self._row_to_dict(r)["user_id"] for r in rows]
         finally:
             conn.close()
 
+    def iter_user_ids_with_jitai_enabled(self, page_size: int = AUDIENCE_PAGE_SIZE):
+        return self._iter_audience(self.get_jitai_audience_page, page_size)
+
+    def get_user_ids_with_jitai_enabled(self) -> list[str]:
+        return list(self.iter_user_ids_with_jitai_enabled())
+
     def complete_onboarding(
         self,
         user_id: str,
@@ -995,97 +1505,89 @@ class Database:
         now = datetime.now().isoformat()
         conn = self._connect()
         try:
-            sql = self._adapt(
-                """UPDATE user_profiles
-                   SET fitness_goal = ?, daily_calorie_target = ?,
-                       daily_protein_target = ?, onboarding_complete = 1,
-                       updated_at = ?
-                   WHERE user_id = ?"""
-            )
+            sql = self._sql["profile_complete_onboarding"]
             params = (fitness_goal, calorie_target, protein_target, now, user_id)
             if self._pg:
                 with conn.cursor() as cur:
                     cur.execute(sql, params)
+                    updated = cur.rowcount
             else:
-                conn.execute(sql, params)
+                updated = conn.execute(sql, params).rowcount
+            self._touch_user_activity(conn, user_id, onboarded=True)
             conn.commit()
+        except Exception:
+            self._forget_onboarding_state(user_id)
+            raise
         finally:
             conn.close()
+        self._notify_change(user_id)
+        if updated:
+            cached = self._onboarding_cache.get(user_id)
+            if cached is not None:
+                self._remember_onboarding_state(
+                    user_id, cached[0] | OnboardingState.ONBOARDED,
+                )
+            else:
+                self._forget_onboarding_state(user_id)
 
     def upsert_user_profile(self, user_id: str, weight=None, body_fat=None,
                             muscle_mass=None, bmr=None, tdee=None,
                             calorie_target=None, protein_target=None,
                             onboarding_complete: int | None = None):
+        """InBody 等資料寫入：新使用者建檔，既有者只覆寫非 None 的欄位（單一 upsert）。"""
         now = datetime.now().isoformat()
+        today = date.today().isoformat()
+        fields = (
+            ("weight", weight),
+            ("body_fat_percentage", body_fat),
+            ("muscle_mass", muscle_mass),
+            ("bmr", bmr),
+            ("tdee", tdee),
+            ("daily_calorie_target", calorie_target),
+            ("daily_protein_target", protein_target),
+            ("onboarding_complete", onboarding_complete),
+        )
+        ob = 0 if onboarding_complete is None else int(onboarding_complete)
+        insert_params = (
+            user_id, weight, body_fat, muscle_mass, bmr, tdee,
+            calorie_target or 2500, protein_target or 300,
+            ob, today, now, now,
+        )
+        sql = self._sql["profile_upsert_returning" if self._returning else "profile_upsert"]
+        params = insert_params + tuple(val for _, val in fields)
         conn = self._connect()
         try:
-            sel = self._adapt("SELECT user_id FROM user_profiles WHERE user_id = ?")
             if self._pg:
                 with conn.cursor() as cur:
-                    cur.execute(sel, (user_id,))
-                    existing = cur.fetchone()
-            else:
-                existing = conn.execute(sel, (user_id,)).fetchone()
-
-            if existing:
-                updates = []
-                values = []
-                for col, val in [
-                    ("weight", weight),
-                    ("body_fat_percentage", body_fat),
-                    ("muscle_mass", muscle_mass),
-                    ("bmr", bmr),
-                    ("tdee", tdee),
-                    ("daily_calorie_target", calorie_target),
-                    ("daily_protein_target", protein_target),
-                    ("onboarding_complete", onboarding_complete),
-                ]:
-                    if val is not None:
-                        updates.append(f"{col} = ?")
-                        values.append(val)
-                updates.append("last_inbody_date = ?")
-                values.append(date.today().isoformat())
-                updates.append("updated_at = ?")
-                values.append(now)
-                values.append(user_id)
-
-                sql = self._adapt(
-                    f"UPDATE user_profiles SET {', '.join(updates)} WHERE user_id = ?"
-                )
-                if self._pg:
-                    with conn.cursor() as cur:
-                        cur.execute(sql, values)
-                else:
-                    conn.execute(sql, values)
+                    cur.execute(sql, params)
+                    row = cur.fetchone() if self._returning else None
             else:
-                ins = self._adapt(
-                    """INSERT INTO user_profiles
-                       (user_id, weight, body_fat_percentage, muscle_mass, bmr, tdee,
-                        daily_calorie_target, daily_protein_target,
-                        onboarding_complete, last_inbody_date, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+                cur = conn.execute(sql, params)
+                row = cur.fetchone() if self._returning else None
+            if onboarding_complete is not None:
+                self._touch_user_activity(
+                    conn, user_id, onboarded=bool(onboarding_complete),
                 )
-                ob = 0 if onboarding_complete is None else int(onboarding_complete)
-                params = (
-                    user_id, weight, body_fat, muscle_mass, bmr, tdee,
-                    calorie_target or 2500, protein_target or 300,
-                    ob, date.today().isoformat(), now, now,
-                )
-                if self._pg:
-                    with conn.cursor() as cur:
-                        cur.execute(ins, params)
-                else:
-                    conn.execute(ins, params)
             conn.commit()
+        except Exception:
+            self._forget_onboarding_state(user_id)
+            raise
         finally:
             conn.close()
+        self._notify_change(user_id)
+        # last_inbody_date 一律寫入；onboarding_complete 以寫入後的列為準
+        if row is None:
+            self._forget_onboarding_state(user_id)
+            return
+        state = OnboardingState.HAS_INBODY
+        if self._row_to_dict(row)["onboarding_complete"]:
+            state |= OnboardingState.ONBOARDED
+        self._remember_onboarding_state(user_id, state)
 
     # ━━━ 欺騙日 ━━━
 
     def is_cheat_day(self, user_id: str, date_str: str) -> bool:
-        sql = self._adapt(
-            "SELECT 1 FROM cheat_days WHERE user_id = ? AND date = ? LIMIT 1"
-        )
+        sql = self._sql["cheat_day_exists"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1100,31 +1602,22 @@ class Database:
 
     def activate_cheat_day(self, user_id: str, date_str: str):
         now = datetime.now().isoformat()
+        sql = self._sql["cheat_day_insert"]
         conn = self._connect()
         try:
             if self._pg:
-                sql = (
-                    "INSERT INTO cheat_days (user_id, date, created_at) VALUES (%s, %s, %s) "
-                    "ON CONFLICT (user_id, date) DO NOTHING"
-                )
                 with conn.cursor() as cur:
                     cur.execute(sql, (user_id, date_str, now))
             else:
-                conn.execute(
-                    """INSERT OR IGNORE INTO cheat_days (user_id, date, created_at)
-                       VALUES (?, ?, ?)""",
-                    (user_id, date_str, now),
-                )
+                conn.execute(sql, (user_id, date_str, now))
             conn.commit()
         finally:
             conn.close()
+        self._notify_change(user_id, date_str)
 
     def count_cheat_days_in_range(self, user_id: str,
                                   start_date: str, end_date: str) -> int:
-        sql = self._adapt(
-            """SELECT COUNT(*) as cnt FROM cheat_days
-               WHERE user_id = ? AND date >= ? AND date <= ?"""
-        )
+        sql = self._sql["cheat_day_count"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1163,12 +1656,7 @@ class Database:
         calories = _num(analysis.get("calories"), 0.0)
         protein = _num(analysis.get("protein"), 0.0)
         now = datetime.now().isoformat()
-        sql_pq = self._adapt(
-            """INSERT INTO purchase_queries
-               (user_id, timestamp, food_name, decision, calories, protein,
-                overall_grade, raw_data, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        )
+        sql_pq = self._sql["purchase_insert"]
         params_pq = (
             user_id, now,
             analysis.get("name", "未知"),
@@ -1184,44 +1672,20 @@ class Database:
             if self._pg:
                 with conn.cursor() as cur:
                     cur.execute(sql_pq, params_pq)
-                    if decision == "purchased":
-                        sql_m = self._adapt(
-                            """INSERT INTO meals
-                               (user_id, timestamp, calories, protein,
-                                food_description, created_date)
-                               VALUES (?, ?, ?, ?, ?, ?)"""
-                        )
-                        cur.execute(
-                            sql_m,
-                            (
-                                user_id, now,
-                                calories,
-                                protein,
-                                f"[購買] {analysis.get('name', '未知')}",
-                                date.today().isoformat(),
-                            ),
-                        )
             else:
                 conn.execute(sql_pq, params_pq)
-                if decision == "purchased":
-                    conn.execute(
-                        self._adapt(
-                            """INSERT INTO meals
-                               (user_id, timestamp, calories, protein,
-                                food_description, created_date)
-                               VALUES (?, ?, ?, ?, ?, ?)"""
-                        ),
-                        (
-                            user_id, now,
-                            calories,
-                            protein,
-                            f"[購買] {analysis.get('name', '未知')}",
-                            date.today().isoformat(),
-                        ),
-                    )
+            if decision == "purchased":
+                self._insert_meal(
+                    conn, user_id, calories, protein,
+                    f"[購買] {analysis.get('name', '未知')}",
+                    date.today().isoformat(),
+                    timestamp=now,
+                )
             conn.commit()
         finally:
             conn.close()
+        if decision == "purchased":
+            self._notify_change(user_id, date.today().isoformat())
 
     # ━━━ 用餐提醒（LINE 訊息時間軸）━━━
 
@@ -1236,9 +1700,7 @@ class Database:
         kind = (message_kind or "text").strip().lower()
         if kind not in ("text", "image", "other"):
             kind = "other"
-        sql = self._adapt(
-            "INSERT INTO user_message_log (user_id, at_utc, message_kind) VALUES (?, ?, ?)"
-        )
+        sql = self._sql["message_log_insert"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1246,6 +1708,7 @@ class Database:
                     cur.execute(sql, (user_id, ts, kind))
             else:
                 conn.execute(sql, (user_id, ts, kind))
+            self._touch_user_activity(conn, user_id, message_at=ts)
             conn.commit()
         finally:
             conn.close()
@@ -1254,11 +1717,7 @@ class Database:
         self, user_id: str, start_iso: str, end_iso: str
     ) -> bool:
         """是否有訊息記錄落在 [start_iso, end_iso)（ISO 字串，建議 UTC）。"""
-        sql = self._adapt(
-            """SELECT 1 FROM user_message_log
-               WHERE user_id = ? AND at_utc >= ? AND at_utc < ?
-               LIMIT 1"""
-        )
+        sql = self._sql["message_in_range"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1275,12 +1734,7 @@ class Database:
         self, user_id: str, created_date: str, start_iso: str, end_iso: str
     ) -> bool:
         """該日已入帳的餐點中，是否有任一筆的 timestamp 落在 [start_iso, end_iso)（UTC ISO）。"""
-        sql = self._adapt(
-            """SELECT 1 FROM meals
-               WHERE user_id = ? AND created_date = ?
-               AND timestamp >= ? AND timestamp < ?
-               LIMIT 1"""
-        )
+        sql = self._sql["meal_in_window"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1309,12 +1763,7 @@ class Database:
         if end_dt.tzinfo is None:
             end_dt = end_dt.replace(tzinfo=timezone.utc)
         start_dt = end_dt - timedelta(minutes=max(1, minutes))
-        sql = self._adapt(
-            """SELECT 1 FROM meals
-               WHERE user_id = ? AND created_date = ?
-               AND timestamp >= ? AND timestamp < ?
-               LIMIT 1"""
-        )
+        sql = self._sql["meal_in_window"]
         conn = self._connect()
         try:
             params = (
@@ -1337,12 +1786,7 @@ class Database:
         self, user_id: str, start_iso: str, end_iso: str
     ) -> bool:
         """該時段內是否曾傳送圖片訊息（僅 message_kind=image）。"""
-        sql = self._adapt(
-            """SELECT 1 FROM user_message_log
-               WHERE user_id = ? AND at_utc >= ? AND at_utc < ?
-               AND COALESCE(message_kind, 'text') = 'image'
-               LIMIT 1"""
-        )
+        sql = self._sql["photo_in_range"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1355,43 +1799,61 @@ class Database:
         finally:
             conn.close()
 
-    def get_user_ids_for_meal_reminders(self, meal_since_date: str) -> list[str]:
-        """曾傳過訊息，或近期有餐點紀錄的使用者（去重）。"""
+    def get_meal_reminder_audience_page(
+        self,
+        meal_since_date: str,
+        after_user_id: str = "",
+        limit: int = AUDIENCE_PAGE_SIZE,
+    ) -> list[str]:
+        """曾傳過訊息，或 meal_since_date 後有餐點紀錄的使用者（依 user_id 游標分頁）。"""
+        sql = self._sql["meal_reminder_audience_page"]
+        params = (after_user_id, meal_since_date, limit)
         conn = self._connect()
         try:
             if self._pg:
-                sql = """
-                    SELECT DISTINCT user_id FROM (
-                        SELECT user_id FROM user_message_log
-                        UNION
-                        SELECT DISTINCT user_id FROM meals WHERE created_date >= %s
-                    ) AS u
-                """
                 with conn.cursor() as cur:
-                    cur.execute(sql, (meal_since_date,))
+                    cur.execute(sql, params)
                     rows = cur.fetchall()
             else:
-                sql = """
-                    SELECT DISTINCT user_id FROM (
-                        SELECT user_id FROM user_message_log
-                        UNION
-                        SELECT user_id FROM meals WHERE created_date >= ?
-                    ) AS u
-                """
-                rows = conn.execute(sql, (meal_since_date,)).fetchall()
+                rows = conn.execute(sql, params).fetchall()
             return [self._row_to_dict(r)["user_id"] for r in rows]
         finally:
             conn.close()
 
-    def get_user_ids_for_daily_summary(self, meal_since_date: str) -> list[str]:
+    @staticmethod
+    def _iter_audience(fetch_page, page_size: int):
+        """依 user_id 游標逐頁讀取推播對象；每頁各自連線，迭代期間不持有交易。"""
+        after = ""
+        while True:
+            page = fetch_page(after_user_id=after, limit=page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+
+    def iter_user_ids_for_meal_reminders(
+        self, meal_since_date: str, page_size: int = AUDIENCE_PAGE_SIZE,
+    ):
+        def fetch(after_user_id: str, limit: int) -> list[str]:
+            return self.get_meal_reminder_audience_page(meal_since_date, after_user_id, limit)
+
+        return self._iter_audience(fetch, page_size)
+
+    def get_user_ids_for_meal_reminders(self, meal_since_date: str) -> list[str]:
+        """曾傳過訊息，或近期有餐點紀錄的使用者（去重）。"""
+        return list(self.iter_user_ids_for_meal_reminders(meal_since_date))
+
+    def iter_user_ids_for_daily_summary(
+        self, meal_since_date: str, page_size: int = AUDIENCE_PAGE_SIZE,
+    ):
         """每日總結推播對象：近期曾互動或有餐點紀錄者（與用餐提醒同一池，避免只吃到『當天有紀錄』）。"""
-        return self.get_user_ids_for_meal_reminders(meal_since_date)
+        return self.iter_user_ids_for_meal_reminders(meal_since_date, page_size)
+
+    def get_user_ids_for_daily_summary(self, meal_since_date: str) -> list[str]:
+        return list(self.iter_user_ids_for_daily_summary(meal_since_date))
 
     def reminder_already_sent(self, user_id: str, local_date: str, slot: str) -> bool:
-        sql = self._adapt(
-            """SELECT 1 FROM reminder_sent
-               WHERE user_id = ? AND local_date = ? AND slot = ? LIMIT 1"""
-        )
+        sql = self._sql["reminder_sent_exists"]
         conn = self._connect()
         try:
             if self._pg:
@@ -1406,53 +1868,276 @@ class Database:
 
     def mark_reminder_sent(self, user_id: str, local_date: str, slot: str):
         now = datetime.now(timezone.utc).isoformat()
+        sql = self._sql["reminder_sent_insert"]
+        params = (user_id, local_date, slot, now)
         conn = self._connect()
         try:
             if self._pg:
-                sql = (
-                    "INSERT INTO reminder_sent (user_id, local_date, slot, created_at) "
-                    "VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, local_date, slot) DO NOTHING"
-                )
                 with conn.cursor() as cur:
-                    cur.execute(sql, (user_id, local_date, slot, now))
+                    cur.execute(sql, params)
             else:
-                conn.execute(
-                    """INSERT OR IGNORE INTO reminder_sent
-                       (user_id, local_date, slot, created_at)
-                       VALUES (?, ?, ?, ?)""",
-                    (user_id, local_date, slot, now),
+                conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ━━━ Webhook 去重 ━━━
+
+    def claim_webhook_event(self, event_id: str, received_at: str | None = None) -> bool:
+        """首次見到此 webhookEventId 時寫入並回傳 True；已由任一程序處理過則回傳 False。"""
+        ts = received_at or datetime.now(timezone.utc).isoformat()
+        sql = self._sql["webhook_event_claim"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (event_id, ts))
+                    n = cur.rowcount
+            else:
+                n = conn.execute(sql, (event_id, ts)).rowcount
+            conn.commit()
+            return n > 0
+        finally:
+            conn.close()
+
+    def prune_webhook_events(self, before_iso: str) -> int:
+        """刪除早於 before_iso 的去重記錄（LINE 僅在短時間內重送）。"""
+        sql = self._sql["webhook_event_prune"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (before_iso,))
+                    n = cur.rowcount
+            else:
+                n = conn.execute(sql, (before_iso,)).rowcount
+            conn.commit()
+            return n
+        finally:
+            conn.close()
+
+    # ━━━ OpenAI 呼叫遙測 ━━━
+
+    def record_openai_calls(self, records: list) -> int:
+        """批次寫入 OpenAICallRecord（或同欄位順序的 tuple）。"""
+        if not records:
+            return 0
+        sql = self._sql["openai_calls_insert"]
+        rows = [tuple(r) for r in records]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.executemany(sql, rows)
+            else:
+                conn.executemany(sql, rows)
+            conn.commit()
+            return len(rows)
+        finally:
+            conn.close()
+
+    def get_openai_usage_summary(self, local_date: str, user_id: str | None = None) -> list[dict]:
+        """某日各使用者 × prompt 的呼叫數、token 與延遲彙總（token 多者在前）。"""
+        if user_id:
+            sql = self._sql["openai_usage_by_day_user"]
+            params: tuple = (local_date, user_id)
+        else:
+            sql = self._sql["openai_usage_by_day"]
+            params = (local_date,)
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall()
+            else:
+                rows = conn.execute(sql, params).fetchall()
+            out = []
+            for r in rows:
+                d = self._row_to_dict(r)
+                for k in ("avg_latency_ms", "max_latency_ms"):
+                    if d.get(k) is not None:
+                        d[k] = round(float(d[k]), 1)
+                d["cache_hit_ratio"] = (
+                    round(d["cached_tokens"] / d["prompt_tokens"], 3) if d["prompt_tokens"] else 0.0
                 )
+                out.append(d)
+            return out
+        finally:
+            conn.close()
+
+    def prune_openai_calls(self, before_iso: str) -> int:
+        sql = self._sql["openai_calls_prune"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (before_iso,))
+                    n = cur.rowcount
+            else:
+                n = conn.execute(sql, (before_iso,)).rowcount
             conn.commit()
+            return n
+        finally:
+            conn.close()
+
+    # ━━━ 背景批次工作 ━━━
+
+    _CRON_JOB_FIELDS = frozenset({
+        "status", "total", "processed", "ok", "skipped", "failed",
+        "result", "error", "started_at", "finished_at",
+    })
+
+    def start_cron_job(
+        self,
+        job_id: str,
+        kind: str,
+        dedupe_key: str,
+        params: dict,
+        stale_after_sec: float = 900,
+    ) -> tuple[str, bool]:
+        """建立 queued 工作，回傳 (job_id, True)。
+
+        同 dedupe_key 已有未結束、且 stale_after_sec 內仍有進度的工作時不重建，
+        回傳 (既有 id, False)；程序中途重啟留下的 running 紀錄逾時後視為失效。
+        查詢與建立在同一把鎖內（PostgreSQL 以 dedupe_key 的 advisory lock，SQLite 以 BEGIN IMMEDIATE），
+        手動觸發與排程同時送達時只會有一方建立工作。
+        """
+        now = datetime.now(timezone.utc)
+        fresh_after = (now - timedelta(seconds=stale_after_sec)).isoformat()
+        find_sql = self._sql["cron_job_find_active"]
+        insert_sql = self._sql["cron_job_insert"]
+        ts = now.isoformat()
+        row_params = (job_id, kind, dedupe_key, json.dumps(params, ensure_ascii=False), ts, ts)
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                        (_CRON_JOB_LOCK_NAMESPACE, dedupe_key),
+                    )
+                    cur.execute(find_sql, (dedupe_key, fresh_after))
+                    row = cur.fetchone()
+                    if row is None:
+                        cur.execute(insert_sql, row_params)
+                conn.commit()
+            else:
+                # 先取得寫鎖再查詢，其他程序的同鍵工作須等這筆交易結束
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute(find_sql, (dedupe_key, fresh_after)).fetchone()
+                    if row is None:
+                        conn.execute(insert_sql, row_params)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            if row is not None:
+                return self._row_to_dict(row)["id"], False
+            return job_id, True
         finally:
             conn.close()
 
+    def update_cron_job(self, job_id: str, **fields) -> None:
+        """更新進度欄位；result 可傳 dict（存成 JSON）。"""
+        unknown = set(fields) - self._CRON_JOB_FIELDS
+        if unknown:
+            raise ValueError(f"unknown cron_jobs fields: {sorted(unknown)}")
+        if isinstance(fields.get("result"), dict):
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+        cols = list(fields)
+        sql = self._adapt(
+            f"UPDATE cron_jobs SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?"
+        )
+        values = (*(fields[c] for c in cols), job_id)
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, values)
+            else:
+                conn.execute(sql, values)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_cron_job(self, job_id: str) -> Optional[dict]:
+        sql = self._sql["cron_job_get"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (job_id,))
+                    row = cur.fetchone()
+            else:
+                row = conn.execute(sql, (job_id,)).fetchone()
+        finally:
+            conn.close()
+        job = self._row_to_dict(row)
+        if job:
+            for k in ("params", "result"):
+                if job.get(k):
+                    try:
+                        job[k] = json.loads(job[k])
+                    except (TypeError, json.JSONDecodeError):
+                        pass
+        return job
+
     # ━━━ 週積分 ━━━
 
     def save_weekly_score(self, user_id: str, week_start: str, week_end: str,
                           overall: str, protein: str, calorie: str,
-                          regularity: str):
+                          regularity: str, **stats):
+        """寫入（或覆寫同週的）積分卡；stats 為 active_days、avg_calories 等數字欄位。"""
+        self.save_weekly_scores([{
+            "user_id": user_id,
+            "week_start": week_start,
+            "week_end": week_end,
+            "overall_grade": overall,
+            "protein_grade": protein,
+            "calorie_grade": calorie,
+            "regularity_grade": regularity,
+            **stats,
+        }])
+
+    def save_weekly_scores(self, cards: list[dict]) -> int:
+        """批次 upsert 積分卡（同一交易）；以 (user_id, week_start) 為鍵。"""
+        if not cards:
+            return 0
+        now = datetime.now(timezone.utc).isoformat()
+        unknown = {k for c in cards for k in c} - set(_WEEKLY_SCORE_COLUMNS)
+        if unknown:
+            raise ValueError(f"weekly_scores 沒有欄位：{sorted(unknown)}")
+        rows = [
+            tuple(c.get(col) for col in _WEEKLY_SCORE_COLUMNS) + (now, now)
+            for c in cards
+        ]
+        sql = self._sql["weekly_score_upsert"]
         conn = self._connect()
         try:
-            del_sql = self._adapt(
-                "DELETE FROM weekly_scores WHERE user_id = ? AND week_start = ?"
-            )
-            ins_sql = self._adapt(
-                """INSERT INTO weekly_scores
-                   (user_id, week_start, week_end, overall_grade,
-                    protein_grade, calorie_grade, regularity_grade, created_at)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
-            )
-            ins_params = (
-                user_id, week_start, week_end, overall,
-                protein, calorie, regularity, datetime.now().isoformat(),
-            )
             if self._pg:
                 with conn.cursor() as cur:
-                    cur.execute(del_sql, (user_id, week_start))
-                    cur.execute(ins_sql, ins_params)
+                    cur.executemany(sql, rows)
             else:
-                conn.execute(del_sql, (user_id, week_start))
-                conn.execute(ins_sql, ins_params)
+                conn.executemany(sql, rows)
             conn.commit()
         finally:
             conn.close()
+        return len(rows)
+
+    def get_weekly_score(self, user_id: str, week_start: str) -> dict | None:
+        sql = self._sql["weekly_score_get"]
+        conn = self._connect()
+        try:
+            if self._pg:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (user_id, week_start))
+                    row = cur.fetchone()
+            else:
+                row = conn.execute(sql, (user_id, week_start)).fetchone()
+            return self._row_to_dict(row)
+        finally:
+            conn.close()
@@ -0,0 +1,159 @@
+"""
+JITAI 提醒的規則式選項引擎：以預先展開的便利食物組合庫，挑出符合剩餘蛋白質與熱量的 2～3 組。
+
+組合庫為各品項（含份數上限）最多 3 份的所有搭配，依蛋白質／熱量分帶快取挑選結果；
+同一分帶的使用者共用同一份答案，一萬人產生文案只需毫秒級 CPU。
+"""
+
+from __future__ import annotations
+
+import itertools
+from functools import lru_cache
+from typing import NamedTuple
+
+
+class NudgeFood(NamedTuple):
+    name: str
+    unit: str  # 每份的量詞（「1 份」「1 顆」）
+    protein: float  # g／份
+    calories: float  # kcal／份
+    max_qty: int = 1
+
+
+class NudgeCombo(NamedTuple):
+    items: tuple[tuple[NudgeFood, int], ...]
+    protein: float
+    calories: float
+
+    @property
+    def portions(self) -> int:
+        return sum(q for _, q in self.items)
+
+    @property
+    def lead(self) -> str:
+        """蛋白質貢獻最多的品項，用來讓選項彼此不同。"""
+        return max(self.items, key=lambda it: it[0].protein * it[1])[0].name
+
+    def label(self) -> str:
+        parts = []
+        for food, qty in self.items:
+            n, unit = food.unit.split(" ", 1)
+            parts.append(f"{food.name} {int(n) * qty} {unit}")
+        return " ＋ ".join(parts)
+
+
+# 超商／外食容易取得的高蛋白品項（數值為常見包裝的約略值）
+FOODS: tuple[NudgeFood, ...] = (
+    NudgeFood("乳清蛋白飲", "1 份", 25, 130),
+    NudgeFood("即食雞胸", "1 包", 23, 120, max_qty=2),
+    NudgeFood("蛋白棒", "1 條", 20, 200),
+    NudgeFood("無糖豆漿", "450 ml", 15, 150),
+    NudgeFood("希臘優格", "150 g", 15, 130),
+    NudgeFood("毛豆", "100 g", 11, 130),
+    NudgeFood("低脂鮮奶", "290 ml", 10, 130),
+    NudgeFood("豆干", "2 片", 8, 90),
+    NudgeFood("茶葉蛋", "1 顆", 7, 75, max_qty=2),
+    NudgeFood("水煮蛋", "1 顆", 6, 75, max_qty=2),
+)
+
+MAX_PORTIONS = 3
+PROTEIN_BAND_G = 5.0
+CALORIE_BAND_KCAL = 100.0
+# 超出分帶範圍者併入端點（蛋白缺口再大，一次也只建議 3 份內）
+_MAX_PROTEIN_BAND = 24  # 120 g
+_MIN_CALORIE_BAND, _MAX_CALORIE_BAND = -1, 15
+
+
+@lru_cache(maxsize=1)
+def combo_library() -> tuple[NudgeCombo, ...]:
+    """所有 1～MAX_PORTIONS 份的品項搭配（有界背包的完整解空間，約數百組）。"""
+    combos = []
+    ranges = [range(f.max_qty + 1) for f in FOODS]
+    for qtys in itertools.product(*ranges):
+        n = sum(qtys)
+        if not 0 < n <= MAX_PORTIONS:
+            continue
+        items = tuple((f, q) for f, q in zip(FOODS, qtys) if q)
+        combos.append(
+            NudgeCombo(
+                items,
+                sum(f.protein * q for f, q in items),
+                sum(f.calories * q for f, q in items),
+            )
+        )
+    return tuple(combos)
+
+
+def _score(combo: NudgeCombo, need: float, budget: float) -> float:
+    """越小越好：補不足的蛋白最重，其次超出熱量空間，再來是多吃的蛋白與份數。"""
+    shortfall = max(0.0, need - combo.protein)
+    overshoot = max(0.0, combo.protein - need)
+    cal_over = max(0.0, combo.calories - max(budget, 0.0))
+    return (
+        shortfall * 1.0
+        + cal_over * 0.12
+        + overshoot * 0.3
+        + combo.calories * 0.01
+        + combo.portions * 1.5
+    )
+
+
+def _bands(remaining_pro: float, remaining_cal: float | None) -> tuple[int, int]:
+    pro_band = min(_MAX_PROTEIN_BAND, max(1, round(remaining_pro / PROTEIN_BAND_G)))
+    if remaining_cal is None:
+        cal_band = _MAX_CALORIE_BAND
+    else:
+        cal_band = int(remaining_cal // CALORIE_BAND_KCAL)
+        cal_band = min(_MAX_CALORIE_BAND, max(_MIN_CALORIE_BAND, cal_band))
+    return pro_band, cal_band
+
+
+@lru_cache(maxsize=4096)
+def _options_for_band(pro_band: int, cal_band: int, k: int) -> tuple[NudgeCombo, ...]:
+    need = pro_band * PROTEIN_BAND_G
+    budget = (cal_band + 0.5) * CALORIE_BAND_KCAL
+    ranked = sorted(combo_library(), key=lambda c: _score(c, need, budget))
+    picked: list[NudgeCombo] = []
+    leads: set[str] = set()
+    for combo in ranked:
+        if combo.lead in leads:
+            continue
+        picked.append(combo)
+        leads.add(combo.lead)
+        if len(picked) == k:
+            break
+    return tuple(picked)
+
+
+def select_options(
+    remaining_pro: float, remaining_cal: float | None = None, k: int = 3,
+) -> tuple[NudgeCombo, ...]:
+    """依剩餘蛋白質與熱量空間挑 k 組主要品項不同的搭配（同分帶結果快取）。"""
+    return _options_for_band(*_bands(remaining_pro, remaining_cal), k)
+
+
+def render_options(
+    remaining_pro: float,
+    remaining_cal: float | None = None,
+    *,
+    urgent: bool = False,
+) -> str:
+    """選項文案；只依分帶與旗標決定，整段文字一併快取。"""
+    low_cal = remaining_cal is not None and remaining_cal < 150
+    return _render_for_band(*_bands(remaining_pro, remaining_cal), low_cal, urgent)
+
+
+@lru_cache(maxsize=8192)
+def _render_for_band(pro_band: int, cal_band: int, low_cal: bool, urgent: bool) -> str:
+    lines = ["可立即補充的選項："]
+    for i, combo in enumerate(_options_for_band(pro_band, cal_band, 3), 1):
+        lines.append(
+            f"{i}. {combo.label()}（約 +{combo.protein:.0f}g 蛋白／{combo.calories:.0f} kcal）"
+        )
+    if low_cal:
+        lines.append("\n今日熱量空間所剩不多，已優先列出熱量最低的組合。")
+    if urgent:
+        lines.append("\n今日紀錄窗格即將關閉，請選一項最快能拿到的先補上。")
+    else:
+        lines.append("\n選一項最順手的先補，補完拍張照或傳「加蛋白飲」記錄。")
+    return "\n".join(lines)
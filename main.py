@@ -3,36 +3,50 @@
 FastAPI + LINE Messaging API + OpenAI GPT Vision
 """
 
+# 須最先匯入：啟動量測的時間起點要涵蓋下方所有套件匯入
+from startup_profile import startup_profile
+
 import os
 import re
 import json
 import base64
 import hmac
+import secrets
 import logging
+import math
 import asyncio
+import itertools
+import threading
 import unicodedata
+from collections import OrderedDict, deque
 from io import BytesIO
 from datetime import date, datetime, time, timedelta, timezone
+from time import monotonic
 from zoneinfo import ZoneInfo
 from contextlib import asynccontextmanager
-import httpx
+from typing import TYPE_CHECKING, Awaitable, Callable, NamedTuple
 from dotenv import load_dotenv
 from fastapi import BackgroundTasks, FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 
-from linebot.v3 import WebhookParser
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    AsyncApiClient,
-    AsyncMessagingApi,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage,
+# LINE SDK（約 0.7 秒）與 httpx 於函式內延遲匯入；cron 與 /health 冷啟動不必付出這段成本
+if TYPE_CHECKING:
+    from linebot.v3.webhooks import MessageEvent
+
+import jitai_engine
+import reporting
+from database import AUDIENCE_PAGE_SIZE, Database, OnboardingState
+from openai_runtime import (
+    CircuitOpenError,
+    JsonFieldStream,
+    OpenAICallRecord,
+    openai_circuit,
+    openai_latency,
+    openai_single_flight,
+    openai_telemetry,
+    payload_key,
+    retry_backoff,
 )
-from linebot.v3.webhooks import FollowEvent, MessageEvent, TextMessageContent, ImageMessageContent
-
-from database import Database
 from notion_sync import get_notion_sync
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -46,6 +60,14 @@ LINE_CHANNEL_ACCESS_TOKEN = (os.getenv("LINE_CHANNEL_ACCESS_TOKEN") or "").strip
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
 OPENAI_MODEL = (os.getenv("OPENAI_MODEL") or "gpt-4o").strip()
 JITAI_MODEL = (os.getenv("JITAI_MODEL") or "gpt-4o-mini").strip()
+# 餐點分析先送快速模型（如 gpt-4o-mini），結果無效或信心低才升級到 OPENAI_MODEL；留空則不分層
+OPENAI_FAST_MODEL = (os.getenv("OPENAI_FAST_MODEL") or "").strip()
+# 快速模型回報的 recognition_confidence 屬於這些值時升級（逗號分隔）
+OPENAI_ESCALATE_CONFIDENCE = frozenset(
+    c.strip()
+    for c in (os.getenv("OPENAI_ESCALATE_CONFIDENCE") or "低").split(",")
+    if c.strip()
+)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
@@ -110,6 +132,11 @@ ONBOARDING_BLOCKED_TEXT = (
     + FITNESS_GOAL_PROMPT
 )
 
+# AI 暫時無法使用時附在回覆後的替代做法
+QUICK_RECORD_FALLBACK_TEXT = (
+    "可先用不耗 AI 的快速記錄：「加蛋白飲」「加雞蛋」「加雞胸肉」「加碳水」。"
+)
+
 # 快速記錄（不呼叫 Vision，省 token）；可經「設定蛋白飲」自訂蛋白飲數值
 DEFAULT_QUICK_ITEMS = {
     "蛋白飲": {"calories": 130, "protein": 25, "description": "乳清蛋白飲 一份"},
@@ -201,14 +228,7 @@ def clear_state(user_id: str):
 
 
 def parse_fitness_goal(text: str) -> str | None:
-    t = _compact_command(text)
-    for alias, goal in FITNESS_GOAL_ALIASES.items():
-        if t == _compact_command(alias):
-            return goal
-    for key in FITNESS_GOALS:
-        if t == _compact_command(key):
-            return key
-    return None
+    return _FITNESS_GOAL_LOOKUP.get(_compact_command(text))
 
 
 def parse_calorie_adjust(text: str) -> tuple[str, int | None] | None:
@@ -298,6 +318,12 @@ def _compact_command(text: str) -> str:
     return re.sub(r"\s+", "", t.strip())
 
 
+# 別名優先於正式名稱（與逐一比對時的先後相同）
+_FITNESS_GOAL_LOOKUP = {
+    **{_compact_command(key): key for key in FITNESS_GOALS},
+    **{_compact_command(alias): goal for alias, goal in FITNESS_GOAL_ALIASES.items()},
+}
+
 JITAI_ON_COMMANDS = {
     _compact_command(x)
     for x in (
@@ -690,6 +716,17 @@ class UserFacingError(Exception):
     """可直接顯示給使用者的流程錯誤。"""
 
 
+class OpenAIUnavailableError(UserFacingError):
+    """OpenAI 熔斷中，請求未送出；retry_after 為預計恢復試探的秒數。"""
+
+    def __init__(self, retry_after: float):
+        minutes = max(1, math.ceil(retry_after / 60))
+        super().__init__(
+            f"AI 服務暫時無法連線（上游連續失敗），約 {minutes} 分鐘內會自動恢復，請稍後再試。"
+        )
+        self.retry_after = retry_after
+
+
 def _openai_error_user_message(status: int, body: str) -> str | None:
     try:
         data = json.loads(body or "{}")
@@ -714,6 +751,102 @@ def _openai_error_user_message(status: int, body: str) -> str | None:
     return None
 
 
+# 遙測明細寫入 openai_calls 的批次間隔與保留天數
+OPENAI_TELEMETRY_FLUSH_SEC = max(0.0, float(os.getenv("OPENAI_TELEMETRY_FLUSH_SEC", "5")))
+OPENAI_TELEMETRY_RETENTION_DAYS = max(1, int(os.getenv("OPENAI_TELEMETRY_RETENTION_DAYS", "30")))
+_OPENAI_TELEMETRY_PRUNE_EVERY_SEC = 86400.0
+_openai_telemetry_flush_task: asyncio.Task | None = None
+# 串流模式：餐點分析的 calories／protein／description 一串流到即開始入帳，不等完整 breakdown
+OPENAI_STREAM = (os.getenv("OPENAI_STREAM") or "0").strip().lower() in ("1", "true", "yes", "on")
+# 單次逾時 = 該模型近期 p95 × 倍數（不超過 OPENAI_TIMEOUT_SEC、不低於下限）；0 則固定用 OPENAI_TIMEOUT_SEC
+OPENAI_ADAPTIVE_TIMEOUT_MULT = max(0.0, float(os.getenv("OPENAI_ADAPTIVE_TIMEOUT_MULT", "2.5")))
+OPENAI_TIMEOUT_MIN_SEC = max(1.0, float(os.getenv("OPENAI_TIMEOUT_MIN_SEC", "20")))
+# 超過此百分位延遲仍未回應時送出第二個相同請求（如 0.9；0 為關閉，會增加 token 花費）
+OPENAI_HEDGE_PERCENTILE = min(0.999, max(0.0, float(os.getenv("OPENAI_HEDGE_PERCENTILE", "0"))))
+# 整體預算保留給後續入帳與推播的秒數；剩餘不足以再跑一次時不重試
+_OPENAI_DEADLINE_MARGIN_SEC = 3.0
+_OPENAI_MIN_ATTEMPT_SEC = 5.0
+_openai_telemetry_last_prune = 0.0
+
+
+def _record_openai_call(
+    *,
+    prompt_id: str,
+    model: str,
+    user_id: str | None,
+    image_detail: str,
+    usage: dict | None,
+    latency_ms: float,
+    retries: int,
+    outcome: str,
+) -> None:
+    """記錄一次上游呼叫（含重試）；明細稍後批次寫入 DB，不佔用回覆路徑。"""
+    usage = usage or {}
+    now_utc = datetime.now(timezone.utc)
+    rec = OpenAICallRecord(
+        created_at=now_utc.isoformat(),
+        local_date=now_utc.astimezone(_bot_timezone()).date().isoformat(),
+        user_id=user_id or "",
+        prompt_id=prompt_id or "unknown",
+        model=model,
+        image_detail=image_detail,
+        prompt_tokens=int(usage.get("prompt_tokens") or 0),
+        completion_tokens=int(usage.get("completion_tokens") or 0),
+        # prompt caching 命中的前綴 token（固定前綴 ≥1024 token 才會快取）
+        cached_tokens=int((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0),
+        latency_ms=round(latency_ms, 1),
+        retries=retries,
+        outcome=outcome,
+    )
+    openai_telemetry.observe(rec)
+    logger.info(
+        "OpenAI 呼叫 prompt=%s model=%s user=%s tokens=%s/%s cached=%s %.0f ms retries=%s outcome=%s",
+        rec.prompt_id, rec.model, rec.user_id[:8], rec.prompt_tokens,
+        rec.completion_tokens, rec.cached_tokens, rec.latency_ms, rec.retries, rec.outcome,
+    )
+    _schedule_openai_telemetry_flush()
+
+
+def _schedule_openai_telemetry_flush() -> None:
+    global _openai_telemetry_flush_task
+    if _openai_telemetry_flush_task is not None and not _openai_telemetry_flush_task.done():
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _openai_telemetry_flush_task = spawn_background_job(
+        flush_openai_telemetry(delay_sec=OPENAI_TELEMETRY_FLUSH_SEC)
+    )
+
+
+async def flush_openai_telemetry(delay_sec: float = 0.0) -> int:
+    """將暫存的呼叫明細寫入 openai_calls；寫入失敗只記 log（遙測不影響主流程）。"""
+    global _openai_telemetry_last_prune
+    if delay_sec:
+        await asyncio.sleep(delay_sec)
+    written = 0
+    while True:
+        batch = openai_telemetry.drain()
+        if not batch:
+            break
+        try:
+            await ensure_db_ready()
+            written += await asyncio.to_thread(db.record_openai_calls, batch)
+        except Exception as e:
+            logger.warning("OpenAI 遙測寫入失敗（捨棄 %s 筆）: %s", len(batch), e)
+            break
+    mono = asyncio.get_running_loop().time()
+    if written and mono - _openai_telemetry_last_prune >= _OPENAI_TELEMETRY_PRUNE_EVERY_SEC:
+        _openai_telemetry_last_prune = mono
+        cutoff = datetime.now(timezone.utc) - timedelta(days=OPENAI_TELEMETRY_RETENTION_DAYS)
+        try:
+            await asyncio.to_thread(db.prune_openai_calls, cutoff.isoformat())
+        except Exception as e:
+            logger.warning("OpenAI 遙測清理失敗: %s", e)
+    return written
+
+
 async def call_openai_vision(
     system_prompt: str,
     user_prompt: str,
@@ -721,14 +854,26 @@ async def call_openai_vision(
     image_base64: str | None = None,
     image_detail: str = "auto",
     response_json_object: bool = True,
+    *,
+    user_suffix: str = "",
+    prompt_id: str = "",
+    user_id: str | None = None,
+    stream_fields: tuple[str, ...] = (),
+    on_fields: Callable[[dict], None] | None = None,
+    model: str | None = None,
+    deadline: float | None = None,
 ) -> dict | str:
-    """呼叫 OpenAI Vision API，回傳解析後的 JSON 或原始文字。"""
+    """呼叫 OpenAI Vision API，回傳解析後的 JSON 或原始文字。
+
+    user_prompt 應為固定文字、user_suffix 放備註等每次不同的內容：
+    順序為 system → 固定指示 → 圖片 → user_suffix，讓 OpenAI prompt caching 能命中最長前綴。
+    """
     if not OPENAI_API_KEY:
         logger.error("OPENAI_API_KEY 未設定")
         return OpenAIUserNotice("AI 服務未設定，請聯絡管理員檢查環境變數。")
 
-    # 組裝 user content
-    user_content = []
+    # 組裝 user content（固定前綴在前、變動內容在後）
+    user_content = [{"type": "text", "text": user_prompt}]
     if image_url:
         user_content.append({
             "type": "image_url",
@@ -739,10 +884,11 @@ async def call_openai_vision(
             "type": "image_url",
             "image_url": {"url": f"data:image/jpeg;base64,{image_base64}", "detail": image_detail},
         })
-    user_content.append({"type": "text", "text": user_prompt})
+    if user_suffix:
+        user_content.append({"type": "text", "text": user_suffix})
 
     payload = {
-        "model": OPENAI_MODEL,
+        "model": model or OPENAI_MODEL,
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_content},
@@ -753,78 +899,30 @@ async def call_openai_vision(
     if response_json_object:
         payload["response_format"] = {"type": "json_object"}
 
-    timeout_sec = float(os.getenv("OPENAI_TIMEOUT_SEC", "60"))
-    max_retries = max(1, int(os.getenv("OPENAI_MAX_RETRIES", "2")))
-    timeout = httpx.Timeout(timeout_sec, connect=20.0)
-
-    resp: httpx.Response | None = None
-    for i in range(max_retries):
-        try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                resp = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "Content-Type": "application/json",
-                    },
-                    json=payload,
-                )
-            if not resp.is_success:
-                logger.error(
-                    "OpenAI Vision HTTP %s: %s",
-                    resp.status_code,
-                    (resp.text or "")[:800],
-                )
-                um = _openai_error_user_message(resp.status_code, resp.text or "")
-                if um:
-                    return OpenAIUserNotice(um)
-                if resp.status_code in (408, 409, 425, 429) or resp.status_code >= 500:
-                    if i < max_retries - 1:
-                        await asyncio.sleep(0.8 * (i + 1))
-                        continue
-                    raise UserFacingError("AI 服務目前忙碌或不穩定，請稍後再試一次。")
-            resp.raise_for_status()
-            break
-        except httpx.TimeoutException:
-            logger.warning("OpenAI Vision 呼叫逾時（第 %s/%s 次）", i + 1, max_retries)
-            if i < max_retries - 1:
-                await asyncio.sleep(0.8 * (i + 1))
-                continue
-            raise UserFacingError("圖片分析等待過久，請重新傳一次照片後再試。")
-        except httpx.RequestError as e:
-            logger.warning("OpenAI Vision 網路錯誤（第 %s/%s 次）: %s", i + 1, max_retries, e)
-            if i < max_retries - 1:
-                await asyncio.sleep(0.8 * (i + 1))
-                continue
-            raise UserFacingError("目前與 AI 服務連線不穩，請稍後再試。")
-
-    if resp is None:
-        raise UserFacingError("AI 服務暫時無回應，請稍後再試。")
-
-    raw = _openai_extract_message_text(resp.json())
-    if not raw:
-        return ""
-
-    parsed = _try_parse_json_response(raw)
-    if parsed is not None:
-        return parsed
-    return raw
-
-
-PROMPT_JITAI_NUDGE = """你是減脂／增肌飲食教練，撰寫「此刻可執行」的 JITAI 智能提醒訊息。
+    return await _openai_chat_completion_once(
+        payload,
+        label="OpenAI Vision",
+        prompt_id=prompt_id,
+        user_id=user_id,
+        image_detail=image_detail,
+        stream_fields=stream_fields,
+        on_fields=on_fields,
+        deadline=deadline,
+        timeout_sec=float(os.getenv("OPENAI_TIMEOUT_SEC", "60")),
+        max_retries=max(1, int(os.getenv("OPENAI_MAX_RETRIES", "2"))),
+        timeout_message="圖片分析等待過久，請重新傳一次照片後再試。",
+    )
 
-原則：
-- 不要只播報數字；必須給 2～3 個可馬上採行的食物組合（每項一行，含約略蛋白質與熱量）
-- 優先便利、超商／外食可取得、高蛋白密度（例：希臘優格＋花生醬、酪梨＋水煮蛋、乳清＋香蕉、雞胸即食包＋地瓜）
-- 結合動機與下一步：簡短點出處境 → 具體選項 → 一句可執行動作
-- 口吻專業、冷靜、一針見血；不使用 emoji；繁體中文
-- 總長不超過 380 字；勿輸出 JSON 或標題符號"""
 
+async def call_openai_jitai_nudge(user_prompt: str, *, user_id: str | None = None) -> str:
+    """以較輕量模型產生可執行的提醒文案（純文字）。
 
-async def call_openai_jitai_nudge(user_prompt: str) -> str:
-    """以較輕量模型產生可執行的提醒文案（純文字）。"""
+    失敗或熔斷中回傳空字串，呼叫端改用規則式文案。
+    """
     if not OPENAI_API_KEY:
         return ""
+    from prompts import PROMPT_JITAI_NUDGE
+
     payload = {
         "model": JITAI_MODEL,
         "messages": [
@@ -834,8 +932,19 @@ async def call_openai_jitai_nudge(user_prompt: str) -> str:
         "max_tokens": 600,
         "temperature": 0.55,
     }
+    import httpx
+
     timeout = httpx.Timeout(45.0, connect=15.0)
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    usage: dict | None = None
+    outcome = "error"
     try:
+        try:
+            openai_circuit.before_call()
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            return ""
         async with httpx.AsyncClient(timeout=timeout) as client:
             resp = await client.post(
                 "https://api.openai.com/v1/chat/completions",
@@ -845,88 +954,367 @@ async def call_openai_jitai_nudge(user_prompt: str) -> str:
                 },
                 json=payload,
             )
+        if resp.status_code == 429 or resp.status_code >= 500:
+            retry_after = _safe_float(resp.headers.get("retry-after"), -1.0)
+            openai_circuit.record_failure(retry_after if retry_after > 0 else None)
+        else:
+            openai_circuit.record_success()
         if not resp.is_success:
             logger.warning("JITAI OpenAI HTTP %s", resp.status_code)
+            outcome = "http_error"
             return ""
         resp.raise_for_status()
-        return _openai_extract_message_text(resp.json())
+        data = resp.json()
+        usage = data.get("usage")
+        text = _openai_extract_message_text(data)
+        outcome = "text" if text else "empty"
+        return text
     except Exception as e:
+        if isinstance(e, httpx.TimeoutException):
+            outcome = "timeout"
+            openai_circuit.record_failure()
+        elif isinstance(e, httpx.RequestError):
+            outcome = "network_error"
+            openai_circuit.record_failure()
         logger.warning("JITAI OpenAI 呼叫失敗: %s", e)
         return ""
+    finally:
+        _record_openai_call(
+            prompt_id="jitai_nudge",
+            model=JITAI_MODEL,
+            user_id=user_id,
+            image_detail="",
+            usage=usage,
+            latency_ms=(loop.time() - t0) * 1000,
+            retries=0,
+            outcome=outcome,
+        )
 
 
-async def call_openai_text(system_prompt: str, user_prompt: str) -> dict | str:
-    """呼叫 OpenAI 文字 API (無圖片)。"""
+async def call_openai_text(
+    system_prompt: str,
+    user_prompt: str,
+    *,
+    user_suffix: str = "",
+    prompt_id: str = "",
+    user_id: str | None = None,
+    stream_fields: tuple[str, ...] = (),
+    on_fields: Callable[[dict], None] | None = None,
+    model: str | None = None,
+    deadline: float | None = None,
+) -> dict | str:
+    """呼叫 OpenAI 文字 API (無圖片)；user_suffix 為接在固定 user_prompt 之後的變動內容。"""
     if not OPENAI_API_KEY:
         logger.error("OPENAI_API_KEY 未設定")
         return OpenAIUserNotice("AI 服務未設定，請聯絡管理員檢查環境變數。")
 
     payload = {
-        "model": OPENAI_MODEL,
+        "model": model or OPENAI_MODEL,
         "messages": [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
+            {"role": "user", "content": user_prompt + user_suffix},
         ],
         "max_tokens": 2000,
         "temperature": 0.4,
         "response_format": {"type": "json_object"},
     }
 
-    timeout_sec = float(os.getenv("OPENAI_TIMEOUT_SEC", "90"))
-    max_retries = max(1, int(os.getenv("OPENAI_MAX_RETRIES", "3")))
-    timeout = httpx.Timeout(timeout_sec, connect=20.0)
+    return await _openai_chat_completion_once(
+        payload,
+        label="OpenAI Text",
+        prompt_id=prompt_id,
+        user_id=user_id,
+        stream_fields=stream_fields,
+        on_fields=on_fields,
+        deadline=deadline,
+        timeout_sec=float(os.getenv("OPENAI_TIMEOUT_SEC", "90")),
+        max_retries=max(1, int(os.getenv("OPENAI_MAX_RETRIES", "3"))),
+        timeout_message="目前文字分析等待過久，請稍後再試。",
+    )
 
-    resp: httpx.Response | None = None
-    for i in range(max_retries):
-        try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                resp = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "Content-Type": "application/json",
-                    },
-                    json=payload,
-                )
-            if not resp.is_success:
-                logger.error(
-                    "OpenAI Text HTTP %s: %s",
-                    resp.status_code,
-                    (resp.text or "")[:800],
-                )
-                um = _openai_error_user_message(resp.status_code, resp.text or "")
-                if um:
-                    return OpenAIUserNotice(um)
-                if resp.status_code in (408, 409, 425, 429) or resp.status_code >= 500:
-                    if i < max_retries - 1:
-                        await asyncio.sleep(0.8 * (i + 1))
-                        continue
-                    raise UserFacingError("AI 服務目前忙碌或不穩定，請稍後再試一次。")
-            resp.raise_for_status()
-            break
-        except httpx.TimeoutException:
-            logger.warning("OpenAI Text 呼叫逾時（第 %s/%s 次）", i + 1, max_retries)
-            if i < max_retries - 1:
-                await asyncio.sleep(0.8 * (i + 1))
+
+async def _openai_chat_completion_once(payload: dict, **kwargs) -> dict | str:
+    """相同 payload 進行中時合併為一次上游呼叫（連點 rich menu、LINE 重送）。"""
+    return await openai_single_flight.do(
+        payload_key(payload),
+        lambda: _openai_chat_completion(payload, **kwargs),
+    )
+
+
+async def _openai_post_streaming(
+    client, payload: dict, on_partial: Callable[[dict], None],
+):
+    """以 SSE 串流送出 chat/completions，回傳 (response, 與非串流相同結構的 JSON)。
+
+    每收到一段文字就餵給 JsonFieldStream，頂層欄位有進展時呼叫 on_partial。
+    HTTP 非 2xx 時 JSON 為 None（本文已讀入，可用 resp.text）。
+    """
+    body = {**payload, "stream": True, "stream_options": {"include_usage": True}}
+    js = JsonFieldStream()
+    usage = None
+    error = None
+    refusal: list[str] = []
+    async with client.stream(
+        "POST",
+        "https://api.openai.com/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        json=body,
+    ) as resp:
+        if not resp.is_success:
+            await resp.aread()
+            return resp, None
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
                 continue
-            raise UserFacingError("目前文字分析等待過久，請稍後再試。")
-        except httpx.RequestError as e:
-            logger.warning("OpenAI Text 網路錯誤（第 %s/%s 次）: %s", i + 1, max_retries, e)
-            if i < max_retries - 1:
-                await asyncio.sleep(0.8 * (i + 1))
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
                 continue
-            raise UserFacingError("目前與 AI 服務連線不穩，請稍後再試。")
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            if chunk.get("error"):
+                error = chunk["error"]
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                if delta.get("refusal"):
+                    refusal.append(str(delta["refusal"]))
+                if js.feed(delta.get("content") or ""):
+                    on_partial(js.fields)
+    if error is not None and not js.text():
+        return resp, {"error": error, "usage": usage}
+    message: dict = {"content": js.text()}
+    if refusal and not message["content"]:
+        message = {"content": None, "refusal": "".join(refusal)}
+    return resp, {"choices": [{"message": message}], "usage": usage}
+
+
+async def _openai_attempt_hedged(
+    attempt: Callable[[], Awaitable[tuple]], hedge_after: float | None, model: str,
+) -> tuple:
+    """執行一次請求；超過 hedge_after 秒仍未回應時再送一個相同請求，先成功者勝出。"""
+    first = asyncio.ensure_future(attempt())
+    tasks = [first]
+    try:
+        if hedge_after is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(attempt())
+        tasks.append(second)
+        logger.info("OpenAI %s 超過 %.1fs 未回應，送出對沖請求", model, hedge_after)
+        pending = set(tasks)
+        fallback: asyncio.Task | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None and t.result()[0].is_success:
+                    openai_telemetry.observe_hedge(model, "primary" if t is first else "hedge")
+                    return t.result()
+                fallback = fallback or t
+        return fallback.result()
+    finally:
+        # 勝出者以外（或外層逾時取消時）的請求一併取消
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+
+async def _openai_chat_completion(
+    payload: dict,
+    *,
+    label: str,
+    timeout_sec: float,
+    max_retries: int,
+    timeout_message: str,
+    prompt_id: str = "",
+    user_id: str | None = None,
+    image_detail: str = "",
+    stream_fields: tuple[str, ...] = (),
+    on_fields: Callable[[dict], None] | None = None,
+    deadline: float | None = None,
+) -> dict | str:
+    """送出 chat/completions（含重試），回傳解析後的 JSON、原始文字或 OpenAIUserNotice。
+
+    單次逾時依該模型近期 p95 調整（OPENAI_ADAPTIVE_TIMEOUT_MULT），且不超過 deadline
+    （loop.time() 絕對時間，由上層整體預算傳入）剩餘的時間；剩餘不足時不再重試。
+    OPENAI_HEDGE_PERCENTILE 開啟時，超過該百分位延遲仍未回應就送出對沖請求。
+    每次嘗試前先過熔斷器：熔斷中直接 raise OpenAIUnavailableError，不等逾時；
+    逾時、網路錯誤、429 與 5xx 計為失敗，上游有回應即計為成功。
+    OPENAI_STREAM 開啟且給了 on_fields 時改走串流：stream_fields 全數到齊即呼叫一次
+    on_fields（重試也不會再呼叫），其餘欄位仍照常等完整回應。
+    結束時（含例外）記錄一筆遙測：outcome 為 ok／text／empty／notice／busy／
+    timeout／deadline／circuit_open／network_error／error。
+    """
+    import httpx
+
+    model = str(payload.get("model") or "")
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    attempts = 0
+    usage: dict | None = None
+    outcome = "error"
+    stream = OPENAI_STREAM and on_fields is not None and bool(stream_fields)
+    early_sent = False
+
+    def _on_partial(fields: dict) -> None:
+        nonlocal early_sent
+        if early_sent or not all(k in fields for k in stream_fields):
+            return
+        early_sent = True
+        logger.info(
+            "%s 串流提前取得 %s（%.0f ms）",
+            label, "/".join(stream_fields), (loop.time() - t0) * 1000,
+        )
+        try:
+            on_fields({k: fields[k] for k in stream_fields})
+        except Exception as e:
+            logger.warning("%s 串流欄位回呼失敗: %s", label, e)
 
-    if resp is None:
-        raise UserFacingError("AI 服務暫時無回應，請稍後再試。")
+    def _remaining() -> float | None:
+        if deadline is None:
+            return None
+        return deadline - loop.time() - _OPENAI_DEADLINE_MARGIN_SEC
 
-    raw = _openai_extract_message_text(resp.json())
-    if not raw:
-        return ""
-    parsed = _try_parse_json_response(raw)
-    if parsed is not None:
-        return parsed
-    return raw
+    async def _attempt(attempt_timeout: float) -> tuple:
+        timeout = httpx.Timeout(attempt_timeout, connect=min(20.0, attempt_timeout))
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            if stream:
+                return await _openai_post_streaming(client, payload, _on_partial)
+            resp = await client.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {OPENAI_API_KEY}",
+                    "Content-Type": "application/json",
+                },
+                json=payload,
+            )
+            return resp, None
+
+    async def _backoff(i: int, retry_after: float | None = None) -> bool:
+        """等待後重試；剩餘預算不夠再跑一次時回傳 False。"""
+        delay = retry_after if retry_after is not None else retry_backoff(i)
+        remaining = _remaining()
+        if remaining is not None and remaining - delay < _OPENAI_MIN_ATTEMPT_SEC:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    try:
+        resp: httpx.Response | None = None
+        data: dict | None = None
+        for i in range(max_retries):
+            attempt_timeout = openai_latency.timeout_for(
+                model, timeout_sec,
+                multiplier=OPENAI_ADAPTIVE_TIMEOUT_MULT, floor=OPENAI_TIMEOUT_MIN_SEC,
+            )
+            remaining = _remaining()
+            if remaining is not None:
+                if remaining < _OPENAI_MIN_ATTEMPT_SEC:
+                    logger.warning("%s 整體時間預算已用完（第 %s 次前）", label, i + 1)
+                    outcome = "deadline"
+                    raise UserFacingError(timeout_message)
+                attempt_timeout = min(attempt_timeout, remaining)
+            try:
+                openai_circuit.before_call()
+            except CircuitOpenError as e:
+                logger.warning("%s 熔斷中，%.0f 秒後才會再試探上游", label, e.retry_after)
+                outcome = "circuit_open"
+                raise OpenAIUnavailableError(e.retry_after) from e
+            hedge_after = None
+            if OPENAI_HEDGE_PERCENTILE > 0:
+                hedge_after = openai_latency.percentile(model, OPENAI_HEDGE_PERCENTILE)
+                if hedge_after is not None and hedge_after >= attempt_timeout:
+                    hedge_after = None
+            attempts = i + 1
+            started = loop.time()
+            try:
+                resp, data = await asyncio.wait_for(
+                    _openai_attempt_hedged(
+                        lambda: _attempt(attempt_timeout), hedge_after, model,
+                    ),
+                    timeout=attempt_timeout,
+                )
+                if not resp.is_success:
+                    logger.error(
+                        "%s HTTP %s: %s",
+                        label,
+                        resp.status_code,
+                        (resp.text or "")[:800],
+                    )
+                    retry_after = _safe_float(resp.headers.get("retry-after"), -1.0)
+                    if resp.status_code == 429 or resp.status_code >= 500:
+                        openai_circuit.record_failure(retry_after if retry_after > 0 else None)
+                    else:
+                        openai_circuit.record_success()
+                    um = _openai_error_user_message(resp.status_code, resp.text or "")
+                    if um:
+                        outcome = "notice"
+                        return OpenAIUserNotice(um)
+                    if resp.status_code in (408, 409, 425, 429) or resp.status_code >= 500:
+                        if i < max_retries - 1 and await _backoff(
+                            i, retry_after if 0 <= retry_after <= 30 else None,
+                        ):
+                            continue
+                        outcome = "busy"
+                        raise UserFacingError("AI 服務目前忙碌或不穩定，請稍後再試一次。")
+                openai_circuit.record_success()
+                resp.raise_for_status()
+                openai_latency.observe(model, loop.time() - started)
+                break
+            except (httpx.TimeoutException, asyncio.TimeoutError):
+                logger.warning(
+                    "%s 呼叫逾時（第 %s/%s 次，上限 %.1fs）",
+                    label, i + 1, max_retries, attempt_timeout,
+                )
+                # 逾時也算一筆（以上限值計），上游變慢時 p95 才會跟著放寬
+                openai_latency.observe(model, attempt_timeout)
+                openai_circuit.record_failure()
+                if i < max_retries - 1 and await _backoff(i):
+                    continue
+                outcome = "timeout"
+                raise UserFacingError(timeout_message)
+            except httpx.RequestError as e:
+                logger.warning("%s 網路錯誤（第 %s/%s 次）: %s", label, i + 1, max_retries, e)
+                openai_circuit.record_failure()
+                if i < max_retries - 1 and await _backoff(i):
+                    continue
+                outcome = "network_error"
+                raise UserFacingError("目前與 AI 服務連線不穩，請稍後再試。")
+
+        if resp is None:
+            raise UserFacingError("AI 服務暫時無回應，請稍後再試。")
+
+        if data is None:
+            data = resp.json()
+        usage = data.get("usage")
+        raw = _openai_extract_message_text(data)
+        if not raw:
+            outcome = "empty"
+            return ""
+        parsed = _try_parse_json_response(raw)
+        if parsed is not None:
+            outcome = "ok"
+            return parsed
+        outcome = "text"
+        return raw
+    finally:
+        _record_openai_call(
+            prompt_id=prompt_id,
+            model=model,
+            user_id=user_id,
+            image_detail=image_detail,
+            usage=usage,
+            latency_ms=(loop.time() - t0) * 1000,
+            retries=max(0, attempts - 1),
+            outcome=outcome,
+        )
 
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -935,6 +1323,8 @@ async def call_openai_text(system_prompt: str, user_prompt: str) -> dict | str:
 
 async def download_line_image_bytes(message_id: str) -> bytes:
     """從 LINE Message Content API 下載圖片原始位元組。"""
+    import httpx
+
     url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
     timeout = httpx.Timeout(float(os.getenv("LINE_IMAGE_TIMEOUT_SEC", "20")), connect=10.0)
     max_retries = max(1, int(os.getenv("LINE_IMAGE_MAX_RETRIES", "3")))
@@ -1007,224 +1397,6 @@ async def get_line_image_base64(message_id: str) -> str:
         raise UserFacingError("圖片處理耗時過長，請重新傳送照片。") from e
 
 
-# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-# 提示詞定義
-# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-PROMPT_MEAL_ANALYSIS_CORE = """# 角色定位
-你是擁有營養學博士學位與執照的極度資深臨床營養師。作風嚴謹、專業、實事求是，專為減脂客戶提供不容一絲誤差的飲食精準分析。
-溝通風格：口吻專業、冷靜、一針見血，不使用任何 emoji，一律使用繁體中文。
-
-# 核心原則
-1. 熱量（Calories）— 減脂保守上緣：推導出區間（Minimum ~ Maximum）後，輸出【必須取 Maximum 上緣】（或 ≥ 上緣 95%）。嚴禁中位數、平均、折衷。
-2. 蛋白質（Protein）— 精準中立：逐項依食材與熟重（或包裝標示）專業估算後加總；取合理最佳估計值即可，【不要】刻意高估或採區間上緣。依計算結果如實輸出即可，無需刻意湊成 5 或 10 的倍數，精度至少 1 g（必要時 0.1 g）。
-3. 份量與隱形熱量（僅影響熱量）：份量模糊一律從大；外食 +25%；醬汁、勾芡、用油、隱藏糖從嚴計入。炒菜類熱量再加約 20% 用油係數。
-
-# 分析步驟（內部必須依序完成，不可跳步）
-
-## 步驟一｜視覺描述（先描述、再推論）
-逐一列出畫面中每個容器／包裝／盤裝食物，各寫：
-- 外觀顏色、形狀、質地（勿用籠統詞如「滷味」「炒菜」代替描述）
-- 是否可見包裝文字或品牌
-- 烹調狀態：生／熟／冷藏未烹調／已烹調
-禁止在未描述前就斷定食物名稱。深色炒物可能是豆干菇類，不一定是香腸滷味；袋裝葉菜可能是生鮮而非燙青菜。
-
-## 步驟二｜包裝文字辨識（有包裝則優先）
-若畫面有食品包裝，優先讀取並採用：
-- 品名、淨重（g）、每份或每 100g 營養標示（熱量、蛋白質）
-包裝可讀數據優先於純視覺猜測；蛋白質依標示與實際食用量精準計算；熱量在包裝或估算基礎上依減脂原則從嚴上修。
-
-## 步驟三｜分類、份量與生熟（What + How Much）
-- 依步驟一、二推論品項與熟重（g）或份數；標註每項信心（高／中／低）。
-- 生鮮冷藏、仍在原包裝、色澤偏生（如粉白雞胸）→ 標記「未烹調／待烹調」；若無法確認使用者已食用，在 breakdown 註明「假設已烹調並計入」或列入 user_confirm_prompt。
-- 有照片時以餐具為比例尺估體積；僅文字時依描述，缺漏從大。
-
-## 步驟四｜烹調與隱形熱量（How Cooked）
-- Level 1（無油／清蒸）：+0g 油
-- Level 2（家常炒）：+3~5g 油
-- Level 3（外食大火炒／勾芡）：+8~12g 油，或熱量 +20% 用油係數
-- Level 4（油炸／酥皮）：食材總重 15%~20% 併入油脂熱量
-
-## 步驟五｜加總與輸出
-- 逐項估算後加總：calories 取總熱量區間 Maximum；protein 取逐項精準加總（非上緣）。
-
-# 輸出格式（僅 JSON，無其他文字）
-{
-  "calories": 數字,
-  "protein": 數字,
-  "description": "一句話餐點摘要（含生熟假設若適用）",
-  "food_breakdown": "Markdown 簡潔版：每項「名稱｜約XXg｜生/熟｜依據：包裝/視覺」",
-  "recognition_confidence": "高或中或低",
-  "uncertain_items": "不確定項目與採用的保守假設，無則空字串",
-  "user_confirm_prompt": "建議使用者確認的一句話，無則空字串",
-  "estimation_note": "熱量採區間上緣、蛋白質精準估算等關鍵假設"
-}"""
-
-PROMPT_MEAL_ANALYSIS = (
-    PROMPT_MEAL_ANALYSIS_CORE
-    + """
-
-# 本任務：照片餐點分析
-使用者提供食物照片。必須先完成步驟一（視覺描述）與步驟二（包裝文字），再分類；忽略手部與無關背景。
-
-# 秤重備註（若 user 訊息含實測克數或總重量）
-若使用者提供各品項克數或「總重量／總重」全餐一次秤重，份量【僅能】採用實測值；
-僅有總重量時，依照片品項占比分配各項熟重，加總須等於總重。視覺估計不得覆寫秤重。"""
-)
-
-PROMPT_MEAL_FROM_TEXT = (
-    PROMPT_MEAL_ANALYSIS_CORE
-    + """
-
-# 本任務：文字餐點分析
-使用者以中文描述餐點（無照片）。跳過步驟一視覺與步驟二包裝，從步驟三依文字執行；缺漏份量從大、外食 +25%。"""
-)
-
-PROMPT_PURCHASE_QUERY = """你是專業的營養師與食品分析師，有長年的飲養輔助經驗、飲養分析研究、有執照。分析圖片中的食物或商品包裝，提供購買前的完整評估。
-
-評級系統使用注音符號：
-- ㄅ：非常適合減重／增肌目標，營養優良
-- ㄆ：大致適合，偶爾可食用
-- ㄇ：中性，需要控制份量
-- ㄈ：不建議，高熱量或低營養價值
-- ㄉ：極度不建議，對目標有嚴重負面影響
-
-規則：
-- 這是使用者自行拍攝的包裝與營養標示，屬於允許的分析情境。畫面中的手部、身體局部、桌面或背景請一律忽略，只專注讀取「包裝」上的品名、成分表、營養標示（每一份量、熱量、蛋白質、脂肪、碳水化合物、糖等）
-- 只要營養標示或包裝文字有任何可讀片段，就必須據此填寫 JSON 數字欄位；略模糊時請合理估算，不要留空或填零敷衍
-- 禁止以「無法識別圖片中的人物或物品」「無法辨識」等理由拒絕；禁止道歉、禁止要求使用者改傳文字、禁止閒聊；回覆必須且只能是一段合法 JSON
-- 不要使用任何 emoji
-- 使用繁體中文
-- 評估要嚴格但公正
-- 替代建議要具體且容易取得
-
-請嚴格以下列 JSON 格式回覆，不要有其他文字：
-{
-  "name": "食物或商品名稱",
-  "calories": 數字,
-  "protein": 數字,
-  "carbs": 數字,
-  "fat": 數字,
-  "sugar": 數字,
-  "grades": {
-    "overall": "ㄅ至ㄉ",
-    "taste": "ㄅ至ㄉ",
-    "fat_level": "ㄅ至ㄉ",
-    "sugar_level": "ㄅ至ㄉ",
-    "calorie_density": "ㄅ至ㄉ",
-    "carb_quality": "ㄅ至ㄉ"
-  },
-  "timing": "適合的飲用或食用時機，例如健身前30分鐘、增肌期訓練後、減脂期避免等",
-  "verdict": "一句話總結：建議購買或不建議，以及原因",
-  "alternatives": ["更健康的替代選項1", "替代選項2", "替代選項3"]
-}"""
-
-PROMPT_INBODY_ANALYSIS = """你是 InBody 體組成報告的數據提取專家。分析圖片並精確提取數據。
-
-規則：
-- 若有手部或背景入鏡，請忽略，專注在報告紙張／螢幕上的數字與圖表
-- 盡可能辨識所有數值
-- 無法辨識、或不符合驗證規則的欄位，設為 null
-- 不要使用任何 emoji
-- 使用繁體中文
-- 只回傳 JSON，不要任何其他說明文字
-
-【重要欄位定義，務必區分】
-- weight：體重（kg），例如 136.8
-- body_fat_percentage：體脂率（%），例如 34.7
-- smm：骨骼肌重 SMM（kg）
-  - 在「肌肉脂肪分析」區塊的「骨骼肌重」列
-  - 常見約 30~70 kg，通常不應超過體重的 50%
-- lbm：除脂體重 LBM（kg）
-  - 在「研究參數」區塊的「除脂體重／除脂體體重」
-  - 常見約 60~100 kg
-- bmr（基礎代謝率）：右側「研究參數」區塊，標籤「基礎代謝率／BMR」，單位 kcal，常見 1200~3500
-- tdee（建議的熱量攝取）— 極易讀錯，請嚴格遵守：
-  - 僅填標籤為「建議的熱量攝取」或「Recommended Calorie Intake」的那一欄
-  - 該欄位在「研究參數」區塊【最下方／最後一行】，通常是該區塊【最大的 kcal 數字】
-  - 必須明顯大於 BMR（常見 ≥ BMR × 1.5，例如 BMR 2298 時 TDEE 常為 3500~5500）
-  - 勿將「1日エネルギー消費量」、活動量中間值、或其他非「建議的熱量攝取」的 kcal 誤填為 tdee
-  - 若同區塊有多個 kcal，請全部列入 research_kcal_values，tdee 填其中最大且 > BMR × 1.4 者
-- body_water：體水分（kg）
-- visceral_fat（內臟脂肪級別）— 極易讀錯，請嚴格遵守：
-  - 讀「內臟脂肪級別／Visceral Fat Level」【文字標籤同一行、標籤右側】的數字（例：20）
-  - 該數字通常印在標籤旁，與長條圖【末端數值】一致；若末端在 20 附近，必須填 20
-  - 禁止讀取：長條圖左/下方刻度軸（5、10、15…）、網格線數字、顏色區間標記
-  - 常見錯誤：把刻度軸上的「10」誤當成級別；若體脂偏高且條形接近高風險區，級別通常 ≥ 15
-- waist_hip_ratio：腰臀比（小數，例如 1.01）
-- test_date：檢測日期（YYYY-MM-DD）
-
-【版面與生理合理性】
-- 若讀出 bmr > tdee，代表欄位可能對調，請重新對照報告後再填
-- research_kcal_values 必須完整列出研究參數區所有 kcal（例：[2298, 4453]），不可遺漏最大者
-
-【驗證規則，違反時設為 null】
-1. smm 與 lbm 皆存在時，smm 必須 < lbm，且 smm < weight × 0.5
-2. weight 與 body_fat_percentage 與 lbm 皆存在時，lbm 應接近 weight × (1 - body_fat_percentage/100)，誤差超過 ±3 kg 視為可疑
-3. bmr 與 tdee 皆存在時，tdee 必須 > bmr × 1.4（建議熱量通常至少為 BMR 的 1.5 倍）
-4. bmr 約 900~3800；tdee 約 1100~7500；visceral_fat 為 1~30 的整數
-5. research_kcal_values 須列出研究參數區塊內所有可見 kcal 數字（由小到大）
-
-請嚴格以下列 JSON 格式回覆：
-{
-  "weight": 數字或null,
-  "body_fat_percentage": 數字或null,
-  "smm": 數字或null,
-  "lbm": 數字或null,
-  "muscle_mass": 數字或null,
-  "bmr": 數字或null,
-  "tdee": 數字或null,
-  "research_kcal_values": [數字,...] 或 [],
-  "body_water": 數字或null,
-  "visceral_fat": 數字或null,
-  "waist_hip_ratio": 數字或null,
-  "test_date": "YYYY-MM-DD或null"
-}"""
-
-PROMPT_AI_COACH = """你是專業的健身營養教練，名叫「減重教練」。根據提供的數據，給出精準的個人化建議。
-
-評分系統：
-- S：超過100分的表現，極其出色
-- A：優秀（85-100%）
-- B：良好（70-84%）
-- C：及格（55-69%）
-- D：需改進（40-54%）
-- E：需要大幅改進（<40%）
-
-規則：
-- 不要使用任何 emoji
-- 使用繁體中文
-- 語氣專業但友善，像一個嚴格但關心你的教練
-- 建議要具體可執行，不要空泛
-- 如果數據不足，誠實說明，不要編造
-
-請嚴格以下列 JSON 格式回覆：
-{
-  "overall_grade": "S至E",
-  "analysis": {
-    "protein_adherence": {"grade": "S至E", "comment": "簡評"},
-    "calorie_control": {"grade": "S至E", "comment": "簡評"},
-    "consistency": {"grade": "S至E", "comment": "簡評"},
-    "meal_balance": {"grade": "S至E", "comment": "簡評"}
-  },
-  "top_issues": ["最關鍵的問題1", "問題2", "問題3"],
-  "action_plan": [
-    {"task": "具體任務", "reason": "為什麼這很重要"},
-    {"task": "具體任務", "reason": "原因"}
-  ],
-  "coach_note": "教練的個人化鼓勵或提醒，2-3句話"
-}"""
-
-PROMPT_CREATIVE_SUGGESTION = """你是一位專業的健身營養教練，有長年的飲養輔助經驗、有執照。用戶剛完成一餐紀錄，請根據他今天剩餘的蛋白質缺口，給出一個簡短、具體、有幫助的補充建議。
-
-規則：
-- 不要使用任何 emoji、表情符號、特殊符號
-- 使用繁體中文
-- 建議要具體到食物名稱和份量
-- 控制在2-3行以內
-- 語氣輕鬆但專業"""
-
-
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 功能處理函數
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -1308,7 +1480,11 @@ def get_user_targets(user_id: str) -> dict:
     只要 profile 有體重，一律用 calculate_targets 依體重／體脂／BMR／TDEE 重算，
     不再沿用 DB 裡可能過舊的 daily_*_target（例如先前寫入的 300g）。
     """
-    profile = db.get_user_profile(user_id)
+    return _targets_from_profile(db.get_user_profile(user_id))
+
+
+def _targets_from_profile(profile: dict | None) -> dict:
+    """get_user_targets／get_user_targets_batch 共用：由已讀出的 profile 算目標。"""
     if not profile:
         return {"calories": DEFAULT_CALORIE_TARGET, "protein": DEFAULT_PROTEIN_TARGET}
     w = profile.get("weight")
@@ -1339,30 +1515,121 @@ def get_user_targets(user_id: str) -> dict:
     }
 
 
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 當日狀態快取（目標、欺騙日、累計與剩餘量；寫入 DB 時由 change listener 失效）
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+DAY_STATE_CACHE_MAX = max(1, int(os.getenv("DAY_STATE_CACHE_MAX", "5000")))
+# 保險用的過期秒數：其他程序（手動腳本等）寫入不會通知本程序
+DAY_STATE_TTL_SEC = float(os.getenv("DAY_STATE_TTL_SEC", "600"))
+
+
+class DayState(NamedTuple):
+    """某使用者某日的衍生狀態；targets／totals 為共用快取，呼叫端不可修改。"""
+
+    date: str
+    targets: dict
+    totals: dict
+    is_cheat_day: bool
+    calorie_target: float  # 當日有效熱量目標（欺騙日已放寬）
+    remaining_protein: float
+    remaining_calories: float
+    progress_bar: str
+
+
+def _compute_day_state(user_id: str, date_str: str, targets: dict | None = None) -> DayState:
+    targets = targets or get_user_targets(user_id)
+    totals = db.get_daily_totals(user_id, date_str)
+    is_cheat = db.is_cheat_day(user_id, date_str)
+    cal_target = float(targets["calories"])
+    if is_cheat:
+        cal_target *= CHEAT_DAY_CALORIE_MULTIPLIER
+    return DayState(
+        date=date_str,
+        targets=targets,
+        totals=totals,
+        is_cheat_day=is_cheat,
+        calorie_target=cal_target,
+        remaining_protein=targets["protein"] - totals["protein"],
+        remaining_calories=cal_target - float(totals["calories"]),
+        progress_bar=build_progress_bar(totals["protein"], targets["protein"]),
+    )
+
+
+class _DayStateCache:
+    """(user_id, date) → DayState 的 LRU；DB 寫入通知時整位使用者或單日失效。
+
+    失效會推進世代；計算期間若有失效，算出的結果不寫回，避免把舊值放回快取。
+    """
+
+    def __init__(self, max_size: int, ttl_sec: float):
+        self._max = max_size
+        self._ttl = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str], tuple[DayState, float]] = OrderedDict()
+        self._generation = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, user_id: str, date_str: str, targets: dict | None = None) -> DayState:
+        key = (user_id, date_str)
+        now = monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[0]
+            self.stats["misses"] += 1
+            generation = self._generation
+        state = _compute_day_state(user_id, date_str, targets)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (state, now + self._ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self._max:
+                    self._entries.popitem(last=False)
+        return state
+
+    def invalidate(self, user_id: str, date_str: str | None = None) -> None:
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            if date_str is not None:
+                self._entries.pop((user_id, date_str), None)
+                return
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_day_states = _DayStateCache(DAY_STATE_CACHE_MAX, DAY_STATE_TTL_SEC)
+db.add_change_listener(_day_states.invalidate)
+
+
+def get_day_state(user_id: str, date_str: str, *, targets: dict | None = None) -> DayState:
+    """當日狀態（快取）；targets 為批次排程已算好的 get_user_targets 結果，可省一次查詢。"""
+    return _day_states.get(user_id, date_str, targets)
+
+
 def get_daily_calorie_target(user_id: str, date_str: str) -> float:
     """當日有效熱量目標（欺騙日放寬至 ×1.3）。"""
-    cal = float(get_user_targets(user_id)["calories"])
-    if db.is_cheat_day(user_id, date_str):
-        cal *= CHEAT_DAY_CALORIE_MULTIPLIER
-    return cal
+    return get_day_state(user_id, date_str).calorie_target
 
 
-def _format_daily_calorie_summary_lines(
-    user_id: str, today_str: str, totals: dict,
-) -> tuple[str, str]:
-    """回傳今日累計的（總熱量行, 剩餘熱量行）。"""
-    cal_target = get_daily_calorie_target(user_id, today_str)
-    is_cheat = db.is_cheat_day(user_id, today_str)
-    remaining_cal = cal_target - float(totals["calories"])
-    if is_cheat:
-        total_line = f"總熱量：{totals['calories']:.0f}／{cal_target:.0f} kcal"
+def _format_daily_calorie_summary_lines(state: DayState) -> tuple[str, str]:
+    """回傳當日累計的（總熱量行, 剩餘熱量行）。"""
+    totals = state.totals
+    if state.is_cheat_day:
+        total_line = f"總熱量：{totals['calories']:.0f}／{state.calorie_target:.0f} kcal"
     else:
         total_line = f"總熱量：{totals['calories']:.0f} kcal"
-    if remaining_cal >= 0:
-        rem_line = f"剩餘熱量：約 {remaining_cal:.0f} kcal"
+    if state.remaining_calories >= 0:
+        rem_line = f"剩餘熱量：約 {state.remaining_calories:.0f} kcal"
     else:
-        rem_line = f"熱量狀態：已超過目標約 {-remaining_cal:.0f} kcal"
-    if is_cheat:
+        rem_line = f"熱量狀態：已超過目標約 {-state.remaining_calories:.0f} kcal"
+    if state.is_cheat_day:
         rem_line += "（欺騙日）"
     return total_line, rem_line
 
@@ -1644,14 +1911,11 @@ async def handle_quick_protein(user_id: str, item_name: str = "蛋白飲") -> st
 
     db.add_meal(user_id, cal, pro, f"[快速記錄] {desc}", today_str)
 
-    totals = db.get_daily_totals(user_id, today_str)
-    targets = get_user_targets(user_id)
-    remaining = targets["protein"] - totals["protein"]
-    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(
-        user_id, today_str, totals,
-    )
-    bar = build_progress_bar(totals["protein"], targets["protein"])
-    gap = get_gap_filler(remaining)
+    state = get_day_state(user_id, today_str)
+    totals, targets = state.totals, state.targets
+    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(state)
+    bar = state.progress_bar
+    gap = get_gap_filler(state.remaining_protein)
 
     return (
         f"已記錄：{desc}\n"
@@ -1702,6 +1966,140 @@ def handle_set_quick_item(user_id: str, text: str) -> str:
     )
 
 
+# ━━━ 餐點分析模型分層 ━━━
+
+def meal_escalation_reason(result) -> str | None:
+    """快速模型的餐點分析是否需升級到大模型；可採用時回傳 None。"""
+    if isinstance(result, OpenAIUserNotice):
+        return None
+    if not isinstance(result, dict):
+        return "invalid_json"
+    if _safe_float(result.get("calories"), -1.0) <= 0:
+        return "missing_calories"
+    if _safe_float(result.get("protein"), -1.0) < 0:
+        return "missing_protein"
+    if not _meal_text_field(result, "description"):
+        return "missing_description"
+    if _meal_text_field(result, "recognition_confidence") in OPENAI_ESCALATE_CONFIDENCE:
+        return "low_confidence"
+    return None
+
+
+async def _call_meal_model(
+    call: Callable[..., Awaitable[dict | str]],
+    *,
+    prompt_id: str,
+    stream_fields: tuple[str, ...] = (),
+    on_fields: Callable[[dict], None] | None = None,
+    **kwargs,
+) -> dict | str:
+    """OPENAI_FAST_MODEL 有設定時先送快速模型，需要時再以 OPENAI_MODEL 重跑。
+
+    快速模型不走提前入帳（信心欄位在 JSON 後段，需整份驗證後才能採用）；
+    升級後的大模型呼叫才帶 on_fields。
+    """
+    if not OPENAI_FAST_MODEL or OPENAI_FAST_MODEL == OPENAI_MODEL:
+        return await call(
+            prompt_id=prompt_id, stream_fields=stream_fields, on_fields=on_fields, **kwargs,
+        )
+    try:
+        fast = await call(prompt_id=prompt_id, model=OPENAI_FAST_MODEL, **kwargs)
+        reason = meal_escalation_reason(fast)
+    except OpenAIUnavailableError:
+        # 熔斷中大模型一樣送不出去，不必升級
+        raise
+    except UserFacingError as e:
+        logger.warning("快速模型 %s 失敗，改用 %s: %s", OPENAI_FAST_MODEL, OPENAI_MODEL, e)
+        fast, reason = None, "error"
+    if reason is None:
+        openai_telemetry.observe_route(prompt_id, "accepted")
+        return fast
+    openai_telemetry.observe_route(prompt_id, "escalated", reason)
+    logger.info("餐點分析升級 prompt=%s reason=%s → %s", prompt_id, reason, OPENAI_MODEL)
+    result = await call(
+        prompt_id=prompt_id, stream_fields=stream_fields, on_fields=on_fields, **kwargs,
+    )
+    if isinstance(fast, dict) and isinstance(result, dict):
+        openai_telemetry.observe_fast_error(prompt_id, {
+            "calories": _safe_float(fast.get("calories")) - _safe_float(result.get("calories")),
+            "protein": _safe_float(fast.get("protein")) - _safe_float(result.get("protein")),
+        })
+    return result
+
+
+_MEAL_CORE_FIELDS = ("calories", "protein", "description")
+
+
+def _meal_core_values(result: dict) -> tuple[float, float, str]:
+    cal = _safe_float(result.get("calories"), 0.0)
+    pro = _safe_float(result.get("protein"), 0.0)
+    desc = result.get("description", "無法辨識")
+    return cal, pro, desc
+
+
+def _record_meal_and_summarize(
+    user_id: str, cal: float, pro: float, stored_desc: str, today_str: str,
+) -> tuple[DayState, str, str]:
+    """入帳並計算今日累計，回傳 (當日狀態, 總熱量行, 剩餘熱量行)。"""
+    db.add_meal(user_id, cal, pro, stored_desc, today_str)
+    state = get_day_state(user_id, today_str)
+    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(state)
+    return state, total_cal_line, remaining_cal_line
+
+
+class _EarlyMealRecorder:
+    """串流中 calories／protein／description 一到齊，就在執行緒中入帳並計算今日累計，
+    與其餘 breakdown 的生成並行。未開串流（或未提前取得）時於 record() 照原流程寫入。
+
+    已提前入帳後，之後的任何失敗都改以入帳的欄位回覆（不讓使用者看到錯誤而重傳、重複記錄）；
+    重試或 hedge 由另一次回應勝出時，其明細與入帳數值不一致，也只回覆入帳的欄位。
+    """
+
+    def __init__(self, user_id: str, desc_prefix: str = ""):
+        self.user_id = user_id
+        self.desc_prefix = desc_prefix
+        self.today_str = date.today().isoformat()
+        self.fields: dict | None = None
+        self.task: asyncio.Future | None = None
+
+    @property
+    def started(self) -> bool:
+        return self.task is not None
+
+    def on_fields(self, fields: dict) -> None:
+        if self.task is not None:
+            return
+        self.fields = dict(fields)
+        cal, pro, desc = _meal_core_values(fields)
+        self.task = asyncio.ensure_future(asyncio.to_thread(
+            _record_meal_and_summarize,
+            self.user_id, cal, pro, f"{self.desc_prefix}{desc}", self.today_str,
+        ))
+
+    def final_result(self, result) -> dict:
+        """回覆用的分析結果；已提前入帳時，明細必須與入帳數值出自同一次回應。"""
+        if self.task is None:
+            return result
+        fields = dict(self.fields or {})
+        if (
+            isinstance(result, dict)
+            and _meal_core_values(result) == _meal_core_values(fields)
+        ):
+            return result
+        return fields
+
+    async def record(self, result: dict) -> tuple[float, float, str, tuple[DayState, str, str]]:
+        """回傳 (cal, pro, desc, 今日累計)；已提前入帳時以入帳的數值為準。"""
+        if self.task is not None:
+            cal, pro, desc = _meal_core_values(self.fields or {})
+            return cal, pro, desc, await self.task
+        cal, pro, desc = _meal_core_values(result)
+        summary = _record_meal_and_summarize(
+            self.user_id, cal, pro, f"{self.desc_prefix}{desc}", self.today_str,
+        )
+        return cal, pro, desc, summary
+
+
 async def handle_meal_photo(
     user_id: str,
     message_id: str,
@@ -1709,48 +2107,53 @@ async def handle_meal_photo(
     *,
     force_scale: bool = False,
     image_b64: str | None = None,
+    deadline: float | None = None,
 ) -> str:
-    """處理食物照片：分析＋記錄＋回傳摘要。"""
+    """處理食物照片：分析＋記錄＋回傳摘要。deadline 為整體分析預算的截止時間（loop.time()）。"""
     if not image_b64:
         image_b64 = await get_line_image_base64(message_id)
     note_prompt, scale_weights, total_weight_g = _build_meal_photo_note_prompt(
         user_note, force_scale=force_scale,
     )
 
-    result = await call_openai_vision(
-        system_prompt=PROMPT_MEAL_ANALYSIS,
-        user_prompt=(
-            "請分析這份餐點照片。目標為減脂：先描述畫面再推論品項；"
-            "有包裝則優先讀標示；區分生/熟；calories 取區間 Maximum，"
-            "protein 精準中立勿上緣；填寫 food_breakdown 與信心欄位。"
-            f"{note_prompt}"
-        ),
-        image_base64=image_b64,
-        image_detail="auto",
-    )
+    from prompts import PROMPT_MEAL_ANALYSIS
 
-    if isinstance(result, OpenAIUserNotice):
+    early = _EarlyMealRecorder(user_id)
+    try:
+        result = await _call_meal_model(
+            call_openai_vision,
+            system_prompt=PROMPT_MEAL_ANALYSIS,
+            user_prompt=(
+                "請分析這份餐點照片。目標為減脂：先描述畫面再推論品項；"
+                "有包裝則優先讀標示；區分生/熟；calories 取區間 Maximum，"
+                "protein 精準中立勿上緣；填寫 food_breakdown 與信心欄位。"
+            ),
+            user_suffix=note_prompt.strip(),
+            image_base64=image_b64,
+            image_detail="auto",
+            prompt_id="meal_analysis",
+            user_id=user_id,
+            stream_fields=_MEAL_CORE_FIELDS,
+            on_fields=early.on_fields,
+            deadline=deadline,
+        )
+    except Exception:
+        # 核心欄位已入帳：之後的逾時或錯誤仍以入帳內容回覆，避免使用者重傳造成重複記錄
+        if not early.started:
+            raise
+        result = None
+
+    if not early.started and isinstance(result, OpenAIUserNotice):
         return str(result)
-    if isinstance(result, str):
+    if not early.started and isinstance(result, str):
         return f"分析失敗，請重新拍照。\n\n原始回應：\n{result[:200]}"
+    result = early.final_result(result)
 
-    cal = _safe_float(result.get("calories"), 0.0)
-    pro = _safe_float(result.get("protein"), 0.0)
-    desc = result.get("description", "無法辨識")
-
-    # 寫入 DB
-    today_str = date.today().isoformat()
-    db.add_meal(user_id, cal, pro, desc, today_str)
-
-    # 今日累計
-    totals = db.get_daily_totals(user_id, today_str)
-    targets = get_user_targets(user_id)
-    remaining = targets["protein"] - totals["protein"]
-    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(
-        user_id, today_str, totals,
-    )
-    bar = build_progress_bar(totals["protein"], targets["protein"])
-    gap = get_gap_filler(remaining)
+    # 寫入 DB＋今日累計（串流時已提前開始）
+    cal, pro, desc, (state, total_cal_line, remaining_cal_line) = await early.record(result)
+    totals, targets = state.totals, state.targets
+    bar = state.progress_bar
+    gap = get_gap_filler(state.remaining_protein)
 
     lines = [
         "本餐分析結果",
@@ -1789,36 +2192,44 @@ def _parse_meal_text_report(text: str) -> str | None:
 
 async def handle_meal_from_text(user_id: str, user_said: str) -> str:
     """依文字描述估算熱量與蛋白質並入帳（與拍照版同一套保守原則）。"""
-    result = await call_openai_text(
-        PROMPT_MEAL_FROM_TEXT,
-        (
-            "使用者原文如下，請依步驟三～五推導並回傳 JSON：\n"
-            f"{user_said.strip()}\n\n"
-            "目標為減脂：calories 取區間 Maximum，protein 精準中立勿上緣；"
-            "填寫 food_breakdown 與信心欄位。"
-        ),
-    )
+    from prompts import PROMPT_MEAL_FROM_TEXT
 
-    if isinstance(result, OpenAIUserNotice):
+    early = _EarlyMealRecorder(user_id, desc_prefix="[文字紀錄] ")
+    try:
+        result = await _call_meal_model(
+            call_openai_text,
+            system_prompt=PROMPT_MEAL_FROM_TEXT,
+            user_prompt=(
+                "請依步驟三～五推導並回傳 JSON。"
+                "目標為減脂：calories 取區間 Maximum，protein 精準中立勿上緣；"
+                "填寫 food_breakdown 與信心欄位。\n\n"
+                "使用者原文如下：\n"
+            ),
+            user_suffix=user_said.strip(),
+            prompt_id="meal_from_text",
+            user_id=user_id,
+            stream_fields=_MEAL_CORE_FIELDS,
+            on_fields=early.on_fields,
+        )
+    except OpenAIUnavailableError as e:
+        if not early.started:
+            return f"{e}\n\n{QUICK_RECORD_FALLBACK_TEXT}"
+        result = None
+    except Exception:
+        if not early.started:
+            raise
+        result = None
+
+    if not early.started and isinstance(result, OpenAIUserNotice):
         return str(result)
-    if isinstance(result, str):
+    if not early.started and isinstance(result, str):
         return f"文字分析失敗，請寫清楚一點再試。\n\n原始回應：\n{result[:200]}"
+    result = early.final_result(result)
 
-    cal = _safe_float(result.get("calories"), 0.0)
-    pro = _safe_float(result.get("protein"), 0.0)
-    desc = result.get("description", "無法辨識")
-
-    today_str = date.today().isoformat()
-    db.add_meal(user_id, cal, pro, f"[文字紀錄] {desc}", today_str)
-
-    totals = db.get_daily_totals(user_id, today_str)
-    targets = get_user_targets(user_id)
-    remaining = targets["protein"] - totals["protein"]
-    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(
-        user_id, today_str, totals,
-    )
-    bar = build_progress_bar(totals["protein"], targets["protein"])
-    gap = get_gap_filler(remaining)
+    cal, pro, desc, (state, total_cal_line, remaining_cal_line) = await early.record(result)
+    totals, targets = state.totals, state.targets
+    bar = state.progress_bar
+    gap = get_gap_filler(state.remaining_protein)
 
     lines = [
         "本餐分析結果（文字紀錄）",
@@ -1839,10 +2250,14 @@ async def handle_meal_from_text(user_id: str, user_said: str) -> str:
     return "\n".join(lines)
 
 
-async def handle_purchase_query_photo(user_id: str, message_id: str) -> str:
+async def handle_purchase_query_photo(
+    user_id: str, message_id: str, *, deadline: float | None = None,
+) -> str:
     """處理購買查詢照片。"""
     image_b64 = await get_line_image_base64(message_id)
 
+    from prompts import PROMPT_PURCHASE_QUERY
+
     result = await call_openai_vision(
         system_prompt=PROMPT_PURCHASE_QUERY,
         user_prompt=(
@@ -1851,6 +2266,9 @@ async def handle_purchase_query_photo(user_id: str, message_id: str) -> str:
         ),
         image_base64=image_b64,
         image_detail="high",
+        prompt_id="purchase_query",
+        user_id=user_id,
+        deadline=deadline,
     )
 
     if isinstance(result, OpenAIUserNotice):
@@ -1920,10 +2338,14 @@ async def handle_purchase_query_photo(user_id: str, message_id: str) -> str:
     return "\n".join(lines)
 
 
-async def handle_inbody_photo(user_id: str, message_id: str) -> str:
+async def handle_inbody_photo(
+    user_id: str, message_id: str, *, deadline: float | None = None,
+) -> str:
     """處理 InBody 照片：OCR＋更新目標。"""
     image_b64 = await get_line_image_base64(message_id)
 
+    from prompts import PROMPT_INBODY_ANALYSIS
+
     result = await call_openai_vision(
         system_prompt=PROMPT_INBODY_ANALYSIS,
         user_prompt=(
@@ -1933,6 +2355,9 @@ async def handle_inbody_photo(user_id: str, message_id: str) -> str:
         ),
         image_base64=image_b64,
         image_detail="high",
+        prompt_id="inbody_analysis",
+        user_id=user_id,
+        deadline=deadline,
     )
 
     if isinstance(result, OpenAIUserNotice):
@@ -2214,6 +2639,12 @@ def calculate_targets(
     return {"calories": int(round(cal)), "protein": pro}
 
 
+def get_user_targets_batch(user_ids: list[str]) -> dict[str, dict]:
+    """多位使用者的每日目標（profile 一次讀完），結果同逐筆 get_user_targets。"""
+    profiles = db.get_user_profiles(user_ids)
+    return {uid: _targets_from_profile(profiles.get(uid)) for uid in user_ids}
+
+
 async def handle_fitness_goal_selection(user_id: str, goal: str) -> str:
     """完成 onboarding：寫入健身目標並重算營養目標。"""
     profile = db.get_user_profile(user_id)
@@ -2247,90 +2678,157 @@ async def handle_fitness_goal_selection(user_id: str, goal: str) -> str:
     )
 
 
-async def handle_weekly_score(user_id: str) -> str:
-    """產生本週飲食積分卡。"""
-    today = date.today()
-    week_start = today - timedelta(days=today.weekday())  # 本週一
+def load_daily_series(user_id: str, start: date, end: date) -> reporting.DailySeries:
+    """[start, end] 的每日彙總（一次查詢；無紀錄的日子補 0）。"""
+    rows = db.get_daily_aggregates(user_id, start.isoformat(), end.isoformat())
+    return reporting.DailySeries.from_rows(rows, start, end)
 
-    days_data = []
-    for i in range(7):
-        d = week_start + timedelta(days=i)
-        if d > today:
-            break
-        totals = db.get_daily_totals(user_id, d.isoformat())
-        days_data.append({"date": d.isoformat(), **totals})
 
-    if not days_data or all(d["meal_count"] == 0 for d in days_data):
-        return "本週尚無飲食紀錄，開始記錄後才能產生積分卡。"
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 週積分卡（每晚批次預先計算；寫入餐點／目標後於背景增量重算，查詢只讀一筆）
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-    targets = get_user_targets(user_id)
-    active_days = [d for d in days_data if d["meal_count"] > 0]
-    total_days = len(active_days)
+# 資料變動後多久內合併重算一次（0 表示不在背景重算，改由下次查詢時現算）
+SCORE_CARD_REFRESH_SEC = float(os.getenv("SCORE_CARD_REFRESH_SEC", "15"))
+
+# user_id → 本程序確認 weekly_scores 已是最新的日期；寫入通知時移除
+_fresh_score_cards: dict[str, str] = {}
+_score_cards_to_refresh: set[str] = set()
+
+
+def _week_start(d: date) -> date:
+    return d - timedelta(days=d.weekday())  # 週一
+
+
+def compute_weekly_score_card(
+    user_id: str,
+    today: date,
+    *,
+    targets: dict | None = None,
+    rows: list[dict] | None = None,
+) -> dict:
+    """本週一到 today 的積分卡欄位（weekly_scores 一列）；rows／targets 供批次預先查好傳入。"""
+    week_start = _week_start(today)
+    if rows is None:
+        series = load_daily_series(user_id, week_start, today)
+    else:
+        series = reporting.DailySeries.from_rows(rows, week_start, today)
+    targets = targets or get_user_targets(user_id)
+    stats = reporting.summarize(series, targets["calories"], targets["protein"])
+    grades = reporting.score_grades(stats)
+    return {
+        "user_id": user_id,
+        "week_start": week_start.isoformat(),
+        "week_end": today.isoformat(),
+        "overall_grade": grades.overall,
+        "protein_grade": grades.protein,
+        "calorie_grade": grades.calorie,
+        "regularity_grade": grades.regularity,
+        "active_days": stats.active_days,
+        "protein_met": stats.protein_met,
+        "elapsed_days": stats.days,
+        "avg_calories": stats.avg_calories,
+        "calorie_target": float(targets["calories"]),
+        "protein_target": float(targets["protein"]),
+    }
+
+
+def refresh_weekly_score_card(user_id: str, today: date | None = None) -> dict:
+    """重算並 upsert 本週積分卡；期間若又有寫入則不標記為最新。"""
+    today = today or date.today()
+    card = compute_weekly_score_card(user_id, today)
+    db.save_weekly_scores([card])
+    if user_id not in _score_cards_to_refresh:
+        _fresh_score_cards[user_id] = today.isoformat()
+    return card
+
+
+def _on_score_data_changed(user_id: str, date_str: str | None) -> None:
+    if date_str is not None and date_str < _week_start(date.today()).isoformat():
+        return
+    _fresh_score_cards.pop(user_id, None)
+    _score_cards_to_refresh.add(user_id)
+
+
+db.add_change_listener(_on_score_data_changed)
+
+
+async def score_card_refresher() -> None:
+    """定期把有變動的使用者積分卡重算寫回（同一人多次寫入只算一次）。"""
+    while True:
+        await asyncio.sleep(SCORE_CARD_REFRESH_SEC)
+        while _score_cards_to_refresh:
+            uid = _score_cards_to_refresh.pop()
+            try:
+                await asyncio.to_thread(refresh_weekly_score_card, uid)
+            except Exception as e:
+                logger.warning("積分卡增量更新失敗 %s: %s", uid[:8], e)
+
+
+async def execute_weekly_score_precompute(
+    today: date | None = None,
+    *,
+    progress: Callable[[dict], Awaitable[None]] | None = None,
+) -> dict:
+    """本週有紀錄的使用者逐頁批次重算積分卡（每頁：目標、彙總各一次查詢＋一次批次 upsert）。"""
+    today = today or date.today()
+    week_start = _week_start(today)
+    counts = {"total": 0, "processed": 0, "ok": 0, "skipped": 0, "failed": 0}
+
+    def _page(uids: list[str]) -> int:
+        targets = get_user_targets_batch(uids)
+        rows = db.get_daily_aggregates_for_users(uids, week_start.isoformat(), today.isoformat())
+        cards = [
+            compute_weekly_score_card(uid, today, targets=targets[uid], rows=rows[uid])
+            for uid in uids
+        ]
+        db.save_weekly_scores(cards)
+        # 補算過去日期會覆寫同週的卡片，這些人改回查詢時現算
+        live = today == date.today()
+        for uid in uids:
+            if live and uid not in _score_cards_to_refresh:
+                _fresh_score_cards[uid] = today.isoformat()
+            elif not live:
+                _fresh_score_cards.pop(uid, None)
+        return len(cards)
+
+    pages = itertools.batched(
+        db.iter_user_ids_with_meals_since(week_start.isoformat()), AUDIENCE_PAGE_SIZE,
+    )
+    while True:
+        page = await asyncio.to_thread(next, pages, None)
+        if page is None:
+            break
+        counts["total"] += len(page)
+        try:
+            counts["ok"] += await asyncio.to_thread(_page, list(page))
+        except Exception as e:
+            counts["failed"] += len(page)
+            logger.error("積分卡批次計算失敗（%s 人）: %s", len(page), e, exc_info=True)
+        counts["processed"] += len(page)
+        if progress is not None:
+            await progress(dict(counts))
+    logger.info("積分卡預先計算 %s：%s 人（失敗 %s）", today, counts["ok"], counts["failed"])
+    return {
+        "date": today.isoformat(),
+        "week_start": week_start.isoformat(),
+        "users": counts["total"],
+        "saved": counts["ok"],
+        "failed": counts["failed"],
+    }
 
+
+def _render_weekly_score_card(card: dict) -> str:
+    total_days = int(card["active_days"] or 0)
     if total_days == 0:
-        return "本週尚無飲食紀錄。"
-
-    # 蛋白質達標率
-    protein_met = sum(1 for d in active_days if d["protein"] >= targets["protein"] * 0.9)
-    protein_rate = protein_met / total_days
-
-    # 平均熱量偏差
-    avg_cal = sum(d["calories"] for d in active_days) / total_days
-    cal_diff_pct = abs(avg_cal - targets["calories"]) / targets["calories"]
-
-    # 紀錄規律性 (有紀錄的天數比例)
-    elapsed_days = (today - week_start).days + 1
-    regularity_rate = total_days / elapsed_days
-
-    # 每日餐次穩定度
-    meal_counts = [d["meal_count"] for d in active_days]
-    avg_meals = sum(meal_counts) / len(meal_counts) if meal_counts else 0
-
-    def grade_general(rate):
-        if rate >= 0.95:
-            return "S"
-        elif rate >= 0.85:
-            return "A"
-        elif rate >= 0.70:
-            return "B"
-        elif rate >= 0.55:
-            return "C"
-        elif rate >= 0.40:
-            return "D"
-        else:
-            return "E"
-
-    def grade_calorie(diff):
-        if diff <= 0.05:
-            return "S"
-        elif diff <= 0.10:
-            return "A"
-        elif diff <= 0.15:
-            return "B"
-        elif diff <= 0.25:
-            return "C"
-        elif diff <= 0.35:
-            return "D"
-        else:
-            return "E"
-
-    protein_grade = grade_general(protein_rate)
-    calorie_grade = grade_calorie(cal_diff_pct)
-    regularity_grade = grade_general(regularity_rate)
-
-    # 綜合
-    grade_values = {"S": 6, "A": 5, "B": 4, "C": 3, "D": 2, "E": 1}
-    avg_score = (
-        grade_values[protein_grade]
-        + grade_values[calorie_grade]
-        + grade_values[regularity_grade]
-    ) / 3
-
-    overall = "S" if avg_score >= 5.5 else \
-              "A" if avg_score >= 4.5 else \
-              "B" if avg_score >= 3.5 else \
-              "C" if avg_score >= 2.5 else \
-              "D" if avg_score >= 1.5 else "E"
+        return "本週尚無飲食紀錄，開始記錄後才能產生積分卡。"
+    protein_met = int(card["protein_met"] or 0)
+    elapsed_days = int(card["elapsed_days"] or 0)
+    avg_cal = float(card["avg_calories"] or 0)
+    cal_target = float(card["calorie_target"] or 0)
+    protein_grade = card["protein_grade"]
+    calorie_grade = card["calorie_grade"]
+    regularity_grade = card["regularity_grade"]
 
     # 生成評語
     comments = []
@@ -2340,37 +2838,26 @@ async def handle_weekly_score(user_id: str) -> str:
         comments.append(f"蛋白質攝取表現出色（{protein_met}/{total_days} 天達標）。")
 
     if calorie_grade in ("D", "E"):
-        direction = "超出" if avg_cal > targets["calories"] else "不足"
-        comments.append(f"平均熱量{direction}目標 {abs(avg_cal - targets['calories']):.0f} kcal，需要調整。")
+        direction = "超出" if avg_cal > cal_target else "不足"
+        comments.append(f"平均熱量{direction}目標 {abs(avg_cal - cal_target):.0f} kcal，需要調整。")
     elif calorie_grade in ("S", "A"):
         comments.append("熱量控制非常精準，繼續保持。")
 
     if regularity_grade in ("D", "E"):
         comments.append(f"本週只有 {total_days}/{elapsed_days} 天有紀錄，請養成每餐拍照的習慣。")
 
-    # 儲存本週積分
-    db.save_weekly_score(
-        user_id=user_id,
-        week_start=week_start.isoformat(),
-        week_end=today.isoformat(),
-        overall=overall,
-        protein=protein_grade,
-        calorie=calorie_grade,
-        regularity=regularity_grade,
-    )
-
     lines = [
         f"本週飲食積分卡",
-        f"({week_start.isoformat()} ~ {today.isoformat()})",
+        f"({card['week_start']} ~ {card['week_end']})",
         "=" * 24,
         "",
-        f"  綜合評分：{overall}",
+        f"  綜合評分：{card['overall_grade']}",
         "",
         f"  蛋白質達標：{protein_grade}",
         f"    （{protein_met}/{total_days} 天達到 90% 以上）",
         "",
         f"  熱量控制：{calorie_grade}",
-        f"    （平均 {avg_cal:.0f}／目標 {targets['calories']:.0f} kcal）",
+        f"    （平均 {avg_cal:.0f}／目標 {cal_target:.0f} kcal）",
         "",
         f"  紀錄規律：{regularity_grade}",
         f"    （{total_days}/{elapsed_days} 天有紀錄）",
@@ -2385,16 +2872,103 @@ async def handle_weekly_score(user_id: str) -> str:
     return "\n".join(lines)
 
 
+async def handle_weekly_score(user_id: str) -> str:
+    """本週飲食積分卡：已預先算好且之後沒有新寫入時只讀 weekly_scores 一筆。"""
+    today = date.today()
+    card = None
+    if _fresh_score_cards.get(user_id) == today.isoformat():
+        card = db.get_weekly_score(user_id, _week_start(today).isoformat())
+    if card is None:
+        card = refresh_weekly_score_card(user_id, today)
+    return _render_weekly_score_card(card)
+
+
+REPORT_DEFAULT_DAYS = 28
+REPORT_MAX_DAYS = 365
+_REPORT_MAX_WEEK_ROWS = 13
+
+
+def _report_window_lines(stats: reporting.WindowStats, targets: dict) -> list[str]:
+    return [
+        f"有紀錄：{stats.active_days}/{stats.days} 天"
+        f"（目前連續 {stats.current_streak} 天，最長 {stats.longest_streak} 天）",
+        f"蛋白質達標：{stats.protein_met}/{stats.active_days} 天（目前連續 {stats.protein_streak} 天）",
+        f"平均熱量：{stats.avg_calories:.0f}／{targets['calories']:.0f} kcal"
+        f"（偏差 {stats.calorie_deviation:.0%}）",
+        f"熱量落在目標 ±10%：{stats.calorie_within_10pct} 天",
+        f"平均蛋白質：{stats.avg_protein:.0f}／{targets['protein']:.0f} g",
+    ]
+
+
+async def handle_history_report(user_id: str, days: int = REPORT_DEFAULT_DAYS) -> str:
+    """近 N 天報表：整段指標＋逐週趨勢（目標一律以目前目標計算）。"""
+    days = min(REPORT_MAX_DAYS, max(7, days))
+    today = date.today()
+    start = today - timedelta(days=days - 1)
+    series = load_daily_series(user_id, start, today)
+    if not any(series.meals):
+        return f"近 {days} 天沒有飲食紀錄，開始記錄後才能產生報表。"
+
+    targets = get_user_targets(user_id)
+    cal_t, pro_t = targets["calories"], targets["protein"]
+    stats = reporting.summarize(series, cal_t, pro_t)
+    lines = [
+        f"飲食報表（近 {days} 天）",
+        f"({start.isoformat()} ~ {today.isoformat()})",
+        "=" * 24,
+        *_report_window_lines(stats, targets),
+        "",
+        "逐週趨勢（紀錄天數｜蛋白達標｜平均熱量｜綜合）：",
+    ]
+    weeks = reporting.rolling_weeks(series, cal_t, pro_t, min(days // 7, _REPORT_MAX_WEEK_ROWS))
+    for w in weeks:
+        grade = reporting.score_grades(w).overall if w.active_days else "-"
+        lines.append(
+            f"  {w.start:%m/%d}~{w.end:%m/%d}  {w.active_days}/7｜{w.protein_met} 天｜"
+            f"{w.avg_calories:.0f} kcal｜{grade}"
+        )
+    return "\n".join(lines)
+
+
+async def handle_monthly_report(user_id: str) -> str:
+    """本月至今與上月同期比較。"""
+    today = date.today()
+    prev_start = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+    series = load_daily_series(user_id, prev_start, today)
+    if not any(series.meals):
+        return "本月與上月都沒有飲食紀錄，開始記錄後才能比較。"
+
+    targets = get_user_targets(user_id)
+    cur, prev = reporting.month_over_month(series, targets["calories"], targets["protein"])
+
+    def _row(label: str, before: str, after: str) -> str:
+        return f"  {label}：{before} → {after}"
+
+    lines = [
+        f"月報：本月 vs 上月同期（1～{today.day} 日）",
+        "=" * 24,
+        _row("紀錄天數", f"{prev.active_days}/{prev.days}", f"{cur.active_days}/{cur.days}"),
+        _row("蛋白質達標", f"{prev.protein_met} 天", f"{cur.protein_met} 天"),
+        _row("平均熱量", f"{prev.avg_calories:.0f}", f"{cur.avg_calories:.0f} kcal"),
+        _row("熱量偏差", f"{prev.calorie_deviation:.0%}", f"{cur.calorie_deviation:.0%}"),
+        _row("平均蛋白質", f"{prev.avg_protein:.0f}", f"{cur.avg_protein:.0f} g"),
+        _row("最長連續紀錄", f"{prev.longest_streak} 天", f"{cur.longest_streak} 天"),
+        "",
+        f"目標：{targets['calories']:.0f} kcal／{targets['protein']:.0f} g（兩期皆以目前目標計算）",
+    ]
+    return "\n".join(lines)
+
+
 async def handle_cheat_day(user_id: str) -> str:
     """啟動或查詢欺騙日。"""
     today_str = date.today().isoformat()
 
-    if db.is_cheat_day(user_id, today_str):
+    state = get_day_state(user_id, today_str)
+    if state.is_cheat_day:
         # 已經是欺騙日
-        totals = db.get_daily_totals(user_id, today_str)
-        targets = get_user_targets(user_id)
-        normal_cal = float(targets["calories"])
-        cheat_cal = get_daily_calorie_target(user_id, today_str)
+        totals = state.totals
+        normal_cal = float(state.targets["calories"])
+        cheat_cal = state.calorie_target
 
         return (
             f"今天已經是欺騙日模式\n"
@@ -2417,9 +2991,9 @@ async def handle_cheat_day(user_id: str) -> str:
 
     # 啟動欺騙日
     db.activate_cheat_day(user_id, today_str)
-    targets = get_user_targets(user_id)
-    normal_cal = float(targets["calories"])
-    cheat_cal = get_daily_calorie_target(user_id, today_str)
+    state = get_day_state(user_id, today_str)
+    normal_cal = float(state.targets["calories"])
+    cheat_cal = state.calorie_target
 
     return (
         f"欺騙日模式已啟動\n"
@@ -2439,13 +3013,8 @@ async def handle_ai_coach(user_id: str) -> str:
     today = date.today()
     targets = get_user_targets(user_id)
 
-    # 收集過去 14 天數據
-    days_data = []
-    for i in range(14):
-        d = today - timedelta(days=i)
-        totals = db.get_daily_totals(user_id, d.isoformat())
-        if totals["meal_count"] > 0:
-            days_data.append({"date": d.isoformat(), **totals})
+    # 過去 14 天有紀錄的日子（新到舊）
+    days_data = load_daily_series(user_id, today - timedelta(days=13), today).active_days()
 
     if len(days_data) < 3:
         return (
@@ -2472,10 +3041,26 @@ async def handle_ai_coach(user_id: str) -> str:
         data_summary["weight"] = profile.get("weight")
         data_summary["body_fat"] = profile.get("body_fat_percentage")
 
-    result = await call_openai_text(
-        system_prompt=PROMPT_AI_COACH,
-        user_prompt=f"以下是使用者的飲食數據，請進行分析：\n{json.dumps(data_summary, ensure_ascii=False, indent=2)}",
-    )
+    from prompts import PROMPT_AI_COACH
+
+    try:
+        result = await call_openai_text(
+            system_prompt=PROMPT_AI_COACH,
+            user_prompt="以下是使用者的飲食數據，請進行分析：\n",
+            user_suffix=json.dumps(data_summary, ensure_ascii=False, indent=2),
+            prompt_id="ai_coach",
+            user_id=user_id,
+        )
+    except OpenAIUnavailableError as e:
+        # 熔斷中：立即回數據摘要，不讓使用者空等
+        return "\n".join([
+            str(e),
+            "",
+            f"先看近 {data_summary['days_recorded']} 天的數據摘要：",
+            f"  平均熱量：{data_summary['avg_daily_calories']:.0f}／{targets['calories']:.0f} kcal",
+            f"  平均蛋白質：{data_summary['avg_daily_protein']:.0f}／{targets['protein']:.0f} g",
+            f"  蛋白質達標（≥90%）：{data_summary['days_meeting_protein_90pct']} 天",
+        ])
 
     if isinstance(result, OpenAIUserNotice):
         return str(result)
@@ -2519,24 +3104,22 @@ async def handle_ai_coach(user_id: str) -> str:
     return "\n".join(lines)
 
 
-async def handle_today_summary(user_id: str) -> str:
-    """今日飲食總結。"""
+async def handle_today_summary(user_id: str, *, targets: dict | None = None) -> str:
+    """今日飲食總結；排程批次推播時可傳入預先算好的 targets。"""
     today_str = date.today().isoformat()
-    totals = db.get_daily_totals(user_id, today_str)
-    targets = get_user_targets(user_id)
-    meals = db.get_meals_today(user_id, today_str)
+    state = get_day_state(user_id, today_str, targets=targets)
+    totals, targets = state.totals, state.targets
 
     if totals["meal_count"] == 0:
         return "今天還沒有任何飲食紀錄。\n拍一張食物照片開始記錄吧。"
+    meals = db.get_meals_today(user_id, today_str)
 
-    remaining_protein = targets["protein"] - totals["protein"]
-    bar = build_progress_bar(totals["protein"], targets["protein"])
+    remaining_protein = state.remaining_protein
+    bar = state.progress_bar
 
-    is_cheat = db.is_cheat_day(user_id, today_str)
-    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(
-        user_id, today_str, totals,
-    )
-    cal_target = get_daily_calorie_target(user_id, today_str)
+    is_cheat = state.is_cheat_day
+    total_cal_line, remaining_cal_line = _format_daily_calorie_summary_lines(state)
+    cal_target = state.calorie_target
 
     lines = [
         f"今日飲食總結 ({today_str})",
@@ -2565,6 +3148,14 @@ async def handle_today_summary(user_id: str) -> str:
 # JITAI 智能提醒（需手動開啟；門檻觸發 + 窗格收尾最後通牒）
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
+# 批次推播時同時產生文案／推播的使用者數上限，與進度回寫間隔
+JITAI_CONCURRENCY = max(1, int(os.getenv("JITAI_CONCURRENCY", "4")))
+_JITAI_PROGRESS_EVERY = 20
+# 文案預設由 jitai_engine 決定性產生；設 1 時才請 JITAI_MODEL 依選好的組合潤飾語氣
+JITAI_LLM_PHRASING = (os.getenv("JITAI_LLM_PHRASING") or "0").strip().lower() in (
+    "1", "true", "yes", "on",
+)
+
 JITAI_CHECKPOINTS = {
     "lunch": {
         "hour": 14,
@@ -2620,35 +3211,11 @@ def _jitai_user_behind(
     return cur < t_pro * protein_progress_min
 
 
-def _jitai_rule_based_options(remaining_pro: float, urgent: bool) -> str:
-    """AI 失敗時的備援：仍給可執行選項。"""
-    lines = ["可立即補充的選項："]
-    opts: list[str] = []
-    if remaining_pro >= 35:
-        opts.extend([
-            "乳清蛋白飲 1 份（約 +25g 蛋白）",
-            "即食雞胸 150g（約 +35g 蛋白）",
-            "希臘優格 200g ＋ 花生醬 1 湯匙（約 +25g 蛋白）",
-        ])
-    elif remaining_pro >= 18:
-        opts.extend([
-            "水煮蛋 2 顆（約 +12g 蛋白）",
-            "乳清蛋白飲 1 份（約 +25g 蛋白）",
-            "即食雞胸 100g（約 +23g 蛋白）",
-        ])
-    else:
-        opts.extend([
-            "水煮蛋 1 顆（約 +6g 蛋白）",
-            "無糖豆漿 450ml（約 +15g 蛋白）",
-            "希臘優格 150g（約 +15g 蛋白）",
-        ])
-    for i, o in enumerate(opts[:3], 1):
-        lines.append(f"{i}. {o}")
-    if urgent:
-        lines.append("\n今日紀錄窗格即將關閉，請選一項最快能拿到的先補上。")
-    else:
-        lines.append("\n選一項最順手的先補，補完拍張照或傳「加蛋白飲」記錄。")
-    return "\n".join(lines)
+def _jitai_rule_based_options(
+    remaining_pro: float, urgent: bool, remaining_cal: float | None = None,
+) -> str:
+    """規則式選項：由 jitai_engine 依剩餘蛋白與熱量空間挑 3 組便利組合。"""
+    return jitai_engine.render_options(remaining_pro, remaining_cal, urgent=urgent)
 
 
 async def _build_jitai_nudge_message(
@@ -2657,66 +3224,62 @@ async def _build_jitai_nudge_message(
     checkpoint: str,
     *,
     urgent: bool = False,
+    targets: dict | None = None,
 ) -> str:
-    totals = db.get_daily_totals(user_id, local_date_s)
-    targets = get_user_targets(user_id)
-    profile = db.get_user_profile(user_id) or {}
-    goal = _profile_fitness_goal(profile)
-    remaining_pro = max(0.0, float(targets["protein"]) - float(totals["protein"]))
-    cal_target = get_daily_calorie_target(user_id, local_date_s)
-    remaining_cal = cal_target - float(totals["calories"])
+    state = get_day_state(user_id, local_date_s, targets=targets)
+    remaining_pro = max(0.0, float(state.remaining_protein))
+    remaining_cal = state.remaining_calories
 
     tz = _bot_timezone()
     now_local = datetime.now(timezone.utc).astimezone(tz)
     window_end = _jitai_window_end_local(now_local.date(), tz)
     mins_left = max(0, int((window_end - now_local).total_seconds() // 60))
 
-    meals = db.get_meals_today(user_id, local_date_s)
-    meal_lines = []
-    for m in meals[-4:]:
-        meal_lines.append(
-            f"- {m.get('food_description', '?')} "
-            f"（{float(m.get('protein') or 0):.0f}g 蛋白）"
-        )
-    meals_ctx = "\n".join(meal_lines) if meal_lines else "（今日尚無紀錄）"
-
-    cp_label = JITAI_CHECKPOINTS.get(checkpoint, {}).get("label", checkpoint)
-    urgency = (
-        "這是今日紀錄窗格關閉前的最後提醒，請聚焦最快能補上的組合，語氣可更緊迫。"
-        if urgent
-        else "僅在進度落後時觸發；請給務實、可馬上執行的建議。"
-    )
-    user_prompt = (
-        f"檢查點：{cp_label}\n"
-        f"健身目標：{goal}\n"
-        f"今日已攝取蛋白質：{totals['protein']:.0f} g／目標 {targets['protein']:.0f} g\n"
-        f"尚缺蛋白質：約 {remaining_pro:.0f} g\n"
-        f"今日已攝取熱量：{totals['calories']:.0f} kcal／目標 {cal_target:.0f} kcal\n"
-        f"熱量剩餘空間：約 {remaining_cal:.0f} kcal\n"
-        f"距離今日窗格結束還有約 {mins_left} 分鐘\n"
-        f"{urgency}\n\n"
-        f"今日已記錄餐點：\n{meals_ctx}"
-    )
+    header = "【智能提醒" + ("｜今日最後補充窗口" if urgent else "") + "】\n"
+    options = _jitai_rule_based_options(remaining_pro, urgent=urgent, remaining_cal=remaining_cal)
+
+    if JITAI_LLM_PHRASING:
+        profile = db.get_user_profile(user_id) or {}
+        goal = _profile_fitness_goal(profile)
+        meals = db.get_meals_today(user_id, local_date_s)
+        meal_lines = []
+        for m in meals[-4:]:
+            meal_lines.append(
+                f"- {m.get('food_description', '?')} "
+                f"（{float(m.get('protein') or 0):.0f}g 蛋白）"
+            )
+        meals_ctx = "\n".join(meal_lines) if meal_lines else "（今日尚無紀錄）"
 
-    ai_text = await call_openai_jitai_nudge(user_prompt)
-    ai_text = (ai_text or "").strip()
-    if ai_text:
-        header = "【智能提醒"
-        if urgent:
-            header += "｜今日最後補充窗口"
-        header += "】\n"
-        return truncate_line_text(header + ai_text)
+        cp_label = JITAI_CHECKPOINTS.get(checkpoint, {}).get("label", checkpoint)
+        urgency = (
+            "這是今日紀錄窗格關閉前的最後提醒，請聚焦最快能補上的組合，語氣可更緊迫。"
+            if urgent
+            else "僅在進度落後時觸發；請給務實、可馬上執行的建議。"
+        )
+        user_prompt = (
+            f"檢查點：{cp_label}\n"
+            f"健身目標：{goal}\n"
+            f"今日已攝取蛋白質：{state.totals['protein']:.0f} g／目標 {state.targets['protein']:.0f} g\n"
+            f"尚缺蛋白質：約 {remaining_pro:.0f} g\n"
+            f"今日已攝取熱量：{state.totals['calories']:.0f} kcal／目標 {state.calorie_target:.0f} kcal\n"
+            f"熱量剩餘空間：約 {remaining_cal:.0f} kcal\n"
+            f"距離今日窗格結束還有約 {mins_left} 分鐘\n"
+            f"{urgency}\n\n"
+            f"今日已記錄餐點：\n{meals_ctx}\n\n"
+            "可用選項（已依剩餘蛋白與熱量算好，請沿用，勿更換品項與數字）：\n"
+            f"{options}"
+        )
+        ai_text = await call_openai_jitai_nudge(user_prompt, user_id=user_id)
+        ai_text = (ai_text or "").strip()
+        if ai_text:
+            return truncate_line_text(header + ai_text)
 
-    fallback_intro = (
+    intro = (
         f"蛋白質尚缺約 {remaining_pro:.0f} g，距離今日窗格結束約 {mins_left} 分鐘。\n\n"
         if remaining_pro > 0
         else f"今日蛋白質已達標；距離窗格結束約 {mins_left} 分鐘，維持記錄節奏即可。\n\n"
     )
-    return truncate_line_text(
-        "【智能提醒" + ("｜今日最後補充窗口" if urgent else "") + "】\n"
-        + fallback_intro
-        + _jitai_rule_based_options(remaining_pro, urgent=urgent)
-    )
+    return truncate_line_text(header + intro + options)
 
 
 def handle_jitai_toggle(user_id: str, enabled: bool) -> str:
@@ -2757,10 +3320,57 @@ def handle_jitai_status(user_id: str) -> str:
     )
 
 
-async def execute_jitai_nudge_push(checkpoint: str) -> dict:
+def _iter_with_targets(user_ids, page_size: int = AUDIENCE_PAGE_SIZE):
+    """逐頁讀名冊並批次計算每日目標，逐一 yield (user_id, targets)。"""
+    for page in itertools.batched(user_ids, page_size):
+        page_targets = get_user_targets_batch(list(page))
+        for uid in page:
+            yield uid, page_targets[uid]
+
+
+def _collect_jitai_targets(
+    checkpoint: str, local_date_s: str, slot: str, now_utc_iso: str,
+) -> tuple[dict[str, dict], int, int]:
+    """篩出本檢查點需要推播的使用者，回傳 ({user_id: 每日目標}, 已開啟人數, 略過數)。
+
+    名冊逐頁處理，每頁的目標以 get_user_targets_batch 一次算完（見 _iter_with_targets）。
+    """
+    urgent = checkpoint == "final"
+    recent_min = _jitai_recent_meal_minutes()
+    selected: dict[str, dict] = {}
+    users = skip = 0
+    for uid, targets in _iter_with_targets(db.iter_user_ids_with_jitai_enabled()):
+        users += 1
+        if db.reminder_already_sent(uid, local_date_s, slot):
+            skip += 1
+            continue
+        if not urgent:
+            # 經當日狀態快取讀取；稍後產生文案時同一份狀態直接命中
+            totals = get_day_state(uid, local_date_s, targets=targets).totals
+            prog_min = JITAI_CHECKPOINTS[checkpoint]["protein_progress_min"]
+            if not _jitai_user_behind(totals, targets, prog_min):
+                skip += 1
+                continue
+            if db.user_had_meal_in_recent_minutes(
+                uid, local_date_s, recent_min, end_utc_iso=now_utc_iso
+            ):
+                skip += 1
+                continue
+        selected[uid] = targets
+    return selected, users, skip
+
+
+async def execute_jitai_nudge_push(
+    checkpoint: str,
+    *,
+    progress: Callable[[dict], Awaitable[None]] | None = None,
+) -> dict:
     """
     JITAI 智能提醒批次推播。
     checkpoint: lunch｜afternoon｜final
+
+    三段式：先篩出落後的使用者，再以 JITAI_CONCURRENCY 為上限並行產生文案，
+    最後並行推播。progress 會在各階段與每批完成時收到目前計數。
     """
     if checkpoint not in (*JITAI_CHECKPOINTS.keys(), "final"):
         return {"error": f"unknown_checkpoint: {checkpoint}"}
@@ -2770,65 +3380,127 @@ async def execute_jitai_nudge_push(checkpoint: str) -> dict:
     now_local = now_utc.astimezone(tz)
     local_date_s = now_local.date().isoformat()
     urgent = checkpoint == "final"
+    slot = JITAI_CHECKPOINTS[checkpoint]["slot"] if checkpoint in JITAI_CHECKPOINTS else "jitai_final"
 
-    user_ids = db.get_user_ids_with_jitai_enabled()
-    ok, skip, fail = 0, 0, 0
-    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-    recent_min = _jitai_recent_meal_minutes()
+    counts = {"total": 0, "processed": 0, "ok": 0, "skipped": 0, "failed": 0}
 
-    async with AsyncApiClient(configuration) as api_client:
-        line_api = AsyncMessagingApi(api_client)
-        for uid in user_ids:
+    async def _report(force: bool = False) -> None:
+        if progress is not None and (force or counts["processed"] % _JITAI_PROGRESS_EVERY == 0):
+            await progress(dict(counts))
+
+    # 1) 篩選（同步 DB 查詢集中在執行緒內，不卡事件迴圈）
+    targets, users, skip = await asyncio.to_thread(
+        _collect_jitai_targets, checkpoint, local_date_s, slot, now_utc.isoformat(),
+    )
+    counts.update(total=len(targets), skipped=skip)
+    await _report(force=True)
+
+    sem = asyncio.Semaphore(JITAI_CONCURRENCY)
+
+    # 2) 產生文案（AI 失敗或熔斷時自動改用規則式文案）
+    async def _generate(uid: str) -> str | None:
+        async with sem:
             try:
-                slot = (
-                    JITAI_CHECKPOINTS[checkpoint]["slot"]
-                    if checkpoint in JITAI_CHECKPOINTS
-                    else "jitai_final"
+                return await _build_jitai_nudge_message(
+                    uid, local_date_s, checkpoint, urgent=urgent, targets=targets[uid],
                 )
-                if db.reminder_already_sent(uid, local_date_s, slot):
-                    skip += 1
-                    continue
+            except Exception as e:
+                logger.error("JITAI 文案產生失敗 %s: %s", uid[:8], e)
+                return None
 
-                totals = db.get_daily_totals(uid, local_date_s)
-                targets = get_user_targets(uid)
-
-                if not urgent:
-                    prog_min = JITAI_CHECKPOINTS[checkpoint]["protein_progress_min"]
-                    if not _jitai_user_behind(totals, targets, prog_min):
-                        skip += 1
-                        continue
-                    if db.user_had_meal_in_recent_minutes(
-                        uid, local_date_s, recent_min, end_utc_iso=now_utc.isoformat()
-                    ):
-                        skip += 1
-                        continue
-
-                text = await _build_jitai_nudge_message(
-                    uid, local_date_s, checkpoint, urgent=urgent,
-                )
-                await line_api.push_message(
-                    PushMessageRequest(
-                        to=uid,
-                        messages=[TextMessage(text=text)],
+    texts = await asyncio.gather(*(_generate(uid) for uid in targets))
+
+    # 3) 推播
+    from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, PushMessageRequest, TextMessage
+
+    async with AsyncApiClient(_line_configuration()) as api_client:
+        line_api = AsyncMessagingApi(api_client)
+
+        async def _push(uid: str, text: str | None) -> None:
+            async with sem:
+                try:
+                    if text is None:
+                        raise RuntimeError("no message")
+                    await line_api.push_message(
+                        PushMessageRequest(to=uid, messages=[TextMessage(text=text)])
                     )
-                )
-                db.mark_reminder_sent(uid, local_date_s, slot)
-                ok += 1
-                logger.info("已推播 JITAI 提醒（%s）給 %s...", checkpoint, uid[:8])
-            except Exception as e:
-                fail += 1
-                logger.error("JITAI 提醒推播失敗 %s: %s", uid[:8], e)
+                    await asyncio.to_thread(db.mark_reminder_sent, uid, local_date_s, slot)
+                    counts["ok"] += 1
+                    logger.info("已推播 JITAI 提醒（%s）給 %s...", checkpoint, uid[:8])
+                except Exception as e:
+                    counts["failed"] += 1
+                    logger.error("JITAI 提醒推播失敗 %s: %s", uid[:8], e)
+                counts["processed"] += 1
+                await _report()
+
+        await asyncio.gather(*(_push(uid, text) for uid, text in zip(targets, texts)))
 
+    await _report(force=True)
     return {
         "checkpoint": checkpoint,
         "date": local_date_s,
-        "users_enabled": len(user_ids),
-        "pushed_ok": ok,
-        "skipped": skip,
-        "pushed_fail": fail,
+        "users_enabled": users,
+        "pushed_ok": counts["ok"],
+        "skipped": counts["skipped"],
+        "pushed_fail": counts["failed"],
+        "concurrency": JITAI_CONCURRENCY,
     }
 
 
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 排程背景工作（cron 請求立即回 202，進度寫入 cron_jobs）
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+async def start_cron_job(
+    kind: str,
+    dedupe_key: str,
+    params: dict,
+    work: Callable[[Callable[[dict], Awaitable[None]]], Awaitable[dict]],
+) -> tuple[str, bool]:
+    """建立工作紀錄並在背景執行 work(progress)；同 dedupe_key 仍在跑時沿用既有工作。"""
+    job_id, created = await asyncio.to_thread(
+        db.start_cron_job, secrets.token_hex(8), kind, dedupe_key, params,
+    )
+    if created:
+        spawn_background_job(_run_cron_job(job_id, kind, work))
+    else:
+        logger.info("%s 已有進行中的工作 %s，不重複啟動", kind, job_id)
+    return job_id, created
+
+
+async def _run_cron_job(job_id: str, kind: str, work) -> None:
+    async def _progress(counts: dict) -> None:
+        try:
+            await asyncio.to_thread(db.update_cron_job, job_id, **counts)
+        except Exception as e:
+            logger.warning("cron 工作 %s 進度寫入失敗: %s", job_id, e)
+
+    await asyncio.to_thread(
+        db.update_cron_job, job_id,
+        status="running", started_at=datetime.now(timezone.utc).isoformat(),
+    )
+    try:
+        result = await work(_progress)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(
+            db.update_cron_job, job_id, status="failed", error="cancelled",
+            finished_at=datetime.now(timezone.utc).isoformat(),
+        )
+        raise
+    except Exception as e:
+        logger.error("cron 工作 %s（%s）失敗: %s", job_id, kind, e, exc_info=True)
+        await asyncio.to_thread(
+            db.update_cron_job, job_id, status="failed", error=str(e)[:500],
+            finished_at=datetime.now(timezone.utc).isoformat(),
+        )
+        return
+    await asyncio.to_thread(
+        db.update_cron_job, job_id, status="done", result=result,
+        finished_at=datetime.now(timezone.utc).isoformat(),
+    )
+    logger.info("cron 工作 %s（%s）完成: %s", job_id, kind, result)
+
+
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 定時推播（建議由 GitHub Actions 呼叫 /cron/daily-summary）
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -2837,54 +3509,54 @@ async def execute_daily_summary_push() -> dict:
     """推播每日總結（可重複呼叫）：對象為近期曾互動／有紀錄者；無餐點也會收到提示。"""
     today_str = date.today().isoformat()
     meal_since = (date.today() - timedelta(days=400)).isoformat()
+    users, ok, fail = 0, 0, 0
+    notion = get_notion_sync()
     try:
-        user_ids = db.get_user_ids_for_daily_summary(meal_since)
+        # user_activity 名冊游標分頁：一次只持有一頁 user_id，目標整頁一次算
+        for uid, targets in _iter_with_targets(db.iter_user_ids_for_daily_summary(meal_since)):
+            users += 1
+            try:
+                if notion.should_sync_line_user(uid):
+                    totals = db.get_daily_totals(uid, today_str)
+                    if totals.get("meal_count", 0) > 0:
+                        try:
+                            await asyncio.to_thread(
+                                notion.sync_daily_nutrition,
+                                today_str,
+                                {
+                                    **totals,
+                                    "carbs": 0.0,
+                                    "fat": 0.0,
+                                },
+                                float(targets["protein"]),
+                            )
+                        except Exception as ne:
+                            logger.error(
+                                "Notion 每日同步失敗（仍會推播 LINE）%s: %s",
+                                uid[:8],
+                                ne,
+                            )
+                summary = await handle_today_summary(uid, targets=targets)
+                await push_line_text_with_retry(uid, summary)
+                ok += 1
+                logger.info("已推播每日總結給 %s...", uid[:8])
+            except Exception as e:
+                fail += 1
+                logger.error("推播失敗 %s: %s", uid[:8], e)
     except Exception as e:
         logger.error("每日總結：讀取目標使用者失敗: %s", e, exc_info=True)
         return {
             "date": today_str,
-            "users": 0,
-            "pushed_ok": 0,
-            "pushed_fail": 0,
+            "users": users,
+            "pushed_ok": ok,
+            "pushed_fail": fail,
             "ok": False,
             "error": f"load_users_failed: {e}",
         }
-    ok, fail = 0, 0
-    notion = get_notion_sync()
-    logger.info("每日總結：預計推播 %s 位使用者", len(user_ids))
-    for uid in user_ids:
-        try:
-            if notion.should_sync_line_user(uid):
-                totals = db.get_daily_totals(uid, today_str)
-                if totals.get("meal_count", 0) > 0:
-                    targets = get_user_targets(uid)
-                    try:
-                        await asyncio.to_thread(
-                            notion.sync_daily_nutrition,
-                            today_str,
-                            {
-                                **totals,
-                                "carbs": 0.0,
-                                "fat": 0.0,
-                            },
-                            float(targets["protein"]),
-                        )
-                    except Exception as ne:
-                        logger.error(
-                            "Notion 每日同步失敗（仍會推播 LINE）%s: %s",
-                            uid[:8],
-                            ne,
-                        )
-            summary = await handle_today_summary(uid)
-            await push_line_text_with_retry(uid, summary)
-            ok += 1
-            logger.info("已推播每日總結給 %s...", uid[:8])
-        except Exception as e:
-            fail += 1
-            logger.error("推播失敗 %s: %s", uid[:8], e)
+    logger.info("每日總結：共 %s 位使用者（成功 %s／失敗 %s）", users, ok, fail)
     return {
         "date": today_str,
-        "users": len(user_ids),
+        "users": users,
         "pushed_ok": ok,
         "pushed_fail": fail,
         "ok": True,
@@ -2953,12 +3625,13 @@ async def execute_meal_reminder_push(slot: str) -> dict:
         text = "晚餐吃什麼～"
 
     meal_since = (local_date - timedelta(days=400)).isoformat()
-    user_ids = db.get_user_ids_for_meal_reminders(meal_since)
-    ok, skip, fail = 0, 0, 0
-    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-    async with AsyncApiClient(configuration) as api_client:
+    users, ok, skip, fail = 0, 0, 0, 0
+    from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, PushMessageRequest, TextMessage
+
+    async with AsyncApiClient(_line_configuration()) as api_client:
         line_api = AsyncMessagingApi(api_client)
-        for uid in user_ids:
+        for uid in db.iter_user_ids_for_meal_reminders(meal_since):
+            users += 1
             try:
                 if db.user_had_photo_in_utc_range(uid, start_iso, end_iso):
                     skip += 1
@@ -2991,7 +3664,7 @@ async def execute_meal_reminder_push(slot: str) -> dict:
     return {
         "slot": slot,
         "date": local_date_s,
-        "users": len(user_ids),
+        "users": users,
         "pushed_ok": ok,
         "skipped": skip,
         "pushed_fail": fail,
@@ -3046,27 +3719,112 @@ async def daily_summary_job_internal():
 # FastAPI 應用
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """應用生命週期：初始化 DB；可選內建當地 22:00 總結與用餐提醒排程。"""
-    db.init()
-    bg_tasks: list[asyncio.Task] = []
+_db_init_task: asyncio.Task | None = None
+
+
+async def _run_db_init():
+    with startup_profile.step("db_init"):
+        await asyncio.to_thread(db.init)
+    startup_profile.mark("db_ready")
+
+
+def _start_db_init() -> asyncio.Task:
+    """啟動（或在上次失敗後重新啟動）背景 DB 初始化。"""
+    global _db_init_task
+    t = _db_init_task
+    if t is None or t.cancelled() or (t.done() and t.exception() is not None):
+        _db_init_task = asyncio.create_task(_run_db_init())
+    return _db_init_task
+
+
+async def ensure_db_ready():
+    """webhook／cron 讀寫 DB 前呼叫；初始化未完成時在此等待，失敗則拋出（下次呼叫會重試）。"""
+    await asyncio.shield(_start_db_init())
+
+
+async def _deferred_startup(bg_tasks: list[asyncio.Task]):
+    """非關鍵初始化：DB 就緒後才啟動排程，並在背景預載 Notion 資料庫欄位。"""
+    try:
+        await ensure_db_ready()
+    except Exception:
+        logger.exception("DB 背景初始化失敗，進程內排程未啟動")
+        return
     if os.getenv("ENABLE_INTERNAL_DAILY_CRON") == "1":
         bg_tasks.append(asyncio.create_task(daily_summary_job_internal()))
         logger.info("已啟用進程內每日總結（BOT_TIMEZONE 22:00）")
     if os.getenv("ENABLE_INTERNAL_MEAL_REMINDERS", "1") != "0":
         bg_tasks.append(asyncio.create_task(meal_reminder_job_internal()))
         logger.info("已啟用進程內用餐提醒（13:00／20:30，BOT_TIMEZONE）")
-    logger.info("Bot 啟動完成")
+    if SCORE_CARD_REFRESH_SEC > 0:
+        bg_tasks.append(asyncio.create_task(score_card_refresher()))
+    try:
+        with startup_profile.step("line_sdk_preload"):
+            await asyncio.to_thread(preload_line_sdk)
+    except Exception as e:
+        logger.warning("LINE SDK 預載失敗：%s", e)
+    try:
+        with startup_profile.step("notion_warm_up"):
+            await asyncio.to_thread(lambda: get_notion_sync().warm_up())
+    except Exception as e:
+        logger.warning("Notion 預載失敗（首次同步時會再試）：%s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    應用生命週期：DB 初始化改在背景執行，不阻塞接收 webhook（處理前以 ensure_db_ready 等待）；
+    排程與 Notion 預載延後到 DB 就緒後；ack-first 模式下開始以背景處理線接收 webhook 事件。
+    """
+    bg_tasks: list[asyncio.Task] = []
+    _start_db_init()
+    if WEBHOOK_ACK_FIRST:
+        start_webhook_lanes()
+    bg_tasks.append(asyncio.create_task(_deferred_startup(bg_tasks)))
+    startup_profile.log_ready()
     yield
+    pending = stop_webhook_lanes()
+    if pending:
+        logger.warning("關閉時仍有 %s 個 webhook 事件未處理", pending)
+    await close_shared_line_api()
+    if openai_telemetry.pending():
+        await flush_openai_telemetry()
     for t in bg_tasks:
         t.cancel()
+    await asyncio.to_thread(db.close)
 
 
 app = FastAPI(title="Diet Tracker LINE Bot", lifespan=lifespan)
 
-parser = WebhookParser(LINE_CHANNEL_SECRET)
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+_line_parser = None
+_line_config = None
+
+
+def _webhook_parser():
+    global _line_parser
+    if _line_parser is None:
+        from linebot.v3 import WebhookParser
+
+        _line_parser = WebhookParser(LINE_CHANNEL_SECRET)
+    return _line_parser
+
+
+def _line_configuration():
+    global _line_config
+    if _line_config is None:
+        from linebot.v3.messaging import Configuration
+
+        _line_config = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+    return _line_config
+
+
+def preload_line_sdk():
+    """於背景執行緒預先匯入 LINE SDK，讓第一則 webhook 不必等待匯入。"""
+    import httpx  # noqa: F401
+    import linebot.v3.messaging  # noqa: F401
+    import linebot.v3.webhooks  # noqa: F401
+
+    _webhook_parser()
+    _line_configuration()
 
 
 def truncate_line_text(text: str) -> str:
@@ -3080,11 +3838,13 @@ async def push_line_text(user_id: str, text: str):
 
     先試 LINE SDK；失敗則改用 httpx 直打 REST，並把錯誤本文寫入 log。
     """
+    import httpx
+    from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, PushMessageRequest, TextMessage
+
     text = truncate_line_text(text)
     last_err: Exception | None = None
     try:
-        cfg = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-        async with AsyncApiClient(cfg) as api_client:
+        async with AsyncApiClient(_line_configuration()) as api_client:
             api = AsyncMessagingApi(api_client)
             await api.push_message(
                 PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
@@ -3146,16 +3906,17 @@ async def _analyze_image_by_state(
     user_note: str = "",
     force_scale: bool = False,
     image_b64: str | None = None,
+    deadline: float | None = None,
 ) -> str:
     if state_at_receive == UserState.WAITING_PURCHASE_PHOTO:
-        return await handle_purchase_query_photo(user_id, message_id)
+        return await handle_purchase_query_photo(user_id, message_id, deadline=deadline)
     if state_at_receive in (
         UserState.WAITING_INBODY_PHOTO,
         UserState.ONBOARDING_WAITING_GOAL,
     ):
-        return await handle_inbody_photo(user_id, message_id)
+        return await handle_inbody_photo(user_id, message_id, deadline=deadline)
     if await asyncio.to_thread(db.needs_inbody, user_id):
-        return await handle_inbody_photo(user_id, message_id)
+        return await handle_inbody_photo(user_id, message_id, deadline=deadline)
     if not await asyncio.to_thread(db.is_onboarded, user_id):
         return ONBOARDING_BLOCKED_TEXT
     return await handle_meal_photo(
@@ -3164,14 +3925,124 @@ async def _analyze_image_by_state(
         user_note=user_note,
         force_scale=force_scale,
         image_b64=image_b64,
+        deadline=deadline,
+    )
+
+
+class _DeferredPhoto(NamedTuple):
+    user_id: str
+    message_id: str
+    state_at_receive: str
+    user_note: str
+    force_scale: bool
+    image_b64: str | None
+    queued_at: float  # loop.time()
+
+
+# OpenAI 熔斷時先收下照片，恢復後依序補分析並推播（僅存記憶體，重啟即失）
+PHOTO_RETRY_QUEUE_MAX = max(0, int(os.getenv("PHOTO_RETRY_QUEUE_MAX", "20")))
+PHOTO_RETRY_TTL_SEC = float(os.getenv("PHOTO_RETRY_TTL_SEC", "1800"))
+_deferred_photos: deque[_DeferredPhoto] = deque()
+_deferred_photo_task: asyncio.Task | None = None
+
+
+async def _analyze_image_to_text(job: _DeferredPhoto, analyze_timeout: float) -> str:
+    """跑一次圖片分析，把可預期的錯誤轉成推播文字；熔斷與取消照常往外拋。"""
+    # 截止時間往下傳：OpenAI 重試不會超過整體預算
+    deadline = asyncio.get_running_loop().time() + analyze_timeout
+    try:
+        body = await asyncio.wait_for(
+            _analyze_image_by_state(
+                job.user_id, job.message_id, job.state_at_receive,
+                user_note=job.user_note, force_scale=job.force_scale,
+                image_b64=job.image_b64, deadline=deadline,
+            ),
+            timeout=analyze_timeout,
+        )
+        logger.info(
+            "圖片分析完成 user=%s msg=%s chars=%s",
+            job.user_id[:8], job.message_id, len(body or ""),
+        )
+    except asyncio.TimeoutError:
+        logger.error("圖片分析逾時 user=%s msg=%s", job.user_id[:8], job.message_id)
+        body = (
+            "本次圖片分析耗時過長，已自動中止。\n"
+            "請重新傳一次照片（盡量清晰、只拍重點），我會立即重跑。"
+        )
+    except OpenAIUnavailableError:
+        raise
+    except UserFacingError as e:
+        logger.warning(
+            "圖片分析可恢復錯誤 user=%s msg=%s err=%s",
+            job.user_id[:8], job.message_id, e,
+        )
+        body = str(e)
+    except Exception as e:
+        logger.error("背景圖片分析失敗: %s", e, exc_info=True)
+        body = "分析過程發生錯誤，請稍後再試或重新傳送照片。"
+
+    if not (body or "").strip():
+        body = "分析完成但未產生結果，請重新傳送照片。"
+    return body
+
+
+def _defer_photo_analysis(job: _DeferredPhoto, err: OpenAIUnavailableError) -> str:
+    """熔斷中：照片排入補分析佇列並回傳給使用者的說明；佇列已滿則直接回錯誤。"""
+    global _deferred_photo_task
+    if len(_deferred_photos) >= PHOTO_RETRY_QUEUE_MAX:
+        logger.warning("補分析佇列已滿，略過 user=%s msg=%s", job.user_id[:8], job.message_id)
+        return f"{err}\n\n請稍後重新傳送照片。"
+    _deferred_photos.append(job)
+    logger.info(
+        "OpenAI 熔斷中，照片排入補分析 user=%s msg=%s queued=%s",
+        job.user_id[:8], job.message_id, len(_deferred_photos),
+    )
+    if _deferred_photo_task is None or _deferred_photo_task.done():
+        _deferred_photo_task = spawn_background_job(_drain_deferred_photos())
+    minutes = max(1, math.ceil(err.retry_after / 60))
+    return (
+        "AI 服務暫時無法連線，這張照片已先收下，"
+        f"約 {minutes} 分鐘後服務恢復會自動分析並推播結果，不用重傳。"
     )
 
 
+async def _drain_deferred_photos() -> None:
+    """等熔斷器放行後依序補分析；試探仍失敗就放回隊首再等下一輪。"""
+    loop = asyncio.get_running_loop()
+    analyze_timeout = float(os.getenv("IMAGE_ANALYSIS_TIMEOUT_SEC", "150"))
+    while _deferred_photos:
+        wait = openai_circuit.retry_after()
+        if wait > 0:
+            await asyncio.sleep(wait + 0.5)
+            continue
+        job = _deferred_photos.popleft()
+        if loop.time() - job.queued_at > PHOTO_RETRY_TTL_SEC:
+            body = "AI 服務停擺過久，先前排隊的照片已取消分析，請重新傳送。"
+        else:
+            user_lock = await _user_analysis_lock(job.user_id)
+            try:
+                async with user_lock, _image_analysis_semaphore():
+                    body = await _analyze_image_to_text(job, analyze_timeout)
+            except OpenAIUnavailableError as e:
+                _deferred_photos.appendleft(job)
+                await asyncio.sleep(max(1.0, e.retry_after))
+                continue
+        try:
+            await push_line_text_with_retry(job.user_id, body, attempts=3)
+            logger.info("補分析結果已推送 user=%s msg=%s", job.user_id[:8], job.message_id)
+        except Exception as e:
+            logger.error(
+                "補分析 Push 失敗 user=%s msg=%s: %s",
+                job.user_id[:8], job.message_id, e, exc_info=True,
+            )
+
+
 async def run_image_analysis_and_push(user_id: str, message_id: str, state_at_receive: str):
     """背景執行：下載、壓縮、Vision、寫入 DB，完成後 push 結果。
 
     圖片下載與備註等待並行；其他指令可提早結束備註等待。
     分析結果一律走 Push（reply_token 已在「分析中」用掉）。
+    OpenAI 熔斷中時不等逾時，照片排入補分析佇列並立即告知使用者。
     """
     analyze_timeout = float(os.getenv("IMAGE_ANALYSIS_TIMEOUT_SEC", "150"))
     note_wait_sec = _photo_note_window_sec()
@@ -3258,25 +4129,14 @@ async def run_image_analysis_and_push(user_id: str, message_id: str, state_at_re
                     bool(user_note),
                     bool(image_b64),
                 )
+                job = _DeferredPhoto(
+                    user_id, message_id, state_at_receive, user_note, force_scale,
+                    image_b64, asyncio.get_running_loop().time(),
+                )
                 try:
-                    body = await asyncio.wait_for(
-                        _analyze_image_by_state(
-                            user_id, message_id, state_at_receive,
-                            user_note=user_note, force_scale=force_scale,
-                            image_b64=image_b64,
-                        ),
-                        timeout=analyze_timeout,
-                    )
-                    logger.info(
-                        "圖片分析完成 user=%s msg=%s chars=%s",
-                        user_id[:8], message_id, len(body or ""),
-                    )
-                except asyncio.TimeoutError:
-                    logger.error("圖片分析逾時 user=%s msg=%s", user_id[:8], message_id)
-                    body = (
-                        "本次圖片分析耗時過長，已自動中止。\n"
-                        "請重新傳一次照片（盡量清晰、只拍重點），我會立即重跑。"
-                    )
+                    body = await _analyze_image_to_text(job, analyze_timeout)
+                except OpenAIUnavailableError as e:
+                    body = _defer_photo_analysis(job, e)
                 except asyncio.CancelledError:
                     logger.error("圖片分析任務被取消 user=%s msg=%s", user_id[:8], message_id)
                     body = "分析尚未完成（可能因服務重啟），請重新傳送照片。"
@@ -3288,18 +4148,7 @@ async def run_image_analysis_and_push(user_id: str, message_id: str, state_at_re
                             user_id[:8], message_id, push_err,
                         )
                     raise
-                except UserFacingError as e:
-                    logger.warning(
-                        "圖片分析可恢復錯誤 user=%s msg=%s err=%s",
-                        user_id[:8], message_id, e,
-                    )
-                    body = str(e)
-                except Exception as e:
-                    logger.error("背景圖片分析失敗: %s", e, exc_info=True)
-                    body = "分析過程發生錯誤，請稍後再試或重新傳送照片。"
 
-                if not (body or "").strip():
-                    body = "分析完成但未產生結果，請重新傳送照片。"
                 try:
                     await _safe_push(body, attempts=3)
                     logger.info("圖片分析結果已推送 user=%s msg=%s", user_id[:8], message_id)
@@ -3344,6 +4193,8 @@ HELP_TEXT = (
     "  「今日」：查看今日總結\n"
     "  「清除今日」：刪除今日所有紀錄\n"
     "  「本週積分」「週報」「積分卡」等：本週飲食成績\n"
+    "  「報表」「報表 90」：近 28 天（或指定天數）的達標、偏差與連續紀錄\n"
+    "  「月報」：本月與上月同期比較\n"
     "  「設定蛋白飲 熱量 蛋白質」：自訂快速記錄數值（例：設定蛋白飲 130 25）\n"
     "  「Notion狀態」：檢查目前是否會同步到 Notion\n"
     "  「我的ID」：顯示你的 LINE userId（可用於比對 NOTION_SYNC_USER_ID）\n"
@@ -3371,132 +4222,662 @@ HELP_TEXT = (
 )
 
 
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# Webhook：先回 200，再依使用者分流於背景處理事件
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+# 1（預設）：驗簽後即回 200，事件於背景處理；0：沿用在請求內處理完才回應
+WEBHOOK_ACK_FIRST = (os.getenv("WEBHOOK_ACK_FIRST") or "1").strip().lower() not in ("0", "false", "no", "off")
+# 同時處理中的事件上限（跨使用者）；同一使用者永遠依序處理
+WEBHOOK_USER_CONCURRENCY = max(1, int(os.getenv("WEBHOOK_USER_CONCURRENCY", "8")))
+# 積壓事件數達此上限後，webhook 請求會等到本批事件所在的處理線消化完才回應（背壓）
+WEBHOOK_QUEUE_MAX = max(1, int(os.getenv("WEBHOOK_QUEUE_MAX", "1000")))
+# 自收到 webhook 起超過此秒數即不再嘗試 reply（token 可能已失效），直接改用 push
+LINE_REPLY_TOKEN_TTL_SEC = float(os.getenv("LINE_REPLY_TOKEN_TTL_SEC", "50"))
+
+# 每位使用者一條處理線（FIFO）；線上有事件時由一個 task 依序消化，清空即移除
+_webhook_lanes: dict[str, deque] = {}
+_webhook_lane_tasks: dict[str, asyncio.Task] = {}
+_webhook_pending = 0
+_webhook_accepting = False
+_webhook_event_sem: asyncio.Semaphore | None = None
+
+# LINE 逾時或收到非 2xx 時會以相同 webhookEventId 重送（deliveryContext.isRedelivery）
+WEBHOOK_DEDUP_TTL_SEC = float(os.getenv("WEBHOOK_DEDUP_TTL_SEC", "86400"))
+WEBHOOK_DEDUP_MAX = max(100, int(os.getenv("WEBHOOK_DEDUP_MAX", "10000")))
+_WEBHOOK_DEDUP_PRUNE_EVERY_SEC = 3600.0
+
+
+class _RecentEventIds:
+    """有上限、依時間過期的事件 ID 集合（程序內第一層去重，不需 DB）。"""
+
+    def __init__(self, ttl_sec: float, max_size: int):
+        self._ttl = ttl_sec
+        self._max = max_size
+        self._seen: OrderedDict[str, float] = OrderedDict()
+
+    def add_if_new(self, event_id: str, now: float) -> bool:
+        while self._seen:
+            _oldest, ts = next(iter(self._seen.items()))
+            if now - ts < self._ttl and len(self._seen) < self._max:
+                break
+            self._seen.popitem(last=False)
+        if event_id in self._seen:
+            return False
+        self._seen[event_id] = now
+        return True
+
+
+_recent_webhook_events = _RecentEventIds(WEBHOOK_DEDUP_TTL_SEC, WEBHOOK_DEDUP_MAX)
+_webhook_dedup_stats = {"memory": 0, "db": 0, "redelivered": 0, "db_errors": 0}
+_webhook_dedup_last_prune = 0.0
+
+
+def _webhook_event_id(event) -> str | None:
+    return getattr(event, "webhook_event_id", None) or None
+
+
+def _seen_webhook_event_recently(event, now: float) -> bool:
+    """程序內去重：同一 webhookEventId 在時間窗內第二次出現即視為重複。"""
+    event_id = _webhook_event_id(event)
+    ctx = getattr(event, "delivery_context", None)
+    if ctx is not None and getattr(ctx, "is_redelivery", False):
+        _webhook_dedup_stats["redelivered"] += 1
+    if not event_id:
+        return False
+    if _recent_webhook_events.add_if_new(event_id, now):
+        return False
+    _webhook_dedup_stats["memory"] += 1
+    logger.info("略過重複 webhook 事件（程序內）id=%s", event_id)
+    return True
+
+
+def _claim_webhook_event(event) -> bool:
+    """跨程序去重：以 DB 主鍵搶佔 webhookEventId；其他程序已處理過則回傳 False。"""
+    global _webhook_dedup_last_prune
+    event_id = _webhook_event_id(event)
+    if not event_id:
+        return True
+    now_utc = datetime.now(timezone.utc)
+    try:
+        claimed = db.claim_webhook_event(event_id, now_utc.isoformat())
+    except Exception as e:
+        # 去重失敗不應擋住正常訊息，寧可偶爾重複處理
+        _webhook_dedup_stats["db_errors"] += 1
+        logger.warning("webhook 去重寫入失敗（照常處理）: %s", e)
+        return True
+    if not claimed:
+        _webhook_dedup_stats["db"] += 1
+        logger.info("略過重複 webhook 事件（DB）id=%s", event_id)
+        return False
+    mono = asyncio.get_running_loop().time()
+    if mono - _webhook_dedup_last_prune >= _WEBHOOK_DEDUP_PRUNE_EVERY_SEC:
+        _webhook_dedup_last_prune = mono
+        cutoff = (now_utc - timedelta(seconds=WEBHOOK_DEDUP_TTL_SEC)).isoformat()
+        spawn_background_job(asyncio.to_thread(db.prune_webhook_events, cutoff))
+    return True
+
+
+def _webhook_event_semaphore() -> asyncio.Semaphore:
+    global _webhook_event_sem
+    if _webhook_event_sem is None:
+        _webhook_event_sem = asyncio.Semaphore(WEBHOOK_USER_CONCURRENCY)
+    return _webhook_event_sem
+
+
+def _webhook_event_user(event) -> str:
+    return getattr(getattr(event, "source", None), "user_id", None) or ""
+
+
+_line_api_client = None
+_line_messaging_api = None
+
+
+def _shared_line_api():
+    """webhook 共用一個 LINE API client（每次新建約 40 ms 同步 SSL 初始化，會卡住事件迴圈）。"""
+    global _line_api_client, _line_messaging_api
+    if _line_messaging_api is None:
+        from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi
+
+        _line_api_client = AsyncApiClient(_line_configuration())
+        _line_messaging_api = AsyncMessagingApi(_line_api_client)
+    return _line_messaging_api
+
+
+async def close_shared_line_api():
+    global _line_api_client, _line_messaging_api
+    client, _line_api_client, _line_messaging_api = _line_api_client, None, None
+    if client is not None:
+        await client.close()
+
+
+async def _handle_webhook_event_limited(event, received_at: float):
+    """在全域併發上限內處理單一事件；例外只記錄，不中斷該使用者後續事件。"""
+    async with _webhook_event_semaphore():
+        try:
+            await ensure_db_ready()
+            await handle_webhook_event(_shared_line_api(), event, received_at)
+        except Exception:
+            logger.exception("webhook 事件處理失敗 user=%s", _webhook_event_user(event)[:8])
+
+
+async def process_webhook_events(events, received_at: float):
+    """依 source.user_id 分組：不同使用者並行、同一使用者依原順序處理（請求內模式）。"""
+    by_user: dict[str, list] = {}
+    for event in events:
+        by_user.setdefault(_webhook_event_user(event), []).append(event)
+
+    async def run_user(user_events: list):
+        for event in user_events:
+            await _handle_webhook_event_limited(event, received_at)
+
+    await asyncio.gather(*(run_user(evs) for evs in by_user.values()))
+
+
+def start_webhook_lanes():
+    global _webhook_accepting
+    _webhook_accepting = True
+    logger.info("Webhook ack-first 模式：同時處理上限 %s", WEBHOOK_USER_CONCURRENCY)
+
+
+def stop_webhook_lanes() -> int:
+    """停止接收新事件，回傳尚未處理的事件數。"""
+    global _webhook_accepting
+    _webhook_accepting = False
+    return _webhook_pending
+
+
+def _enqueue_webhook_event(event, received_at: float) -> asyncio.Task | None:
+    """放入該使用者的處理線，回傳消化該線的 task。
+
+    該使用者已有處理線時一律排在後面（即使已停止接收或積壓超過上限），確保同一使用者依序處理；
+    未啟用 ack-first 且沒有處理線時回傳 None，由呼叫端於請求內處理。
+    """
+    global _webhook_pending
+    key = _webhook_event_user(event)
+    lane = _webhook_lanes.get(key)
+    if lane is None and not _webhook_accepting:
+        return None
+    _webhook_pending += 1
+    if lane is not None:
+        lane.append((event, received_at))
+        return _webhook_lane_tasks[key]
+    lane = deque([(event, received_at)])
+    _webhook_lanes[key] = lane
+    task = spawn_background_job(_drain_webhook_lane(key, lane))
+    _webhook_lane_tasks[key] = task
+    return task
+
+
+async def _drain_webhook_lane(key: str, lane: deque):
+    global _webhook_pending
+    try:
+        while lane:
+            event, received_at = lane.popleft()
+            _webhook_pending -= 1
+            await _handle_webhook_event_limited(event, received_at)
+    finally:
+        if _webhook_lanes.get(key) is lane:
+            del _webhook_lanes[key]
+            _webhook_lane_tasks.pop(key, None)
+
+
+async def dispatch_webhook_events(events, received_at: float):
+    """去重後把事件排入各使用者的處理線。
+
+    積壓達 WEBHOOK_QUEUE_MAX 時仍排入處理線（不改在請求內另外處理，以免同一使用者的新訊息
+    跑在舊訊息之前），但請求會等這些處理線消化完才回應，以延長回應時間作為背壓。
+    """
+    inline = []
+    backlogged: set[asyncio.Task] = set()
+    for event in events:
+        if _seen_webhook_event_recently(event, received_at):
+            continue
+        over_cap = _webhook_pending >= WEBHOOK_QUEUE_MAX
+        task = _enqueue_webhook_event(event, received_at)
+        if task is None:
+            inline.append(event)
+        elif over_cap:
+            backlogged.add(task)
+    if backlogged:
+        logger.warning("webhook 背景積壓已達上限，等待 %s 條處理線消化後才回應", len(backlogged))
+        await asyncio.wait(backlogged)
+    if inline:
+        await process_webhook_events(inline, received_at)
+
+
+async def send_event_reply(line_api, user_id: str, reply_token: str | None, text: str, received_at: float):
+    """回覆事件：reply token 仍在效期內先試 reply，失敗或逾時改以 push 傳送。"""
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+
+    text = truncate_line_text(text)
+    elapsed = asyncio.get_running_loop().time() - received_at
+    if reply_token and elapsed < LINE_REPLY_TOKEN_TTL_SEC:
+        try:
+            await line_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text=text)],
+                )
+            )
+            return
+        except Exception as e:
+            logger.warning(
+                "reply_message 失敗（常見於 Reply Token 過期或主機冷啟動過慢）: %s，改以 push 傳送",
+                e,
+            )
+    else:
+        logger.info("處理耗時 %.1f 秒，略過 reply 改以 push 傳送 user=%s", elapsed, user_id[:8])
+    try:
+        await push_line_text(user_id, text)
+    except Exception as e2:
+        logger.error("push 備援亦失敗: %s", e2, exc_info=True)
+
+
+async def handle_webhook_event(line_api, event, received_at: float):
+    """處理單一 LINE 事件（follow／訊息），結果以 reply 或 push 回覆。"""
+    from linebot.v3.webhooks import FollowEvent, ImageMessageContent, MessageEvent, TextMessageContent
+
+    if not _claim_webhook_event(event):
+        return
+
+    if isinstance(event, FollowEvent):
+        user_id = event.source.user_id
+        logger.info("新使用者加入好友 user=%s", user_id[:8])
+        await send_event_reply(line_api, user_id, event.reply_token, ONBOARDING_WELCOME_TEXT, received_at)
+        return
+
+    if not isinstance(event, MessageEvent):
+        return
+
+    user_id = event.source.user_id
+    if isinstance(event.message, ImageMessageContent):
+        msg_kind = "image"
+    elif isinstance(event.message, TextMessageContent):
+        msg_kind = "text"
+    else:
+        msg_kind = "other"
+    try:
+        db.log_line_message(
+            user_id,
+            datetime.now(timezone.utc).isoformat(),
+            message_kind=msg_kind,
+        )
+    except Exception as e:
+        logger.warning("log_line_message 失敗（略過）: %s", e)
+
+    reply_token = event.reply_token
+    state = get_state(user_id)
+
+    try:
+        if isinstance(event.message, ImageMessageContent):
+            logger.info(
+                "收到圖片訊息 user=%s msg=%s state=%s",
+                user_id[:8],
+                event.message.id,
+                state,
+            )
+            reply_text = "已收到照片，正在分析中…"
+            snap_state = get_state(user_id)
+            needs_inbody = db.needs_inbody(user_id)
+            if snap_state in (
+                UserState.WAITING_INBODY_PHOTO,
+                UserState.ONBOARDING_WAITING_GOAL,
+            ) or needs_inbody:
+                reply_text = "已收到 InBody 照片，正在分析中…"
+            user_lock = _user_analysis_locks.get(user_id)
+            if (
+                user_lock is not None
+                and user_lock.locked()
+                and snap_state not in (
+                    UserState.WAITING_PURCHASE_PHOTO,
+                    UserState.WAITING_INBODY_PHOTO,
+                )
+                and not needs_inbody
+            ):
+                reply_text = (
+                    "已收到照片，已排入分析佇列"
+                    "（前一張仍在處理，完成後會依序回覆）。"
+                )
+            if snap_state not in (
+                UserState.WAITING_PURCHASE_PHOTO,
+                UserState.WAITING_INBODY_PHOTO,
+            ) and not needs_inbody:
+                await create_pending_note_window(
+                    user_id, event.message.id, window_sec=_photo_note_window_sec(),
+                )
+            # 用獨立 Task，不依賴 BackgroundTasks（長分析才穩）
+            spawn_background_job(
+                run_image_analysis_and_push(
+                    user_id,
+                    event.message.id,
+                    snap_state,
+                )
+            )
+        else:
+            reply_text = await route_message(event, user_id, state)
+    except UserFacingError as e:
+        logger.warning("處理訊息可恢復錯誤 user=%s: %s", user_id[:8], e)
+        reply_text = str(e)
+    except Exception as e:
+        logger.error(f"處理訊息失敗: {e}", exc_info=True)
+        reply_text = "處理時發生錯誤，請稍後再試。"
+
+    if reply_text:
+        await send_event_reply(line_api, user_id, reply_token, reply_text, received_at)
+
+
 @app.post("/webhook")
 async def webhook(request: Request, background_tasks: BackgroundTasks):
+    received_at = asyncio.get_running_loop().time()
     signature = request.headers.get("X-Line-Signature", "")
     body = (await request.body()).decode("utf-8")
 
+    from linebot.v3.exceptions import InvalidSignatureError
+
     try:
-        events = parser.parse(body, signature)
+        events = _webhook_parser().parse(body, signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    async with AsyncApiClient(configuration) as api_client:
-        line_api = AsyncMessagingApi(api_client)
+    await dispatch_webhook_events(events, received_at)
+    return JSONResponse(content={"status": "ok"})
 
-        for event in events:
-            if isinstance(event, FollowEvent):
-                user_id = event.source.user_id
-                logger.info("新使用者加入好友 user=%s", user_id[:8])
-                welcome = truncate_line_text(ONBOARDING_WELCOME_TEXT)
-                try:
-                    await line_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=welcome)],
-                        )
-                    )
-                except Exception as e:
-                    logger.warning("Follow 歡迎訊息 reply 失敗: %s", e)
-                continue
 
-            if not isinstance(event, MessageEvent):
-                continue
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 文字指令表
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-            user_id = event.source.user_id
-            if isinstance(event.message, ImageMessageContent):
-                msg_kind = "image"
-            elif isinstance(event.message, TextMessageContent):
-                msg_kind = "text"
-            else:
-                msg_kind = "other"
-            try:
-                db.log_line_message(
-                    user_id,
-                    datetime.now(timezone.utc).isoformat(),
-                    message_kind=msg_kind,
-                )
-            except Exception as e:
-                logger.warning("log_line_message 失敗（略過）: %s", e)
 
-            reply_token = event.reply_token
-            state = get_state(user_id)
+class CommandSpec(NamedTuple):
+    handler: Callable[[str, str], Awaitable[str]]  # (user_id, text) -> 回覆
+    requires_onboarding: bool = True  # 未完成 onboarding 時先擋下
+    leaves_photo_wait: bool = True  # 執行前離開「等待傳照」狀態
 
-            try:
-                if isinstance(event.message, ImageMessageContent):
-                    logger.info(
-                        "收到圖片訊息 user=%s msg=%s state=%s",
-                        user_id[:8],
-                        event.message.id,
-                        state,
-                    )
-                    reply_text = "已收到照片，正在分析中…"
-                    snap_state = get_state(user_id)
-                    if snap_state in (
-                        UserState.WAITING_INBODY_PHOTO,
-                        UserState.ONBOARDING_WAITING_GOAL,
-                    ) or db.needs_inbody(user_id):
-                        reply_text = "已收到 InBody 照片，正在分析中…"
-                    user_lock = _user_analysis_locks.get(user_id)
-                    if (
-                        user_lock is not None
-                        and user_lock.locked()
-                        and snap_state not in (
-                            UserState.WAITING_PURCHASE_PHOTO,
-                            UserState.WAITING_INBODY_PHOTO,
-                        )
-                        and not db.needs_inbody(user_id)
-                    ):
-                        reply_text = (
-                            "已收到照片，已排入分析佇列"
-                            "（前一張仍在處理，完成後會依序回覆）。"
-                        )
-                    if snap_state not in (
-                        UserState.WAITING_PURCHASE_PHOTO,
-                        UserState.WAITING_INBODY_PHOTO,
-                    ) and not db.needs_inbody(user_id):
-                        await create_pending_note_window(
-                            user_id, event.message.id, window_sec=_photo_note_window_sec(),
-                        )
-                    # 用獨立 Task，不依賴 BackgroundTasks（長分析才穩）
-                    spawn_background_job(
-                        run_image_analysis_and_push(
-                            user_id,
-                            event.message.id,
-                            snap_state,
-                        )
-                    )
-                else:
-                    reply_text = await route_message(event, user_id, state)
-            except Exception as e:
-                logger.error(f"處理訊息失敗: {e}", exc_info=True)
-                reply_text = "處理時發生錯誤，請稍後再試。"
 
-            if reply_text:
-                reply_text = truncate_line_text(reply_text)
+async def _cmd_help(user_id: str, text: str) -> str:
+    return HELP_TEXT
 
-                try:
-                    await line_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-                except Exception as e:
-                    logger.warning(
-                        "reply_message 失敗（常見於 Reply Token 過期或主機冷啟動過慢）: %s，改以 push 傳送",
-                        e,
-                    )
-                    try:
-                        await push_line_text(user_id, reply_text)
-                    except Exception as e2:
-                        logger.error("push 備援亦失敗: %s", e2, exc_info=True)
 
-    return JSONResponse(content={"status": "ok"})
+async def _cmd_jitai_on(user_id: str, text: str) -> str:
+    return handle_jitai_toggle(user_id, True)
+
+
+async def _cmd_jitai_off(user_id: str, text: str) -> str:
+    return handle_jitai_toggle(user_id, False)
+
+
+async def _cmd_jitai_status(user_id: str, text: str) -> str:
+    return handle_jitai_status(user_id)
+
+
+async def _cmd_today(user_id: str, text: str) -> str:
+    return await handle_today_summary(user_id)
+
+
+async def _cmd_my_id(user_id: str, text: str) -> str:
+    return f"你的 LINE userId：\n{user_id}"
+
+
+async def _cmd_test_push(user_id: str, text: str) -> str:
+    try:
+        await push_line_text(user_id, "推播測試成功：這則是用 Push API 送出的。")
+        return "Reply 正常。Push 測試也已送出；若你有收到上一則「推播測試成功」，代表分析結果推播通道正常。"
+    except Exception as e:
+        logger.error("測試推播失敗 user=%s: %s", user_id[:8], e, exc_info=True)
+        err = str(e)
+        quota_hint = ""
+        if "429" in err or "Too Many Requests" in err:
+            quota_hint = (
+                "\n\n這通常是 LINE 免費方案本月訊息額度用完（常見 200/200），"
+                "不是 Bot 程式壞掉。請到 LINE Official Account Manager 看「訊息用量」，"
+                "下個月重置後會恢復，或升級／加購訊息方案。"
+            )
+        return (
+            "Reply 正常，但 Push 失敗（餐點分析結果走 Push，所以會收不到）。\n"
+            f"錯誤：{type(e).__name__}: {e}"
+            f"{quota_hint}"
+        )
+
+
+async def _cmd_notion_status(user_id: str, text: str) -> str:
+    notion = get_notion_sync()
+    sync_ok = notion.should_sync_line_user(user_id)
+    uid_set = "已設定" if notion.sync_user_id else "未設定"
+    uid_match = "符合" if sync_ok else "不符合"
+    return (
+        "Notion 同步檢查\n"
+        "--------------------\n"
+        f"Notion 啟用：{'是' if notion.enabled else '否'}\n"
+        f"NOTION_SYNC_USER_ID：{uid_set}\n"
+        f"目前 userId 是否可同步：{uid_match}\n\n"
+        "若顯示不符合，請先傳「我的ID」，並把該值填入 Render 的 NOTION_SYNC_USER_ID。"
+    )
+
+
+async def _cmd_clear_today(user_id: str, text: str) -> str:
+    today_str = date.today().isoformat()
+    count = db.clear_today(user_id, today_str)
+    return f"已清除今日 {count} 筆紀錄。"
+
+
+async def _cmd_set_quick_item(user_id: str, text: str) -> str:
+    return handle_set_quick_item(user_id, text)
+
+
+def _cmd_quick_item(item_name: str) -> Callable[[str, str], Awaitable[str]]:
+    async def handler(user_id: str, text: str) -> str:
+        return await handle_quick_protein(user_id, item_name)
+
+    return handler
+
+
+async def _cmd_purchase_query(user_id: str, text: str) -> str:
+    set_state(user_id, UserState.WAITING_PURCHASE_PHOTO)
+    return (
+        "購買前熱量查詢已啟動\n"
+        "-----\n"
+        "請拍攝食物或商品包裝照片傳送。\n"
+        "我會分析營養數據並給予等級評定。\n\n"
+        "輸入「取消」可結束查詢。"
+    )
+
+
+async def _cmd_weekly_score(user_id: str, text: str) -> str:
+    return await handle_weekly_score(user_id)
+
+
+async def _cmd_inbody_upload(user_id: str, text: str) -> str:
+    set_state(user_id, UserState.WAITING_INBODY_PHOTO)
+    return (
+        "InBody 上傳模式已啟動\n"
+        "-----\n"
+        "請拍攝或傳送 InBody 體組成報告照片。\n"
+        "我會自動辨識數據並更新你的營養目標。\n\n"
+        "輸入「取消」可結束。"
+    )
+
+
+async def _cmd_cheat_day(user_id: str, text: str) -> str:
+    return await handle_cheat_day(user_id)
+
+
+async def _cmd_force_cheat_day(user_id: str, text: str) -> str:
+    today_str = date.today().isoformat()
+    db.activate_cheat_day(user_id, today_str)
+    cheat_cal = get_daily_calorie_target(user_id, today_str)
+    return (
+        f"欺騙日已強制啟動\n"
+        f"今日熱量上限：{cheat_cal:.0f} kcal\n\n"
+        f"注意：頻繁使用欺騙日會影響整體進度。"
+    )
+
+
+async def _cmd_history_report(user_id: str, text: str) -> str:
+    m = re.search(r"\d+", text)
+    return await handle_history_report(user_id, int(m.group()) if m else REPORT_DEFAULT_DAYS)
+
+
+async def _cmd_monthly_report(user_id: str, text: str) -> str:
+    return await handle_monthly_report(user_id)
+
+
+async def _cmd_ai_coach(user_id: str, text: str) -> str:
+    return await handle_ai_coach(user_id)
+
+
+async def _cmd_targets(user_id: str, text: str) -> str:
+    targets = get_user_targets(user_id)
+    profile = db.get_user_profile(user_id)
+    goal_label = _profile_fitness_goal(profile)
+    offset = int((profile or {}).get("calorie_offset") or 0)
+    lines = [
+        "目前設定的目標",
+        "=" * 24,
+        f"健身目標：{goal_label}",
+        f"每日熱量：{targets['calories']:.0f} kcal",
+    ]
+    if profile and profile.get("weight") and offset:
+        base = _base_targets_from_profile(profile)["calories"]
+        sign = "+" if offset > 0 else ""
+        lines.append(f"  （公式 {base:.0f} {sign}{offset}）")
+    lines.append(f"每日蛋白質：{targets['protein']:.0f} g")
+    if profile:
+        lines.extend([
+            "",
+            "身體數據：",
+            f"  體重：{profile.get('weight', '?')} kg",
+            f"  體脂率：{profile.get('body_fat_percentage', '?')} %",
+            f"  上次 InBody：{profile.get('last_inbody_date', '未上傳')}",
+        ])
+    return "\n".join(lines)
+
+
+# 原文完全相符（不做正規化）
+_EXACT_COMMANDS: dict[str, CommandSpec] = {}
+# 以 _compact_command 正規化後相符（全半形、空白不拘）
+_COMPACT_COMMANDS: dict[str, CommandSpec] = {}
+
+
+def _register_commands(table: dict[str, CommandSpec], keys, spec: CommandSpec) -> None:
+    for key in keys:
+        if key in table:
+            raise ValueError(f"指令重複註冊：{key}")
+        table[key] = spec
+
+
+_register_commands(
+    _EXACT_COMMANDS, ("說明", "幫助", "help", "Help", "HELP"),
+    CommandSpec(_cmd_help, requires_onboarding=False),
+)
+_register_commands(
+    _EXACT_COMMANDS, ("我的ID", "我的id", "my id", "My ID", "userid", "user id"),
+    CommandSpec(_cmd_my_id, requires_onboarding=False),
+)
+_register_commands(_COMPACT_COMMANDS, JITAI_ON_COMMANDS, CommandSpec(_cmd_jitai_on))
+_register_commands(_COMPACT_COMMANDS, JITAI_OFF_COMMANDS, CommandSpec(_cmd_jitai_off))
+_register_commands(_COMPACT_COMMANDS, JITAI_STATUS_COMMANDS, CommandSpec(_cmd_jitai_status))
+_register_commands(
+    _EXACT_COMMANDS, ("今日", "今日總計", "今日總結", "總計", "今天"), CommandSpec(_cmd_today)
+)
+_register_commands(
+    _EXACT_COMMANDS, ("測試推播", "測試push", "測試 Push", "push測試"), CommandSpec(_cmd_test_push)
+)
+_register_commands(
+    _EXACT_COMMANDS,
+    ("Notion狀態", "notion狀態", "Notion 狀態", "notion status", "Notion status"),
+    CommandSpec(_cmd_notion_status),
+)
+_register_commands(_EXACT_COMMANDS, ("清除今日",), CommandSpec(_cmd_clear_today))
+_register_commands(
+    _EXACT_COMMANDS,
+    ("加蛋白飲", "蛋白飲", "+蛋白飲", "+蛋白", "＋蛋白飲", "＋蛋白"),
+    CommandSpec(_cmd_quick_item("蛋白飲")),
+)
+_register_commands(
+    _EXACT_COMMANDS, ("加雞蛋", "+雞蛋", "＋雞蛋"), CommandSpec(_cmd_quick_item("雞蛋"))
+)
+_register_commands(
+    _EXACT_COMMANDS, ("加雞胸肉", "+雞胸肉", "＋雞胸肉"), CommandSpec(_cmd_quick_item("雞胸肉"))
+)
+_register_commands(
+    _EXACT_COMMANDS,
+    ("加碳水", "加一份碳水", "碳水", "+碳水", "＋碳水", "加地瓜", "+地瓜", "＋地瓜"),
+    CommandSpec(_cmd_quick_item("碳水")),
+)
+# 進入「等待傳照」的指令本身不清除等待狀態
+_register_commands(
+    _EXACT_COMMANDS, ("購買查詢", "食物查詢", "查詢", "買之前"),
+    CommandSpec(_cmd_purchase_query, leaves_photo_wait=False),
+)
+_register_commands(
+    _EXACT_COMMANDS, ("本週積分", "積分", "積分卡", "本週", "週報"), CommandSpec(_cmd_weekly_score)
+)
+_register_commands(
+    _EXACT_COMMANDS, ("上傳InBody", "InBody", "inbody", "INBODY"),
+    CommandSpec(_cmd_inbody_upload, leaves_photo_wait=False),
+)
+_register_commands(
+    _EXACT_COMMANDS, ("欺騙日", "cheat day", "Cheat Day"), CommandSpec(_cmd_cheat_day)
+)
+_register_commands(_EXACT_COMMANDS, ("強制欺騙日",), CommandSpec(_cmd_force_cheat_day))
+_register_commands(
+    _EXACT_COMMANDS, ("AI教練", "教練", "ai教練", "AI 教練"), CommandSpec(_cmd_ai_coach)
+)
+_register_commands(_EXACT_COMMANDS, ("目標", "我的目標", "查看目標"), CommandSpec(_cmd_targets))
+_register_commands(
+    _EXACT_COMMANDS, ("月報", "月比較", "本月報表"), CommandSpec(_cmd_monthly_report)
+)
+
+# 前綴指令（原文 startswith）
+_PREFIX_COMMANDS: tuple[tuple[str, CommandSpec], ...] = (
+    ("設定蛋白飲", CommandSpec(_cmd_set_quick_item)),
+    ("報表", CommandSpec(_cmd_history_report)),
+)
 
 
-async def route_message(event: MessageEvent, user_id: str, state: str) -> str:
+def resolve_command(text: str, compact: str) -> CommandSpec | None:
+    spec = _EXACT_COMMANDS.get(text) or _COMPACT_COMMANDS.get(compact)
+    if spec is not None:
+        return spec
+    for prefix, prefix_spec in _PREFIX_COMMANDS:
+        if text.startswith(prefix):
+            return prefix_spec
+    return None
+
+
+def _onboarding_block_reply(user_id: str) -> str | None:
+    """未完成 onboarding 時回傳提示文字；已完成或可放行則回傳 None。"""
+    onboarding = db.onboarding_state(user_id)
+    if onboarding & OnboardingState.ONBOARDED:
+        return None
+    if not onboarding & OnboardingState.HAS_INBODY:
+        return ONBOARDING_NEED_INBODY_TEXT
+    return ONBOARDING_BLOCKED_TEXT
+
+
+def _handle_purchase_review_reply(user_id: str, text: str) -> str:
+    if text in ("買了", "確定", "購買"):
+        ctx = get_context(user_id)
+        db.save_purchase_decision(user_id, ctx, "purchased")
+        clear_state(user_id)
+        return (
+            f"已記錄購買：{ctx.get('name', '未知')}\n"
+            f"熱量 {ctx.get('calories', '?')} kcal 已計入今日統計。"
+        )
+    if text in ("不買", "取消", "放棄"):
+        ctx = get_context(user_id)
+        db.save_purchase_decision(user_id, ctx, "cancelled")
+        clear_state(user_id)
+        return "明智的選擇。繼續保持紀律。"
+    clear_state(user_id)
+    return "查詢已取消。"
+
+
+async def route_message(event: "MessageEvent", user_id: str, state: str) -> str:
     """路由訊息到對應的處理函數（圖片改由 webhook 立即回覆後於背景分析並 push）。"""
+    from linebot.v3.webhooks import ImageMessageContent, TextMessageContent
+
     if isinstance(event.message, ImageMessageContent):
         return ""
 
@@ -3513,182 +4894,29 @@ async def route_message(event: MessageEvent, user_id: str, state: str) -> str:
         # 非備註指令（如加蛋白飲）：結束備註等待，讓照片分析立刻開始
         await release_pending_note_waits(user_id)
 
-        onboarding_allowed = {
-            "說明", "幫助", "help", "Help", "HELP",
-            "我的ID", "我的id", "my id", "My ID", "userid", "user id",
-        }
-
-        goal = parse_fitness_goal(text)
+        compact = _compact_command(text)
+        goal = _FITNESS_GOAL_LOOKUP.get(compact)
         if goal and (
             state == UserState.ONBOARDING_WAITING_GOAL or db.needs_fitness_goal(user_id)
         ):
             return await handle_fitness_goal_selection(user_id, goal)
 
-        if not db.is_onboarded(user_id):
-            if text in onboarding_allowed:
-                pass
-            elif db.needs_inbody(user_id):
-                return ONBOARDING_NEED_INBODY_TEXT
-            elif db.needs_fitness_goal(user_id):
-                return ONBOARDING_BLOCKED_TEXT
+        spec = resolve_command(text, compact)
+        # 只有需要 onboarding 的指令（及非指令文字）才查詢使用者檔案
+        if spec is None or spec.requires_onboarding:
+            blocked = _onboarding_block_reply(user_id)
+            if blocked:
+                return blocked
 
         # 狀態內的文字回應
         if state == UserState.PURCHASE_REVIEWED:
-            if text in ("買了", "確定", "購買"):
-                ctx = get_context(user_id)
-                db.save_purchase_decision(user_id, ctx, "purchased")
-                clear_state(user_id)
-                return (
-                    f"已記錄購買：{ctx.get('name', '未知')}\n"
-                    f"熱量 {ctx.get('calories', '?')} kcal 已計入今日統計。"
-                )
-            elif text in ("不買", "取消", "放棄"):
-                ctx = get_context(user_id)
-                db.save_purchase_decision(user_id, ctx, "cancelled")
-                clear_state(user_id)
-                return "明智的選擇。繼續保持紀律。"
-            else:
-                clear_state(user_id)
-                return "查詢已取消。"
+            return _handle_purchase_review_reply(user_id, text)
 
         # ── 一般指令（優先於「等待傳照」提示，才能隨時切換購買查詢／InBody 等）──
-        if text in ("說明", "幫助", "help", "Help", "HELP"):
-            leave_photo_wait_if_any(user_id)
-            return HELP_TEXT
-
-        if _compact_command(text) in JITAI_ON_COMMANDS:
-            leave_photo_wait_if_any(user_id)
-            return handle_jitai_toggle(user_id, True)
-
-        if _compact_command(text) in JITAI_OFF_COMMANDS:
-            leave_photo_wait_if_any(user_id)
-            return handle_jitai_toggle(user_id, False)
-
-        if _compact_command(text) in JITAI_STATUS_COMMANDS:
-            leave_photo_wait_if_any(user_id)
-            return handle_jitai_status(user_id)
-
-        if text in ("今日", "今日總計", "今日總結", "總計", "今天"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_today_summary(user_id)
-
-        if text in ("我的ID", "我的id", "my id", "My ID", "userid", "user id"):
-            leave_photo_wait_if_any(user_id)
-            return f"你的 LINE userId：\n{user_id}"
-
-        if text in ("測試推播", "測試push", "測試 Push", "push測試"):
-            leave_photo_wait_if_any(user_id)
-            try:
-                await push_line_text(user_id, "推播測試成功：這則是用 Push API 送出的。")
-                return "Reply 正常。Push 測試也已送出；若你有收到上一則「推播測試成功」，代表分析結果推播通道正常。"
-            except Exception as e:
-                logger.error("測試推播失敗 user=%s: %s", user_id[:8], e, exc_info=True)
-                err = str(e)
-                quota_hint = ""
-                if "429" in err or "Too Many Requests" in err:
-                    quota_hint = (
-                        "\n\n這通常是 LINE 免費方案本月訊息額度用完（常見 200/200），"
-                        "不是 Bot 程式壞掉。請到 LINE Official Account Manager 看「訊息用量」，"
-                        "下個月重置後會恢復，或升級／加購訊息方案。"
-                    )
-                return (
-                    "Reply 正常，但 Push 失敗（餐點分析結果走 Push，所以會收不到）。\n"
-                    f"錯誤：{type(e).__name__}: {e}"
-                    f"{quota_hint}"
-                )
-
-        if text in ("Notion狀態", "notion狀態", "Notion 狀態", "notion status", "Notion status"):
-            leave_photo_wait_if_any(user_id)
-            notion = get_notion_sync()
-            sync_ok = notion.should_sync_line_user(user_id)
-            uid_set = "已設定" if notion.sync_user_id else "未設定"
-            uid_match = "符合" if sync_ok else "不符合"
-            return (
-                "Notion 同步檢查\n"
-                "--------------------\n"
-                f"Notion 啟用：{'是' if notion.enabled else '否'}\n"
-                f"NOTION_SYNC_USER_ID：{uid_set}\n"
-                f"目前 userId 是否可同步：{uid_match}\n\n"
-                "若顯示不符合，請先傳「我的ID」，並把該值填入 Render 的 NOTION_SYNC_USER_ID。"
-            )
-
-        if text == "清除今日":
-            leave_photo_wait_if_any(user_id)
-            today_str = date.today().isoformat()
-            count = db.clear_today(user_id, today_str)
-            return f"已清除今日 {count} 筆紀錄。"
-
-        if text.startswith("設定蛋白飲"):
-            leave_photo_wait_if_any(user_id)
-            return handle_set_quick_item(user_id, text)
-
-        if text in ("加蛋白飲", "蛋白飲", "+蛋白飲", "+蛋白", "＋蛋白飲", "＋蛋白"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_quick_protein(user_id, "蛋白飲")
-
-        if text in ("加雞蛋", "+雞蛋", "＋雞蛋"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_quick_protein(user_id, "雞蛋")
-
-        if text in ("加雞胸肉", "+雞胸肉", "＋雞胸肉"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_quick_protein(user_id, "雞胸肉")
-
-        if text in (
-            "加碳水",
-            "加一份碳水",
-            "碳水",
-            "+碳水",
-            "＋碳水",
-            "加地瓜",
-            "+地瓜",
-            "＋地瓜",
-        ):
-            leave_photo_wait_if_any(user_id)
-            return await handle_quick_protein(user_id, "碳水")
-
-        if text in ("購買查詢", "食物查詢", "查詢", "買之前"):
-            set_state(user_id, UserState.WAITING_PURCHASE_PHOTO)
-            return (
-                "購買前熱量查詢已啟動\n"
-                "-----\n"
-                "請拍攝食物或商品包裝照片傳送。\n"
-                "我會分析營養數據並給予等級評定。\n\n"
-                "輸入「取消」可結束查詢。"
-            )
-
-        if text in ("本週積分", "積分", "積分卡", "本週", "週報"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_weekly_score(user_id)
-
-        if text in ("上傳InBody", "InBody", "inbody", "INBODY"):
-            set_state(user_id, UserState.WAITING_INBODY_PHOTO)
-            return (
-                "InBody 上傳模式已啟動\n"
-                "-----\n"
-                "請拍攝或傳送 InBody 體組成報告照片。\n"
-                "我會自動辨識數據並更新你的營養目標。\n\n"
-                "輸入「取消」可結束。"
-            )
-
-        if text in ("欺騙日", "cheat day", "Cheat Day"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_cheat_day(user_id)
-
-        if text == "強制欺騙日":
-            leave_photo_wait_if_any(user_id)
-            today_str = date.today().isoformat()
-            db.activate_cheat_day(user_id, today_str)
-            cheat_cal = get_daily_calorie_target(user_id, today_str)
-            return (
-                f"欺騙日已強制啟動\n"
-                f"今日熱量上限：{cheat_cal:.0f} kcal\n\n"
-                f"注意：頻繁使用欺騙日會影響整體進度。"
-            )
-
-        if text in ("AI教練", "教練", "ai教練", "AI 教練"):
-            leave_photo_wait_if_any(user_id)
-            return await handle_ai_coach(user_id)
+        if spec is not None:
+            if spec.leaves_photo_wait:
+                leave_photo_wait_if_any(user_id)
+            return await spec.handler(user_id, text)
 
         calorie_adj = parse_calorie_adjust(text)
         if calorie_adj:
@@ -3696,33 +4924,6 @@ async def route_message(event: MessageEvent, user_id: str, state: str) -> str:
             action, amount = calorie_adj
             return await handle_calorie_adjust(user_id, action, amount)
 
-        if text in ("目標", "我的目標", "查看目標"):
-            leave_photo_wait_if_any(user_id)
-            targets = get_user_targets(user_id)
-            profile = db.get_user_profile(user_id)
-            goal_label = _profile_fitness_goal(profile)
-            offset = int((profile or {}).get("calorie_offset") or 0)
-            lines = [
-                "目前設定的目標",
-                "=" * 24,
-                f"健身目標：{goal_label}",
-                f"每日熱量：{targets['calories']:.0f} kcal",
-            ]
-            if profile and profile.get("weight") and offset:
-                base = _base_targets_from_profile(profile)["calories"]
-                sign = "+" if offset > 0 else ""
-                lines.append(f"  （公式 {base:.0f} {sign}{offset}）")
-            lines.append(f"每日蛋白質：{targets['protein']:.0f} g")
-            if profile:
-                lines.extend([
-                    "",
-                    "身體數據：",
-                    f"  體重：{profile.get('weight', '?')} kg",
-                    f"  體脂率：{profile.get('body_fat_percentage', '?')} %",
-                    f"  上次 InBody：{profile.get('last_inbody_date', '未上傳')}",
-                ])
-            return "\n".join(lines)
-
         if state == UserState.WAITING_PURCHASE_PHOTO:
             if text in ("取消", "結束"):
                 clear_state(user_id)
@@ -3767,6 +4968,7 @@ async def ping_head():
 async def cron_daily_summary(request: Request):
     """給 GitHub Actions 定時 POST；標頭 X-Cron-Secret 須與環境變數 CRON_SECRET 相同。"""
     _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
     try:
         result = await execute_daily_summary_push()
         return JSONResponse(content=result)
@@ -3800,6 +5002,7 @@ async def cron_meal_reminder(request: Request):
     - 未給 slot 時同次執行兩個時段
     """
     _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
     slot = (request.query_params.get("slot") or "").strip().lower()
     try:
         if slot in ("noon", "evening"):
@@ -3821,6 +5024,52 @@ async def cron_meal_reminder(request: Request):
         )
 
 
+@app.post("/cron/weekly-scores")
+async def cron_weekly_scores(request: Request):
+    """
+    每日換日後預先計算本週積分卡（本週有紀錄者）：
+    - /cron/weekly-scores（預設以伺服器今日為截止日）
+    - /cron/weekly-scores?date=YYYY-MM-DD
+
+    建立背景工作後立即回 202；加 wait=1 則在請求內跑完並回傳結果。
+    """
+    _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
+    raw_date = (request.query_params.get("date") or "").strip()
+    try:
+        day = date.fromisoformat(raw_date) if raw_date else date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date 須為 YYYY-MM-DD")
+    try:
+        if (request.query_params.get("wait") or "").strip() in ("1", "true", "yes"):
+            result = await execute_weekly_score_precompute(day)
+            return JSONResponse(content={"ok": True, "result": result})
+        job_id, created = await start_cron_job(
+            "weekly_scores",
+            f"weekly_scores:{day.isoformat()}",
+            {"date": day.isoformat()},
+            lambda progress: execute_weekly_score_precompute(day, progress=progress),
+        )
+        return JSONResponse(
+            status_code=202,
+            content={
+                "ok": True,
+                "date": day.isoformat(),
+                "job_id": job_id,
+                "deduplicated": not created,
+                "status_url": f"/cron/jobs/{job_id}",
+            },
+        )
+    except Exception as e:
+        logger.error("cron weekly-scores 執行失敗: %s", e, exc_info=True)
+        return JSONResponse(
+            content={
+                "ok": False,
+                "error": f"cron_weekly_scores_failed: {e}",
+            }
+        )
+
+
 @app.post("/cron/jitai-nudge")
 async def cron_jitai_nudge(request: Request):
     """
@@ -3828,8 +5077,12 @@ async def cron_jitai_nudge(request: Request):
     - /cron/jitai-nudge?checkpoint=lunch
     - /cron/jitai-nudge?checkpoint=afternoon
     - /cron/jitai-nudge?checkpoint=final
+
+    預設建立背景工作後立即回 202（job_id 可查 /cron/jobs/{job_id}）；
+    加 wait=1 則在請求內跑完並回傳結果。
     """
     _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
     checkpoint = (request.query_params.get("checkpoint") or "").strip().lower()
     if checkpoint not in ("lunch", "afternoon", "final"):
         raise HTTPException(
@@ -3837,8 +5090,26 @@ async def cron_jitai_nudge(request: Request):
             detail="checkpoint 須為 lunch、afternoon 或 final",
         )
     try:
-        result = await execute_jitai_nudge_push(checkpoint)
-        return JSONResponse(content={"ok": True, "checkpoint": checkpoint, "result": result})
+        if (request.query_params.get("wait") or "").strip() in ("1", "true", "yes"):
+            result = await execute_jitai_nudge_push(checkpoint)
+            return JSONResponse(content={"ok": True, "checkpoint": checkpoint, "result": result})
+        local_date_s = datetime.now(timezone.utc).astimezone(_bot_timezone()).date().isoformat()
+        job_id, created = await start_cron_job(
+            "jitai_nudge",
+            f"jitai_nudge:{checkpoint}:{local_date_s}",
+            {"checkpoint": checkpoint, "date": local_date_s},
+            lambda progress: execute_jitai_nudge_push(checkpoint, progress=progress),
+        )
+        return JSONResponse(
+            status_code=202,
+            content={
+                "ok": True,
+                "checkpoint": checkpoint,
+                "job_id": job_id,
+                "deduplicated": not created,
+                "status_url": f"/cron/jobs/{job_id}",
+            },
+        )
     except Exception as e:
         logger.error("cron jitai-nudge 執行失敗: %s", e, exc_info=True)
         return JSONResponse(
@@ -3850,10 +5121,22 @@ async def cron_jitai_nudge(request: Request):
         )
 
 
+@app.get("/cron/jobs/{job_id}")
+async def cron_job_status(job_id: str, request: Request):
+    """查詢背景批次工作的狀態與進度（標頭 X-Cron-Secret）。"""
+    _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
+    job = await asyncio.to_thread(db.get_cron_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return JSONResponse(content=job)
+
+
 @app.post("/cron/db-keepalive")
 async def cron_db_keepalive(request: Request):
     """給外部排程觸發：執行最小 DB 讀取，避免長期閒置。"""
     _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
     today_str = date.today().isoformat()
     probe_uid = os.getenv("DB_KEEPALIVE_PROBE_USER_ID", "__keepalive__")
     totals = db.get_daily_totals(probe_uid, today_str)
@@ -3868,6 +5151,41 @@ async def cron_db_keepalive(request: Request):
     )
 
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Prometheus 格式的 OpenAI 呼叫計數、token 與延遲直方圖（標頭 X-Cron-Secret）。"""
+    _verify_cron_secret_or_401(request)
+    from fastapi.responses import PlainTextResponse
+
+    return PlainTextResponse(
+        openai_telemetry.render_prometheus(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/metrics/openai-usage")
+async def metrics_openai_usage(request: Request):
+    """
+    每位使用者每日的 OpenAI 用量彙總（標頭 X-Cron-Secret）：
+    - /metrics/openai-usage?date=2025-01-31
+    - /metrics/openai-usage?date=2025-01-31&user_id=U...
+    未給 date 時為 BOT_TIMEZONE 的今天。
+    """
+    _verify_cron_secret_or_401(request)
+    await ensure_db_ready()
+    day = (request.query_params.get("date") or "").strip()
+    if not day:
+        day = datetime.now(_bot_timezone()).date().isoformat()
+    try:
+        date.fromisoformat(day)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date 須為 YYYY-MM-DD")
+    uid = (request.query_params.get("user_id") or "").strip() or None
+    await flush_openai_telemetry()
+    rows = await asyncio.to_thread(db.get_openai_usage_summary, day, uid)
+    return JSONResponse(content={"date": day, "rows": rows})
+
+
 @app.get("/health")
 async def health():
     commit = (
@@ -3880,9 +5198,25 @@ async def health():
         "timestamp": datetime.now().isoformat(),
         "commit": commit,
         "features": ["jitai_nudge", "scale_note", "onboarding"],
+        "db_ready": _db_init_task is not None
+        and _db_init_task.done()
+        and not _db_init_task.cancelled()
+        and _db_init_task.exception() is None,
+        "startup": startup_profile.summary(),
+        "webhook_dedup": dict(_webhook_dedup_stats),
+        "openai_single_flight": openai_single_flight.stats(),
+        "openai_routing": openai_telemetry.route_stats(),
+        "openai_latency": openai_latency.stats(),
+        "openai_circuit": openai_circuit.stats(),
+        "deferred_photos": len(_deferred_photos),
+        "day_state_cache": {"size": len(_day_states), **_day_states.stats},
+        "score_cards_pending": len(_score_cards_to_refresh),
     }
 
 
+startup_profile.mark("imported")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
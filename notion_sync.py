@@ -7,6 +7,7 @@ from __future__ import annotations
 
 import logging
 import os
+import threading
 from typing import Any
 
 logger = logging.getLogger(__name__)
@@ -36,19 +37,14 @@ class NotionSync:
         self._db_props: dict[str, dict[str, dict]] = {}
         self._missing_prop_warned: set[tuple[str, str]] = set()
         self._sync_user_missing_warned = False
+        # 資料庫欄位（兩次 databases.retrieve）延後到首次同步或 warm_up 才讀取，避免拖慢冷啟動
+        self._schema_loaded = False
+        self._schema_lock = threading.Lock()
         if token and self.daily_db_id and self.inbody_db_id:
             try:
                 from notion_client import Client
 
                 self._client = Client(auth=token)
-                self._db_props[self.daily_db_id] = self._load_db_properties(self.daily_db_id, "每日飲食")
-                self._db_props[self.inbody_db_id] = self._load_db_properties(self.inbody_db_id, "InBody")
-                self.daily_title_prop = self._resolve_title_prop(
-                    self.daily_db_id, self.daily_title_prop, "每日飲食"
-                )
-                self.inbody_title_prop = self._resolve_title_prop(
-                    self.inbody_db_id, self.inbody_title_prop, "InBody"
-                )
             except Exception as e:
                 logger.error("Notion Client 初始化失敗：%s", e)
         elif token or self.daily_db_id or self.inbody_db_id:
@@ -60,6 +56,27 @@ class NotionSync:
     def enabled(self) -> bool:
         return self._client is not None
 
+    def warm_up(self) -> None:
+        """啟動後於背景預先讀取資料庫欄位，讓第一次同步不必等待。"""
+        if self.enabled:
+            self._ensure_schema()
+
+    def _ensure_schema(self) -> None:
+        if self._schema_loaded:
+            return
+        with self._schema_lock:
+            if self._schema_loaded:
+                return
+            self._db_props[self.daily_db_id] = self._load_db_properties(self.daily_db_id, "每日飲食")
+            self._db_props[self.inbody_db_id] = self._load_db_properties(self.inbody_db_id, "InBody")
+            self.daily_title_prop = self._resolve_title_prop(
+                self.daily_db_id, self.daily_title_prop, "每日飲食"
+            )
+            self.inbody_title_prop = self._resolve_title_prop(
+                self.inbody_db_id, self.inbody_title_prop, "InBody"
+            )
+            self._schema_loaded = True
+
     def should_sync_line_user(self, line_user_id: str) -> bool:
         if not self.enabled:
             return False
@@ -82,6 +99,7 @@ class NotionSync:
         if not self.enabled:
             return False
         try:
+            self._ensure_schema()
             cal = float(data.get("calories", 0))
             pro = float(data.get("protein", 0))
             meals = int(data.get("meal_count", 0))
@@ -127,6 +145,7 @@ class NotionSync:
         if not self.enabled:
             return False
         try:
+            self._ensure_schema()
             w = _nv(inbody_data.get("weight"))
             bf = _nv(inbody_data.get("body_fat_percentage"))
             muscle = _nv(inbody_data.get("muscle_mass"))
@@ -0,0 +1,516 @@
+"""
+OpenAI 呼叫的執行期輔助：
+- 相同請求合併（single-flight）：使用者連點 rich menu（如「AI教練」）或 LINE 重送時，
+  同一份 payload 會同時送出多次；進行中的相同請求只打一次上游，其餘等待者共用結果。
+- 每次上游呼叫的遙測（prompt、模型、token、延遲、重試、結果），供 /metrics 與每日彙總。
+- 串流回應的增量 JSON 欄位擷取：頂層純量欄位一完整即可取用，不必等整段 completion。
+- 依各模型近期延遲（p95）調整單次逾時、決定對沖（hedge）請求的送出時機。
+- 熔斷器：上游連續失敗（逾時、網路錯誤、429、5xx）時暫停呼叫、立即失敗，冷卻後以單一請求試探。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+def payload_key(payload: dict) -> str:
+    """以 model、messages 與參數的正規化 JSON 計算 sha256，作為合併鍵。"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """同一鍵同時只執行一次；每個等待者各拿一份結果的深拷貝（呼叫端可能就地修改 dict）。
+
+    上游呼叫跑在獨立 Task 中，任一等待者被取消不會中斷其他等待者。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._calls = 0
+        self._upstream = 0
+        self._coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self._calls += 1
+        task = self._inflight.get(key)
+        if task is not None:
+            self._coalesced += 1
+            logger.info("%s 合併進行中的相同請求 key=%s", self.name, key[:12])
+        else:
+            self._upstream += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result) if isinstance(result, (dict, list)) else result
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已取消時，避免「exception was never retrieved」
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self._calls,
+            "upstream": self._upstream,
+            "coalesced": self._coalesced,
+            "inflight": len(self._inflight),
+        }
+
+
+openai_single_flight = SingleFlight("OpenAI")
+
+
+# ━━━ 延遲追蹤與自適應逾時 ━━━
+
+
+class LatencyTracker:
+    """各模型最近 N 次成功呼叫的延遲（秒），提供百分位數給逾時與對沖使用。"""
+
+    def __init__(self, window: int = 100, min_samples: int = 10):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: dict[str, deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, q: float) -> float | None:
+        """樣本不足 min_samples 時回傳 None（呼叫端改用固定設定）。"""
+        with self._lock:
+            samples = sorted(self._samples.get(model) or ())
+        if len(samples) < self.min_samples:
+            return None
+        idx = min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))
+        return samples[idx]
+
+    def timeout_for(self, model: str, ceiling: float, *, multiplier: float, floor: float) -> float:
+        """p95 × multiplier，夾在 [floor, ceiling]；multiplier ≤ 0 或樣本不足時為 ceiling。"""
+        p95 = self.percentile(model, 0.95) if multiplier > 0 else None
+        if p95 is None:
+            return ceiling
+        return max(min(floor, ceiling), min(ceiling, p95 * multiplier))
+
+    def stats(self) -> dict:
+        out = {}
+        for model in list(self._samples):
+            p50, p95 = self.percentile(model, 0.5), self.percentile(model, 0.95)
+            out[model] = {
+                "samples": len(self._samples.get(model) or ()),
+                "p50_sec": round(p50, 2) if p50 is not None else None,
+                "p95_sec": round(p95, 2) if p95 is not None else None,
+            }
+        return out
+
+
+def retry_backoff(attempt: int, *, base: float = 0.8, cap: float = 8.0) -> float:
+    """指數退避加隨機抖動（0.5～1 倍），避免多個請求同時重試撞在一起。"""
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+openai_latency = LatencyTracker()
+
+
+# ━━━ 熔斷器 ━━━
+
+
+class CircuitOpenError(Exception):
+    """熔斷中，未送出請求；retry_after 為預計可再試探的秒數。"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"circuit open, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """closed → 連續失敗達門檻 → open（立即失敗）→ 冷卻後 half_open（放行單一試探）。
+
+    試探成功即恢復 closed；失敗則再 open 一輪。429 帶 Retry-After 時冷卻至少等那麼久。
+    試探請求若遲遲沒有回報（例如被取消），超過冷卻時間後會再放行下一個。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, open_sec: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_sec = open_sec
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._open_until = 0.0
+        self._probe_at: float | None = None
+        self._opened_total = 0
+        self._rejected_total = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == "open" and time.monotonic() >= self._open_until:
+                return "half_open"
+            return self._state
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic()) if self._state != "closed" else 0.0
+
+    def before_call(self) -> None:
+        """放行則直接返回；熔斷中則 raise CircuitOpenError。"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == "closed":
+                return
+            if now < self._open_until:
+                self._rejected_total += 1
+                raise CircuitOpenError(self._open_until - now)
+            # 冷卻結束：只放行一個試探，其餘照樣拒絕
+            if self._probe_at is not None and now - self._probe_at < self.open_sec:
+                self._rejected_total += 1
+                raise CircuitOpenError(self.open_sec - (now - self._probe_at))
+            self._state = "half_open"
+            self._probe_at = now
+            logger.info("%s 熔斷冷卻結束，放行試探請求", self.name)
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != "closed":
+                logger.info("%s 熔斷解除", self.name)
+            self._state = "closed"
+            self._failures = 0
+            self._probe_at = None
+
+    def record_failure(self, retry_after: float | None = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                cool = max(self.open_sec, retry_after or 0.0)
+                if self._state != "open" or now >= self._open_until:
+                    self._opened_total += 1
+                    logger.warning(
+                        "%s 熔斷開啟（連續失敗 %s 次），%.0f 秒內直接失敗",
+                        self.name, self._failures, cool,
+                    )
+                self._state = "open"
+                self._open_until = now + cool
+                self._probe_at = None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_after_sec": round(self.retry_after(), 1),
+            "opened_total": self._opened_total,
+            "rejected_total": self._rejected_total,
+        }
+
+
+# ━━━ 串流 JSON 欄位擷取 ━━━
+
+
+class JsonFieldStream:
+    """逐段餵入模型輸出的 JSON 文字，記錄已完整的頂層純量欄位（字串、數字、布林、null）。
+
+    巢狀物件／陣列只略過不解析；最外層 { 之前的文字（如 ```json）會被忽略。
+    """
+
+    def __init__(self):
+        self.fields: dict[str, Any] = {}
+        self._text: list[str] = []
+        self._buf = ""
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._token_start: int | None = None
+        self._expect = "object"  # object／key／colon／value／scalar／nested／comma／done
+        self._key: str | None = None
+
+    def text(self) -> str:
+        return "".join(self._text)
+
+    def feed(self, chunk: str) -> bool:
+        """餵入一段文字；有新欄位完成時回傳 True。"""
+        if not chunk:
+            return False
+        self._text.append(chunk)
+        before = len(self.fields)
+        start = len(self._buf)
+        self._buf += chunk
+        for i in range(start, len(self._buf)):
+            self._step(i, self._buf[i])
+        # 已完成的前段不再需要，保留進行中的 token 起點
+        keep = self._token_start if self._token_start is not None else len(self._buf)
+        if keep:
+            self._buf = self._buf[keep:]
+            if self._token_start is not None:
+                self._token_start = 0
+        return len(self.fields) > before
+
+    def _step(self, i: int, c: str) -> None:
+        if self._expect == "done":
+            return
+        if self._in_str:
+            if self._esc:
+                self._esc = False
+            elif c == "\\":
+                self._esc = True
+            elif c == '"':
+                self._in_str = False
+                if self._token_start is not None:
+                    token = self._buf[self._token_start : i + 1]
+                    self._token_start = None
+                    if self._expect == "key":
+                        self._key = self._loads(token)
+                        self._expect = "colon"
+                    else:
+                        self._set(self._loads(token))
+            return
+        if self._depth == 1 and self._expect == "scalar" and (c in ",}" or c.isspace()):
+            self._set(self._loads(self._buf[self._token_start : i].strip()))
+            self._token_start = None
+        if c == '"':
+            self._in_str = True
+            if self._depth == 1 and self._expect in ("key", "value"):
+                self._token_start = i
+        elif c in "{[":
+            if self._depth == 0 and c == "{" and self._expect == "object":
+                self._expect = "key"
+            elif self._depth == 1 and self._expect == "value":
+                self._expect = "nested"
+            self._depth += 1
+        elif c in "}]":
+            self._depth = max(0, self._depth - 1)
+            if self._depth == 1 and self._expect == "nested":
+                self._expect = "comma"
+            elif self._depth == 0 and self._expect != "object":
+                self._expect = "done"
+        elif self._depth == 1:
+            if c == ":" and self._expect == "colon":
+                self._expect = "value"
+            elif c == ",":
+                self._expect = "key"
+            elif not c.isspace() and self._expect == "value":
+                self._token_start = i
+                self._expect = "scalar"
+
+    def _set(self, value: Any) -> None:
+        if self._key is not None and value is not _INVALID:
+            self.fields[self._key] = value
+        self._key = None
+        self._expect = "comma"
+
+    @staticmethod
+    def _loads(token: str) -> Any:
+        try:
+            return json.loads(token)
+        except (json.JSONDecodeError, ValueError):
+            return _INVALID
+
+
+_INVALID = object()
+
+
+# ━━━ 呼叫遙測 ━━━
+
+# 延遲直方圖上界（秒）；Vision 分析常在 5～30 秒
+LATENCY_BUCKETS_SEC = (0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+
+
+class OpenAICallRecord(NamedTuple):
+    created_at: str
+    local_date: str
+    user_id: str
+    prompt_id: str
+    model: str
+    image_detail: str
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    latency_ms: float
+    retries: int
+    outcome: str
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**kv: str) -> str:
+    return "{" + ",".join(f'{k}="{_escape_label(str(v))}"' for k, v in kv.items()) + "}"
+
+
+class OpenAITelemetry:
+    """程序內累計的計數／直方圖，並暫存待寫入 DB 的明細（由呼叫端批次取出）。"""
+
+    def __init__(self, pending_max: int = 5000):
+        self._lock = threading.Lock()
+        self._calls: dict[tuple[str, str, str], int] = {}
+        self._tokens: dict[tuple[str, str, str], int] = {}
+        # (prompt_id, model) -> [各 bucket 次數..., 總和秒, 總次數]
+        self._latency: dict[tuple[str, str], list[float]] = {}
+        self._pending: deque[OpenAICallRecord] = deque(maxlen=pending_max)
+        # 模型分層路由：(prompt_id, decision, reason) -> 次數
+        self._routes: dict[tuple[str, str, str], int] = {}
+        # 升級時快速模型與大模型的差距：(prompt_id, field) -> [絕對誤差總和, 次數]
+        self._fast_error: dict[tuple[str, str], list[float]] = {}
+        # 對沖請求：(model, winner) -> 次數；winner 為 primary／hedge
+        self._hedges: dict[tuple[str, str], int] = {}
+
+    def observe(self, rec: OpenAICallRecord) -> None:
+        sec = rec.latency_ms / 1000
+        with self._lock:
+            key = (rec.prompt_id, rec.model, rec.outcome)
+            self._calls[key] = self._calls.get(key, 0) + 1
+            for kind, n in (
+                ("prompt", rec.prompt_tokens),
+                ("completion", rec.completion_tokens),
+                ("cached", rec.cached_tokens),
+            ):
+                tk = (rec.prompt_id, rec.model, kind)
+                self._tokens[tk] = self._tokens.get(tk, 0) + n
+            hist = self._latency.setdefault(
+                (rec.prompt_id, rec.model), [0.0] * (len(LATENCY_BUCKETS_SEC) + 2)
+            )
+            for i, le in enumerate(LATENCY_BUCKETS_SEC):
+                if sec <= le:
+                    hist[i] += 1
+            hist[-2] += sec
+            hist[-1] += 1
+            self._pending.append(rec)
+
+    def observe_route(self, prompt_id: str, decision: str, reason: str = "") -> None:
+        """decision：accepted（快速模型結果採用）／escalated（改用大模型）。"""
+        with self._lock:
+            key = (prompt_id, decision, reason)
+            self._routes[key] = self._routes.get(key, 0) + 1
+
+    def observe_fast_error(self, prompt_id: str, errors: dict[str, float]) -> None:
+        """升級後以大模型結果為基準，記錄快速模型各欄位的絕對誤差（準確度參考）。"""
+        with self._lock:
+            for field, err in errors.items():
+                agg = self._fast_error.setdefault((prompt_id, field), [0.0, 0])
+                agg[0] += abs(err)
+                agg[1] += 1
+
+    def observe_hedge(self, model: str, winner: str) -> None:
+        with self._lock:
+            key = (model, winner)
+            self._hedges[key] = self._hedges.get(key, 0) + 1
+
+    def route_stats(self) -> dict:
+        with self._lock:
+            return {
+                "decisions": {"|".join(k): n for k, n in sorted(self._routes.items())},
+                "fast_mean_abs_error": {
+                    f"{pid}|{field}": round(total / n, 1)
+                    for (pid, field), (total, n) in sorted(self._fast_error.items())
+                    if n
+                },
+            }
+
+    def drain(self, limit: int = 500) -> list[OpenAICallRecord]:
+        with self._lock:
+            out = []
+            while self._pending and len(out) < limit:
+                out.append(self._pending.popleft())
+            return out
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format（0.0.4）。"""
+        with self._lock:
+            calls = dict(self._calls)
+            tokens = dict(self._tokens)
+            latency = {k: list(v) for k, v in self._latency.items()}
+            routes = dict(self._routes)
+            fast_error = {k: list(v) for k, v in self._fast_error.items()}
+            hedges = dict(self._hedges)
+        lines = [
+            "# HELP openai_calls_total OpenAI upstream calls by prompt, model and outcome.",
+            "# TYPE openai_calls_total counter",
+        ]
+        for (pid, model, outcome), n in sorted(calls.items()):
+            lines.append(f"openai_calls_total{_labels(prompt_id=pid, model=model, outcome=outcome)} {n}")
+        lines += [
+            "# HELP openai_tokens_total Tokens reported in the usage block (cached is a subset of prompt).",
+            "# TYPE openai_tokens_total counter",
+        ]
+        for (pid, model, kind), n in sorted(tokens.items()):
+            lines.append(f"openai_tokens_total{_labels(prompt_id=pid, model=model, kind=kind)} {n}")
+        lines += [
+            "# HELP openai_call_latency_seconds Upstream latency including retries.",
+            "# TYPE openai_call_latency_seconds histogram",
+        ]
+        for (pid, model), hist in sorted(latency.items()):
+            for i, le in enumerate(LATENCY_BUCKETS_SEC):
+                lab = _labels(prompt_id=pid, model=model, le=f"{le:g}")
+                lines.append(f"openai_call_latency_seconds_bucket{lab} {int(hist[i])}")
+            lab = _labels(prompt_id=pid, model=model, le="+Inf")
+            lines.append(f"openai_call_latency_seconds_bucket{lab} {int(hist[-1])}")
+            lab = _labels(prompt_id=pid, model=model)
+            lines.append(f"openai_call_latency_seconds_sum{lab} {hist[-2]:.3f}")
+            lines.append(f"openai_call_latency_seconds_count{lab} {int(hist[-1])}")
+        lines += [
+            "# HELP openai_route_decisions_total Fast-model routing decisions.",
+            "# TYPE openai_route_decisions_total counter",
+        ]
+        for (pid, decision, reason), n in sorted(routes.items()):
+            lab = _labels(prompt_id=pid, decision=decision, reason=reason)
+            lines.append(f"openai_route_decisions_total{lab} {n}")
+        lines += [
+            "# HELP openai_route_fast_abs_error Fast-model absolute error vs. the escalated result.",
+            "# TYPE openai_route_fast_abs_error summary",
+        ]
+        for (pid, field), (total, n) in sorted(fast_error.items()):
+            lab = _labels(prompt_id=pid, field=field)
+            lines.append(f"openai_route_fast_abs_error_sum{lab} {total:.1f}")
+            lines.append(f"openai_route_fast_abs_error_count{lab} {int(n)}")
+        lines += [
+            "# HELP openai_hedged_requests_total Hedged second requests and which one answered first.",
+            "# TYPE openai_hedged_requests_total counter",
+        ]
+        for (model, winner), n in sorted(hedges.items()):
+            lines.append(f"openai_hedged_requests_total{_labels(model=model, winner=winner)} {n}")
+        cb = openai_circuit.stats()
+        lines += [
+            "# HELP openai_circuit_open Whether the OpenAI circuit breaker is rejecting calls (1) or not (0).",
+            "# TYPE openai_circuit_open gauge",
+            f"openai_circuit_open {1 if cb['state'] == 'open' else 0}",
+            "# HELP openai_circuit_rejected_total Calls failed fast while the circuit was open.",
+            "# TYPE openai_circuit_rejected_total counter",
+            f"openai_circuit_rejected_total {cb['rejected_total']}",
+        ]
+        sf = openai_single_flight.stats()
+        lines += [
+            "# HELP openai_single_flight_coalesced_total Requests served by an identical in-flight call.",
+            "# TYPE openai_single_flight_coalesced_total counter",
+            f"openai_single_flight_coalesced_total {sf['coalesced']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+openai_telemetry = OpenAITelemetry()
+openai_circuit = CircuitBreaker(
+    "OpenAI",
+    failure_threshold=int(os.getenv("OPENAI_CIRCUIT_FAILURES", "5")),
+    open_sec=float(os.getenv("OPENAI_CIRCUIT_OPEN_SEC", "30")),
+)
@@ -0,0 +1,205 @@
+"""
+飲食報表引擎：把 daily_aggregates 的每日彙總整理成連續日期的欄式序列，計算任意區間的達標、偏差與連續紀錄。
+
+DailySeries 以 array 存放各欄（struct-of-arrays），無紀錄的日子補 0；
+週積分卡、AI 教練摘要與「報表」指令共用同一套指標與評等。
+"""
+
+from __future__ import annotations
+
+from array import array
+from datetime import date, timedelta
+from typing import Iterable, NamedTuple
+
+# 蛋白質「達標」的門檻（目標的 90%），與積分卡文案一致
+PROTEIN_MET_RATIO = 0.9
+
+_GENERAL_BANDS = ((0.95, "S"), (0.85, "A"), (0.70, "B"), (0.55, "C"), (0.40, "D"))
+_CALORIE_BANDS = ((0.05, "S"), (0.10, "A"), (0.15, "B"), (0.25, "C"), (0.35, "D"))
+_GRADE_VALUES = {"S": 6, "A": 5, "B": 4, "C": 3, "D": 2, "E": 1}
+
+
+class DailySeries:
+    """start 起連續 len(self) 天的每日熱量／蛋白質／餐數。"""
+
+    __slots__ = ("start", "calories", "protein", "meals")
+
+    def __init__(self, start: date, calories: array, protein: array, meals: array):
+        self.start = start
+        self.calories = calories
+        self.protein = protein
+        self.meals = meals
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict], start: date, end: date) -> "DailySeries":
+        """rows 為 get_daily_aggregates 的結果；區間外的列略過。"""
+        n = max(0, (end - start).days + 1)
+        series = cls(start, array("d", [0.0]) * n, array("d", [0.0]) * n, array("l", [0]) * n)
+        for row in rows:
+            i = (date.fromisoformat(str(row["date"])) - start).days
+            if 0 <= i < n:
+                series.calories[i] = float(row["calories"] or 0)
+                series.protein[i] = float(row["protein"] or 0)
+                series.meals[i] = int(row["meal_count"] or 0)
+        return series
+
+    def __len__(self) -> int:
+        return len(self.meals)
+
+    @property
+    def end(self) -> date:
+        return self.start + timedelta(days=len(self) - 1)
+
+    def day(self, i: int) -> date:
+        return self.start + timedelta(days=i)
+
+    def window(self, start: date, end: date) -> "DailySeries":
+        """[start, end] 的子序列（超出範圍的部分截掉）。"""
+        lo = max(0, (start - self.start).days)
+        hi = min(len(self), (end - self.start).days + 1)
+        hi = max(lo, hi)
+        return DailySeries(
+            self.day(lo), self.calories[lo:hi], self.protein[lo:hi], self.meals[lo:hi],
+        )
+
+    def active_days(self) -> list[dict]:
+        """有紀錄的日子（新到舊），格式同 get_daily_totals 加上 date。"""
+        return [
+            {
+                "date": self.day(i).isoformat(),
+                "calories": self.calories[i],
+                "protein": self.protein[i],
+                "meal_count": self.meals[i],
+            }
+            for i in range(len(self) - 1, -1, -1)
+            if self.meals[i] > 0
+        ]
+
+
+class WindowStats(NamedTuple):
+    start: date
+    end: date
+    days: int  # 區間天數
+    active_days: int  # 有紀錄天數
+    protein_met: int  # 蛋白質達 90% 的天數（只算有紀錄的日子）
+    avg_calories: float  # 有紀錄日的平均
+    avg_protein: float
+    calorie_deviation: float  # |平均熱量 − 目標| ／ 目標
+    calorie_within_10pct: int  # 單日熱量落在目標 ±10% 的天數
+    regularity: float  # 有紀錄天數 ／ 區間天數
+    current_streak: int  # 到區間最後一天為止連續有紀錄的天數
+    longest_streak: int
+    protein_streak: int  # 到區間最後一天為止連續蛋白質達標的天數
+
+    @property
+    def protein_rate(self) -> float:
+        return self.protein_met / self.active_days if self.active_days else 0.0
+
+
+def _streaks(flags: Iterable[bool]) -> tuple[int, int]:
+    """(結尾連續 True 的長度, 最長連續 True)。"""
+    current = longest = 0
+    for flag in flags:
+        current = current + 1 if flag else 0
+        longest = max(longest, current)
+    return current, longest
+
+
+def summarize(
+    series: DailySeries, calorie_target: float, protein_target: float,
+) -> WindowStats:
+    """整段序列的指標；目標沿用呼叫端傳入的目前目標。"""
+    n = len(series)
+    active = [m > 0 for m in series.meals]
+    active_n = sum(active)
+    protein_line = protein_target * PROTEIN_MET_RATIO
+    met = [a and p >= protein_line for a, p in zip(active, series.protein)]
+    cal_sum = sum(c for a, c in zip(active, series.calories) if a)
+    pro_sum = sum(p for a, p in zip(active, series.protein) if a)
+    avg_cal = cal_sum / active_n if active_n else 0.0
+    avg_pro = pro_sum / active_n if active_n else 0.0
+    lo, hi = calorie_target * 0.9, calorie_target * 1.1
+    current, longest = _streaks(active)
+    protein_streak, _ = _streaks(met)
+    return WindowStats(
+        start=series.start,
+        end=series.end,
+        days=n,
+        active_days=active_n,
+        protein_met=sum(met),
+        avg_calories=avg_cal,
+        avg_protein=avg_pro,
+        calorie_deviation=abs(avg_cal - calorie_target) / calorie_target if calorie_target else 0.0,
+        calorie_within_10pct=sum(
+            1 for a, c in zip(active, series.calories) if a and lo <= c <= hi
+        ),
+        regularity=active_n / n if n else 0.0,
+        current_streak=current,
+        longest_streak=longest,
+        protein_streak=protein_streak,
+    )
+
+
+def rolling_weeks(
+    series: DailySeries, calorie_target: float, protein_target: float, weeks: int,
+) -> list[WindowStats]:
+    """以序列最後一天往回切成 weeks 個 7 天區間（舊到新）。"""
+    out = []
+    for k in range(weeks, 0, -1):
+        end = series.end - timedelta(days=7 * (k - 1))
+        out.append(summarize(series.window(end - timedelta(days=6), end), calorie_target, protein_target))
+    return out
+
+
+def month_over_month(
+    series: DailySeries, calorie_target: float, protein_target: float,
+) -> tuple[WindowStats, WindowStats]:
+    """本月 1 日到序列最後一天，對照上個月同樣的天數（上月較短時截到月底）。"""
+    end = series.end
+    this_start = end.replace(day=1)
+    prev_end_of_month = this_start - timedelta(days=1)
+    prev_start = prev_end_of_month.replace(day=1)
+    prev_end = min(prev_start + timedelta(days=(end - this_start).days), prev_end_of_month)
+    return (
+        summarize(series.window(this_start, end), calorie_target, protein_target),
+        summarize(series.window(prev_start, prev_end), calorie_target, protein_target),
+    )
+
+
+# ━━━ 評等 ━━━
+
+def grade_general(rate: float) -> str:
+    for threshold, grade in _GENERAL_BANDS:
+        if rate >= threshold:
+            return grade
+    return "E"
+
+
+def grade_calorie(deviation: float) -> str:
+    for threshold, grade in _CALORIE_BANDS:
+        if deviation <= threshold:
+            return grade
+    return "E"
+
+
+class ScoreGrades(NamedTuple):
+    overall: str
+    protein: str
+    calorie: str
+    regularity: str
+
+
+def score_grades(stats: WindowStats) -> ScoreGrades:
+    """積分卡的三項評等與綜合評等（三項平均後四捨五入到等第）。"""
+    protein = grade_general(stats.protein_rate)
+    calorie = grade_calorie(stats.calorie_deviation)
+    regularity = grade_general(stats.regularity)
+    avg = (_GRADE_VALUES[protein] + _GRADE_VALUES[calorie] + _GRADE_VALUES[regularity]) / 3
+    overall = (
+        "S" if avg >= 5.5 else
+        "A" if avg >= 4.5 else
+        "B" if avg >= 3.5 else
+        "C" if avg >= 2.5 else
+        "D" if avg >= 1.5 else "E"
+    )
+    return ScoreGrades(overall, protein, calorie, regularity)
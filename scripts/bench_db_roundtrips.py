@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""計算 Database 各寫入操作實際送出的 SQL 句數（≈ PostgreSQL 的來回次數）與耗時。
+
+   python3 scripts/bench_db_roundtrips.py
+   python3 scripts/bench_db_roundtrips.py --iterations 500
+
+DB 使用暫存 SQLite，以 sqlite3 的 trace callback 計數；BEGIN／COMMIT 另列，
+因為 PostgreSQL 的交易開頭由 psycopg 隱含送出，commit 則同樣是一次來回。
+每項操作分「新使用者」與「既有使用者」兩種情境（讀後寫的路徑兩者句數不同）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from database import Database  # noqa: E402
+
+
+class CountingDatabase(Database):
+    """每條新連線掛上 trace callback，累計執行過的語句。"""
+
+    def __init__(self, path: str):
+        super().__init__(path, database_url="")
+        self.statements: list[str] = []
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.set_trace_callback(self.statements.append)
+        return conn
+
+
+def _ops(db: Database):
+    today = date.today().isoformat()
+    return [
+        ("upsert_user_profile", lambda uid: db.upsert_user_profile(uid, weight=72.5, body_fat=18)),
+        ("update_custom_quick_items", lambda uid: db.update_custom_quick_items(uid, '{"蛋白飲": {}}')),
+        ("set_jitai_nudges_enabled", lambda uid: db.set_jitai_nudges_enabled(uid, True)),
+        ("set_calorie_offset", lambda uid: db.set_calorie_offset(uid, -150)),
+        ("complete_onboarding", lambda uid: db.complete_onboarding(uid, "減脂", 2000, 140)),
+        ("add_meal", lambda uid: db.add_meal(uid, 520, 35, "雞胸便當", today)),
+        ("activate_cheat_day", lambda uid: db.activate_cheat_day(uid, today)),
+        ("mark_reminder_sent", lambda uid: db.mark_reminder_sent(uid, today, "noon")),
+        ("save_weekly_score", lambda uid: db.save_weekly_score(
+            uid, today, today, "A", "A", "B", "S", active_days=1, elapsed_days=1,
+        )),
+    ]
+
+
+def _classify(statements: list[str]) -> tuple[int, int]:
+    tx = sum(1 for s in statements if s.split(None, 1)[0].upper() in ("BEGIN", "COMMIT", "ROLLBACK"))
+    return len(statements) - tx, tx
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--iterations", type=int, default=200, help="每種情境量測耗時的次數")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = CountingDatabase(os.path.join(tmp, "bench.db"))
+        db.init()
+        print(f"{'操作':<28}{'情境':<6}{'SQL':>5}{'交易':>6}{'µs/次':>10}")
+        for name, op in _ops(db):
+            for label, fresh in (("新", True), ("既有", False)):
+                uid = f"Ubench-{name}-{label}"
+                if not fresh:
+                    op(uid)
+                db.statements.clear()
+                op(uid)
+                sql_n, tx_n = _classify(db.statements)
+                t0 = time.perf_counter()
+                for i in range(args.iterations):
+                    op(f"{uid}-{i}" if fresh else uid)
+                per = (time.perf_counter() - t0) / args.iterations * 1e6
+                print(f"{name:<28}{label:<6}{sql_n:>5}{tx_n:>6}{per:>10.0f}")
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
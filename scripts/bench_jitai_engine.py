@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""量測 jitai_engine 為大量使用者產生規則式提醒選項的 CPU 時間。
+
+   python3 scripts/bench_jitai_engine.py
+   python3 scripts/bench_jitai_engine.py --users 50000 --show 3
+
+剩餘蛋白質／熱量以亂數模擬（固定 seed），不連 DB、LINE 或 OpenAI。
+冷啟動包含組合庫展開與各分帶的第一次挑選；熱快取為同一程序再跑一輪。
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import jitai_engine  # noqa: E402
+
+
+def synth_users(n: int, seed: int) -> list[tuple[float, float]]:
+    rng = random.Random(seed)
+    return [(rng.uniform(5, 140), rng.uniform(-400, 1600)) for _ in range(n)]
+
+
+def run(users: list[tuple[float, float]]) -> float:
+    t0 = time.perf_counter()
+    for pro, cal in users:
+        jitai_engine.render_options(pro, cal, urgent=pro > 60)
+    return time.perf_counter() - t0
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=10000)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--show", type=int, default=0, help="印出前 N 位的文案")
+    args = ap.parse_args()
+
+    users = synth_users(args.users, args.seed)
+    jitai_engine.combo_library.cache_clear()
+    jitai_engine._options_for_band.cache_clear()
+    jitai_engine._render_for_band.cache_clear()
+    cold = run(users)
+    warm = run(users)
+    info = jitai_engine._options_for_band.cache_info()
+    print(f"組合庫：{len(jitai_engine.combo_library())} 組；分帶快取：{info.currsize} 格")
+    for label, sec in (("冷啟動", cold), ("熱快取", warm)):
+        print(
+            f"{label}：{args.users} 位 {sec * 1000:8.1f} ms"
+            f"（每位 {sec / args.users * 1e6:6.1f} µs）"
+        )
+    for pro, cal in users[: args.show]:
+        print(f"\n— 尚缺蛋白 {pro:.0f} g／熱量空間 {cal:.0f} kcal —")
+        print(jitai_engine.render_options(pro, cal))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
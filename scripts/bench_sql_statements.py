@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""量測每次查詢在送出前的 SQL 準備成本，以及 PostgreSQL 上 prepared statement 的效果。
+
+   python3 scripts/bench_sql_statements.py
+   python3 scripts/bench_sql_statements.py --iterations 200000
+   DATABASE_URL=postgresql://... python3 scripts/bench_sql_statements.py --pg-iterations 500
+
+第一段不需資料庫：對語句表內每條 SQL 比較「每次呼叫都 replace('?', '%s')」（舊的 _adapt）
+與「查 import 時備妥的語句表」的耗時（PostgreSQL 方言，SQLite 方言本來就不轉換）。
+第二段只在有 DATABASE_URL 時執行：同一條連線上重複執行幾條唯讀語句，
+比較 prepare_threshold=None（不 prepare）與 0（首次執行就 prepare）的每次查詢延遲。
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import database  # noqa: E402
+
+# 第二段使用的唯讀語句與參數（使用者不存在也無妨，量的是來回與規劃成本）
+_PG_READS = (
+    ("profile_get", ("Ubench",)),
+    ("meal_day_totals", ("Ubench", date.today().isoformat())),
+    ("daily_aggregates_range", ("Ubench", "2000-01-01", date.today().isoformat())),
+    ("jitai_audience_page", ("", 500)),
+)
+
+
+def bench_text(iterations: int) -> None:
+    names = list(database._STATEMENTS)
+    texts = [database._STATEMENTS[n] for n in names]
+    table = database._STATEMENT_TEXT["postgres"]
+    calls = iterations * len(names)
+
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for sql in texts:
+            sql.replace("?", "%s")
+    per_old = (time.perf_counter() - t0) / calls * 1e9
+
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for name in names:
+            table[name]
+    per_new = (time.perf_counter() - t0) / calls * 1e9
+
+    print(f"語句表 {len(names)} 條，各 {iterations} 次（PostgreSQL 方言）")
+    print(f"  每次 replace('?', '%s')  {per_old:8.0f} ns/查詢")
+    print(f"  查語句表                {per_new:8.0f} ns/查詢")
+
+
+def bench_postgres(url: str, iterations: int) -> None:
+    import psycopg
+    from psycopg.rows import dict_row
+
+    conninfo = database._resolve_postgres_conninfo(url)
+    print(f"\nPostgreSQL，同一連線各語句 {iterations} 次")
+    print(f"  目前設定的 prepare_threshold：{database._postgres_prepare_threshold(conninfo)}")
+    for label, threshold in (("不 prepare", None), ("首次即 prepare", 0)):
+        with psycopg.connect(conninfo, row_factory=dict_row, prepare_threshold=threshold) as conn:
+            for name, params in _PG_READS:
+                sql = database._STATEMENT_TEXT["postgres"][name]
+                conn.execute(sql, params).fetchall()  # 暖身（建立 prepared statement）
+                t0 = time.perf_counter()
+                for _ in range(iterations):
+                    conn.execute(sql, params).fetchall()
+                per = (time.perf_counter() - t0) / iterations * 1e6
+                print(f"  {label:<12}{name:<26}{per:10.0f} µs/次")
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--iterations", type=int, default=100000, help="第一段每條語句的次數")
+    ap.add_argument("--pg-iterations", type=int, default=300, help="第二段每條語句的次數")
+    args = ap.parse_args()
+
+    bench_text(args.iterations)
+    url = (os.getenv("DATABASE_URL") or "").strip()
+    if not url:
+        print("\n未設定 DATABASE_URL：略過 PostgreSQL prepared statement 量測")
+        return 0
+    if importlib.util.find_spec("psycopg") is None:
+        print("\n未安裝 psycopg：略過 PostgreSQL prepared statement 量測")
+        return 0
+    bench_postgres(url, args.pg_iterations)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
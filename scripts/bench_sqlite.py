@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""比較 SQLite basic（每次查詢各自連線）與 tuned（共用連線＋PRAGMA 調校）的吞吐量。
+
+   python3 scripts/bench_sqlite.py
+   python3 scripts/bench_sqlite.py --users 200 --ops 4000 --threads 1 8
+
+每種設定各用一個暫存資料庫，以相同的混合工作量（記餐、當日總計、讀 profile、
+用餐提醒標記與查詢）跑指定的執行緒數；多執行緒模擬 asyncio.to_thread 同時寫入。
+每輪結束檢查餐點筆數與每日彙總一致，確認並行寫入沒有遺失。
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from database import Database  # noqa: E402
+
+
+def _seed(db: Database, users: int) -> list[str]:
+    ids = [f"Ubench{u:05d}" for u in range(users)]
+    for uid in ids:
+        db.upsert_user_profile(uid, weight=70, body_fat=20, bmr=1600, tdee=2300)
+        db.complete_onboarding(uid, "減脂", 2000, 140)
+    return ids
+
+
+def _workload(db: Database, ids: list[str], ops: int, seed: int) -> int:
+    """回傳這批工作寫入的餐點筆數。"""
+    rng = random.Random(seed)
+    today = date.today().isoformat()
+    meals = 0
+    for _ in range(ops):
+        uid = rng.choice(ids)
+        r = rng.random()
+        if r < 0.25:
+            db.add_meal(uid, 450, 30, "雞胸便當", today)
+            meals += 1
+        elif r < 0.55:
+            db.get_daily_totals(uid, today)
+        elif r < 0.80:
+            db.get_user_profile(uid)
+        elif r < 0.90:
+            db.mark_reminder_sent(uid, today, "noon")
+        else:
+            db.reminder_already_sent(uid, today, "noon")
+    return meals
+
+
+def run(profile: str, users: int, ops: int, threads: int) -> tuple[float, bool]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"), database_url="", sqlite_profile=profile)
+        db.init()
+        ids = _seed(db, users)
+        per_thread = ops // threads
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            written = sum(ex.map(lambda i: _workload(db, ids, per_thread, i), range(threads)))
+        elapsed = time.perf_counter() - t0
+        today = date.today().isoformat()
+        meals = sum(db.get_daily_totals(uid, today)["meal_count"] for uid in ids)
+        agg = sum(
+            row["meal_count"]
+            for uid in ids
+            for row in db.get_daily_aggregates(uid, today, today)
+        )
+        db.close()
+    return per_thread * threads / elapsed, written == meals == agg
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--ops", type=int, default=3000, help="每輪的操作總數（平均分給各執行緒）")
+    ap.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    args = ap.parse_args()
+
+    print(f"{args.users} 位使用者，每輪 {args.ops} 次操作")
+    print(f"{'設定':<8}{'執行緒':>6}{'ops/s':>10}  資料一致")
+    ok = True
+    for threads in args.threads:
+        base = None
+        for profile in ("basic", "tuned"):
+            rate, consistent = run(profile, args.users, args.ops, threads)
+            ok &= consistent
+            note = f"  ×{rate / base:.1f}" if base else ""
+            base = base or rate
+            print(f"{profile:<8}{threads:>6}{rate:>10.0f}  {'是' if consistent else '否'}{note}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""以合成的多使用者 webhook 批次比較「逐一處理」與「依使用者分組並行」的回覆延遲。
+
+   python3 scripts/bench_webhook_batch.py
+   python3 scripts/bench_webhook_batch.py --users 30 --events-per-user 2 --slow-users 2 --slow-ms 3000
+
+route_message 與回覆以 sleep 模擬（不連 LINE／OpenAI），DB 使用暫存 SQLite。
+queue-full 模式走 ack-first 處理線：積壓上限設為 --queue-max，同一批事件拆成兩個請求、
+第二個在第一個仍在消化時送達，檢查積壓溢出後同一使用者的訊息仍依序處理。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+_SECRET = "bench-secret"
+os.environ["LINE_CHANNEL_SECRET"] = _SECRET
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-token")
+
+import main  # noqa: E402
+from database import Database  # noqa: E402
+
+
+def build_batch(users: int, events_per_user: int, first: int = 0) -> tuple[str, str]:
+    """回傳 (body, signature)；事件依「輪流各使用者」排列，模擬多人同時傳訊。first 為訊息序號起點。"""
+    events = []
+    for n in range(first, first + events_per_user):
+        for u in range(users):
+            events.append(
+                {
+                    "type": "message",
+                    "mode": "active",
+                    "timestamp": 1700000000000 + len(events),
+                    "source": {"type": "user", "userId": f"U{u:032d}"},
+                    "webhookEventId": f"BENCH{u:04d}{n:04d}{time.time_ns()}",
+                    "deliveryContext": {"isRedelivery": False},
+                    "replyToken": f"r{u}-{n}",
+                    "message": {"type": "text", "id": f"{u}{n}", "quoteToken": "q", "text": f"{u}:{n}"},
+                }
+            )
+    body = json.dumps({"destination": "Ubench", "events": events})
+    sig = base64.b64encode(hmac.new(_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, sig
+
+
+def install_stubs(slow_users: int, slow_ms: float, fast_ms: float, replies: list):
+    async def fake_route(event, user_id, state):
+        u = int(user_id[1:])
+        await asyncio.sleep((slow_ms if u < slow_users else fast_ms) / 1000)
+        return event.message.text
+
+    async def fake_reply(line_api, user_id, reply_token, text, received_at):
+        replies.append((user_id, text, asyncio.get_running_loop().time() - received_at))
+
+    main.route_message = fake_route
+    main.send_event_reply = fake_reply
+
+
+async def run_queue_full(batches, queue_max: int) -> None:
+    """兩個請求：第一個塞滿積壓，第二個在處理線仍在消化時送達；等所有處理線清空才返回。"""
+    main.WEBHOOK_QUEUE_MAX = queue_max
+    main.start_webhook_lanes()
+    t0 = asyncio.get_running_loop().time()
+
+    async def second():
+        await asyncio.sleep(0.05)
+        await main.dispatch_webhook_events(batches[1], t0)
+
+    await asyncio.gather(main.dispatch_webhook_events(batches[0], t0), second())
+    while main._webhook_lanes:
+        await asyncio.sleep(0.01)
+    main.stop_webhook_lanes()
+
+
+async def run_mode(mode: str, events, replies: list, queue_max: int = 0) -> float:
+    replies.clear()
+    t0 = asyncio.get_running_loop().time()
+    if mode == "queue-full":
+        await run_queue_full(events, queue_max)
+    elif mode == "sequential":
+        # 舊版 webhook：同一批次逐一 await
+        for event in events:
+            await main.handle_webhook_event(None, event, t0)
+    else:
+        await main.process_webhook_events(events, t0)
+    return asyncio.get_running_loop().time() - t0
+
+
+def report(mode: str, wall: float, replies: list, ttl: float) -> bool:
+    lat = sorted(r[2] for r in replies)
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    late = sum(1 for x in lat if x >= ttl)
+    order_ok = True
+    last: dict[str, int] = {}
+    for uid, text, _ in replies:
+        n = int(text.split(":")[1])
+        if last.get(uid, -1) > n:
+            order_ok = False
+        last[uid] = n
+    print(
+        f"{mode:<11} 總耗時 {wall * 1000:8.0f} ms | 回覆延遲 p50 {statistics.median(lat) * 1000:7.0f} ms"
+        f"  p95 {p95 * 1000:7.0f} ms  max {lat[-1] * 1000:7.0f} ms"
+        f" | 超過 {ttl:.0f}s：{late} | 同使用者順序 {'OK' if order_ok else 'FAIL'}"
+    )
+    return order_ok
+
+
+async def amain(args) -> int:
+    tmp = tempfile.mkdtemp(prefix="bench_webhook_")
+    main.db = Database(db_path=os.path.join(tmp, "bench.db"), database_url="")
+    await main.ensure_db_ready()
+    # 先載入 LINE SDK 並建立共用 client，避免一次性的匯入成本算進量測
+    main.preload_line_sdk()
+    main._shared_line_api()
+    main.WEBHOOK_USER_CONCURRENCY = args.concurrency
+    main._webhook_event_sem = None
+
+    replies: list = []
+    install_stubs(args.slow_users, args.slow_ms, args.fast_ms, replies)
+    print(
+        f"{args.users} 位使用者 × {args.events_per_user} 則；慢使用者 {args.slow_users} 位"
+        f"（{args.slow_ms:.0f} ms／則），其餘 {args.fast_ms:.0f} ms／則；併發上限 {args.concurrency}"
+    )
+    ok = True
+    for mode in ("sequential", "per-user"):
+        body, sig = build_batch(args.users, args.events_per_user)
+        events = main._webhook_parser().parse(body, sig)
+        wall = await run_mode(mode, events, replies)
+        ok &= report(mode, wall, replies, args.reply_ttl)
+
+    half = max(1, args.events_per_user // 2)
+    batches = [
+        main._webhook_parser().parse(*build_batch(args.users, half)),
+        main._webhook_parser().parse(*build_batch(args.users, args.events_per_user - half, first=half)),
+    ]
+    wall = await run_mode("queue-full", batches, replies, args.queue_max)
+    ok &= report("queue-full", wall, replies, args.reply_ttl)
+    expected = args.users * args.events_per_user
+    if len(replies) != expected:
+        print(f"queue-full 回覆數 {len(replies)}，應為 {expected}")
+        ok = False
+    await main.close_shared_line_api()
+    return 0 if ok else 1
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--events-per-user", type=int, default=3)
+    ap.add_argument("--slow-users", type=int, default=1)
+    ap.add_argument("--slow-ms", type=float, default=2000)
+    ap.add_argument("--fast-ms", type=float, default=100)
+    ap.add_argument("--concurrency", type=int, default=main.WEBHOOK_USER_CONCURRENCY)
+    ap.add_argument("--queue-max", type=int, default=5, help="queue-full 模式的積壓上限")
+    ap.add_argument("--reply-ttl", type=float, default=main.LINE_REPLY_TOKEN_TTL_SEC)
+    args = ap.parse_args()
+    return asyncio.run(amain(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""檢查每條餐點寫入路徑都會同步 daily_aggregates，並讓當日狀態與積分卡重新計算。
+
+   python3 scripts/check_meal_writes.py
+
+DB 使用暫存 SQLite。依序執行 add_meal、確認購買、取消購買、欺騙日與 clear_today，
+每一步後比對：
+- get_daily_totals（meals）與 get_daily_aggregates 相同
+- get_day_state 的累計與 DB 一致（快取已失效）
+- 有寫入餐點的步驟會讓積分卡失去 fresh 標記並排入增量更新
+任何一項不符即印出並以非 0 結束。
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+from datetime import date
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import main  # noqa: E402
+from database import Database  # noqa: E402
+
+UID = "Ucheck-meal-writes"
+
+
+def _steps(db: Database, today: str):
+    """(名稱, 寫入, 是否應讓積分卡重算)"""
+    return [
+        ("add_meal", lambda: db.add_meal(UID, 500, 30, "雞胸便當", today), True),
+        ("購買（purchased）", lambda: db.save_purchase_decision(
+            UID, {"name": "飯糰", "calories": 200, "protein": 8}, "purchased",
+        ), True),
+        ("購買（cancelled）", lambda: db.save_purchase_decision(
+            UID, {"name": "蛋糕", "calories": 450, "protein": 5}, "cancelled",
+        ), False),
+        ("activate_cheat_day", lambda: db.activate_cheat_day(UID, today), True),
+        ("clear_today", lambda: db.clear_today(UID, today), True),
+    ]
+
+
+def main_cli() -> int:
+    today = date.today().isoformat()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "check.db"), database_url="")
+        db.init()
+        # main 匯入時把 listener 掛在預設的 db；換成暫存 DB 後重新註冊
+        main.db = db
+        db.add_change_listener(main._day_states.invalidate)
+        db.add_change_listener(main._on_score_data_changed)
+        db.upsert_user_profile(UID, weight=70, body_fat=20)
+        db.complete_onboarding(UID, "減脂", 2000, 140)
+
+        failures = 0
+        for name, write, refreshes_card in _steps(db, today):
+            main.get_day_state(UID, today)  # 先讓快取持有寫入前的狀態
+            main._fresh_score_cards[UID] = True
+            main._score_cards_to_refresh.discard(UID)
+            write()
+
+            totals = db.get_daily_totals(UID, today)
+            agg = db.get_daily_aggregates(UID, today, today)
+            agg_totals = (
+                {k: agg[0][k] for k in ("calories", "protein", "meal_count")} if agg
+                else {"calories": 0, "protein": 0, "meal_count": 0}
+            )
+            state = main.get_day_state(UID, today)
+            card_refreshed = UID not in main._fresh_score_cards and UID in main._score_cards_to_refresh
+            problems = []
+            if agg_totals != totals:
+                problems.append(f"daily_aggregates {agg_totals} ≠ meals {totals}")
+            if state.totals != totals:
+                problems.append(f"當日狀態 {state.totals} ≠ DB {totals}")
+            if refreshes_card and not card_refreshed:
+                problems.append("積分卡未排入重算")
+            print(f"{name:<20} {'OK' if not problems else '；'.join(problems)}")
+            failures += bool(problems)
+        db.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""量測 main.py 匯入耗時（python -X importtime），列出最慢的模組並檢查預算。
+
+   python3 scripts/import_time.py
+   python3 scripts/import_time.py --budget-ms 600 --top 15
+
+超過 --budget-ms，或冷啟動路徑載入了應延遲匯入的模組（--lazy）時以非 0 結束，
+可放在 CI 當作匯入耗時的回歸檢查。
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+
+# 只應在處理 webhook／呼叫模型時才載入的模組
+DEFAULT_LAZY = ("linebot", "httpx", "PIL", "notion_client", "psycopg", "prompts")
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def run_importtime(module: str) -> list[tuple[int, int, int, str]]:
+    """回傳 (self_us, cumulative_us, depth, name)，依匯入順序。"""
+    env = dict(os.environ)
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr[-2000:])
+        raise SystemExit(f"匯入 {module} 失敗（exit {proc.returncode}）")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            rows.append((int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2, m.group(4)))
+    return rows
+
+
+def module_rows(rows: list[tuple[int, int, int, str]], module: str) -> list[tuple[int, int, int, str]]:
+    """只保留 module 本身與其子匯入（排除直譯器啟動時 site 載入的模組）。"""
+    end = next((i for i, r in enumerate(rows) if r[2] == 0 and r[3] == module), None)
+    if end is None:
+        raise SystemExit(f"importtime 輸出找不到 {module}")
+    start = end
+    while start > 0 and rows[start - 1][2] > 0:
+        start -= 1
+    return rows[start : end + 1]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--module", default="main")
+    ap.add_argument("--budget-ms", type=float, default=None, help="匯入總耗時上限（毫秒）")
+    ap.add_argument("--repeat", type=int, default=3, help="重複量測取最小值，降低雜訊")
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument(
+        "--lazy",
+        default=",".join(DEFAULT_LAZY),
+        help="不得在匯入時載入的頂層套件（逗號分隔，空字串停用）",
+    )
+    args = ap.parse_args()
+
+    best: list[tuple[int, int, int, str]] | None = None
+    best_total = None
+    for _ in range(max(1, args.repeat)):
+        rows = module_rows(run_importtime(args.module), args.module)
+        total = rows[-1][1]
+        if best_total is None or total < best_total:
+            best, best_total = rows, total
+    assert best is not None and best_total is not None
+
+    total_ms = best_total / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms（{args.repeat} 次取最小）")
+
+    top_level = sorted(
+        (r for r in best if r[2] == 1), key=lambda r: r[1], reverse=True
+    )[: args.top]
+    print(f"\n{args.module} 直接匯入的模組（累計）:")
+    for _s, cum, _d, name in top_level:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    by_self = sorted(best, key=lambda r: r[0], reverse=True)[: args.top]
+    print("\n自身耗時最高的模組:")
+    for self_us, _c, _d, name in by_self:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    lazy = [x.strip() for x in args.lazy.split(",") if x.strip()]
+    loaded = sorted({n.split(".")[0] for _s, _c, _d, n in best} & set(lazy))
+    if loaded:
+        print(f"\n[FAIL] 匯入時載入了應延遲的模組：{', '.join(loaded)}")
+        failed = True
+    if args.budget_ms is not None:
+        if total_ms > args.budget_ms:
+            print(f"\n[FAIL] 匯入 {total_ms:.1f} ms 超過預算 {args.budget_ms:.0f} ms")
+            failed = True
+        else:
+            print(f"\n[OK] 匯入 {total_ms:.1f} ms，預算 {args.budget_ms:.0f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""以固定的餐點樣本重播模型分層路由（快速模型 → 必要時升級大模型），比較準確度、延遲與 token。
+
+   python3 scripts/replay_meal_fixtures.py
+   python3 scripts/replay_meal_fixtures.py --escalate-confidence 低,中
+   OPENAI_API_KEY=... python3 scripts/replay_meal_fixtures.py --live --write
+
+預設離線：只用樣本中已錄下的兩層回應（responses.fast／responses.large），
+以 main.meal_escalation_reason 判斷是否升級，不連網。
+--live 會以兩個模型實際呼叫 OpenAI；加 --write 把新回應寫回樣本檔。
+內附的 scripts/fixtures/meal_replay.jsonl 只是示範格式的樣本，
+請以 --live --write 換成實測回應，再依結果調整 OPENAI_ESCALATE_CONFIDENCE。
+
+樣本每行一筆 JSON：
+  {"id", "kind": "text"|"photo", "input": 文字或照片備註, "image": 照片路徑（photo，相對樣本檔）,
+   "expected": {"calories", "protein"}（選填，人工核對值）,
+   "responses": {"fast"|"large": {"result", "latency_ms", "prompt_tokens", "completion_tokens"}}}
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# 專案根目錄
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import main  # noqa: E402
+
+DEFAULT_FIXTURES = ROOT / "scripts" / "fixtures" / "meal_replay.jsonl"
+
+
+def load_fixtures(path: Path) -> list[dict]:
+    cases = []
+    for n, line in enumerate(path.read_text(encoding="utf-8").splitlines(), 1):
+        if line.strip():
+            try:
+                cases.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise SystemExit(f"{path}:{n} JSON 格式錯誤：{e}")
+    return cases
+
+
+async def call_live(case: dict, model: str, fixture_dir: Path) -> dict:
+    """以指定模型實際呼叫一次，回傳與樣本相同格式的 response。"""
+    from prompts import PROMPT_MEAL_ANALYSIS, PROMPT_MEAL_FROM_TEXT
+
+    main.openai_telemetry.drain()
+    t0 = time.perf_counter()
+    if case.get("kind") == "photo":
+        image_b64 = base64.b64encode((fixture_dir / case["image"]).read_bytes()).decode()
+        note_prompt, _, _ = main._build_meal_photo_note_prompt(case.get("input") or "")
+        result = await main.call_openai_vision(
+            system_prompt=PROMPT_MEAL_ANALYSIS,
+            user_prompt="請分析這份餐點照片，依規則回傳 JSON。",
+            user_suffix=note_prompt.strip(),
+            image_base64=image_b64,
+            prompt_id="replay_meal_analysis",
+            model=model,
+        )
+    else:
+        result = await main.call_openai_text(
+            system_prompt=PROMPT_MEAL_FROM_TEXT,
+            user_prompt="請依步驟三～五推導並回傳 JSON。使用者原文如下：\n",
+            user_suffix=case["input"],
+            prompt_id="replay_meal_from_text",
+            model=model,
+        )
+    latency_ms = (time.perf_counter() - t0) * 1000
+    recs = main.openai_telemetry.drain()
+    return {
+        "result": result if isinstance(result, dict) else str(result),
+        "latency_ms": round(latency_ms, 1),
+        "prompt_tokens": sum(r.prompt_tokens for r in recs),
+        "completion_tokens": sum(r.completion_tokens for r in recs),
+    }
+
+
+def _values(resp: dict | None) -> tuple[float, float] | None:
+    if not resp or not isinstance(resp.get("result"), dict):
+        return None
+    r = resp["result"]
+    return main._safe_float(r.get("calories")), main._safe_float(r.get("protein"))
+
+
+def _tokens(resp: dict | None) -> int:
+    if not resp:
+        return 0
+    return int(resp.get("prompt_tokens") or 0) + int(resp.get("completion_tokens") or 0)
+
+
+def evaluate(cases: list[dict]) -> int:
+    rows = []
+    for case in cases:
+        fast = case.get("responses", {}).get("fast")
+        large = case.get("responses", {}).get("large")
+        if not fast or not large:
+            print(f"略過 {case.get('id')}：缺少 fast／large 回應（請先 --live --write）")
+            continue
+        reason = main.meal_escalation_reason(fast["result"])
+        routed = fast if reason is None else large
+        routed_latency = fast["latency_ms"] + (0 if reason is None else large["latency_ms"])
+        routed_tokens = _tokens(fast) + (0 if reason is None else _tokens(large))
+        rows.append((case, fast, large, reason, routed, routed_latency, routed_tokens))
+
+    if not rows:
+        print("沒有可評估的樣本")
+        return 1
+
+    print(f"{'樣本':<26} {'快速 kcal/g':>14} {'大模型 kcal/g':>14} {'預期 kcal/g':>14}  路由")
+    for case, fast, large, reason, *_ in rows:
+        def fmt(v):
+            return f"{v[0]:.0f}/{v[1]:.0f}" if v else "無效"
+        exp = case.get("expected") or {}
+        exp_s = f"{exp['calories']:.0f}/{exp['protein']:.0f}" if "calories" in exp else "-"
+        print(
+            f"{case['id']:<26} {fmt(_values(fast)):>14} {fmt(_values(large)):>14} {exp_s:>14}"
+            f"  {'採用快速' if reason is None else '升級：' + reason}"
+        )
+
+    print()
+    escalated = sum(1 for r in rows if r[3] is not None)
+    print(f"升級比例：{escalated}/{len(rows)}（{escalated / len(rows):.0%}）")
+    strategies = {
+        "只用快速模型": [(r[1], r[1]["latency_ms"], _tokens(r[1])) for r in rows],
+        "只用大模型": [(r[2], r[2]["latency_ms"], _tokens(r[2])) for r in rows],
+        "分層路由": [(r[4], r[5], r[6]) for r in rows],
+    }
+    print(f"{'策略':<10} {'熱量 MAE':>10} {'蛋白 MAE':>10} {'無效':>6} {'平均延遲':>10} {'p95 延遲':>10} {'token':>8}")
+    for name, picks in strategies.items():
+        cal_err, pro_err, invalid = [], [], 0
+        for (resp, _, _), row in zip(picks, rows):
+            exp = row[0].get("expected") or {}
+            v = _values(resp)
+            if v is None:
+                invalid += 1
+                continue
+            if "calories" in exp:
+                cal_err.append(abs(v[0] - exp["calories"]))
+                pro_err.append(abs(v[1] - exp["protein"]))
+        lat = sorted(p[1] for p in picks)
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        print(
+            f"{name:<10} {statistics.mean(cal_err) if cal_err else float('nan'):>10.1f}"
+            f" {statistics.mean(pro_err) if pro_err else float('nan'):>10.1f}"
+            f" {invalid:>6} {statistics.mean(lat):>8.0f}ms {p95:>8.0f}ms {sum(p[2] for p in picks):>8}"
+        )
+    return 0
+
+
+async def amain(args) -> int:
+    if args.escalate_confidence is not None:
+        main.OPENAI_ESCALATE_CONFIDENCE = frozenset(
+            c.strip() for c in args.escalate_confidence.split(",") if c.strip()
+        )
+    cases = load_fixtures(args.fixtures)
+    if args.only:
+        cases = [c for c in cases if c.get("id") in args.only]
+    if args.live:
+        if not main.OPENAI_API_KEY:
+            print("--live 需要 OPENAI_API_KEY")
+            return 2
+        for case in cases:
+            responses = case.setdefault("responses", {})
+            for tier, model in (("fast", args.fast_model), ("large", args.large_model)):
+                responses[tier] = await call_live(case, model, args.fixtures.parent)
+                responses[tier]["model"] = model
+            print(f"已呼叫 {case['id']}")
+        await main.flush_openai_telemetry()
+        if args.write:
+            args.fixtures.write_text(
+                "".join(json.dumps(c, ensure_ascii=False) + "\n" for c in cases),
+                encoding="utf-8",
+            )
+            print(f"已寫回 {args.fixtures}")
+    return evaluate(cases)
+
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--fixtures", type=Path, default=DEFAULT_FIXTURES)
+    ap.add_argument("--only", nargs="*", help="只跑指定 id")
+    ap.add_argument("--escalate-confidence", help="覆寫 OPENAI_ESCALATE_CONFIDENCE，如 低,中")
+    ap.add_argument("--live", action="store_true", help="實際呼叫 OpenAI 取得兩層回應")
+    ap.add_argument("--write", action="store_true", help="搭配 --live：把回應寫回樣本檔")
+    ap.add_argument("--fast-model", default=main.OPENAI_FAST_MODEL or "gpt-4o-mini")
+    ap.add_argument("--large-model", default=main.OPENAI_MODEL)
+    args = ap.parse_args()
+    return asyncio.run(amain(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
@@ -0,0 +1,75 @@
+"""
+啟動耗時量測：記錄模組匯入與各初始化步驟（毫秒），寫入日誌並由 /health 回報。
+冷啟動（Render 免費方案喚醒）時用來確認「可接收 webhook」前是否超出預算。
+請在 main.py 最先匯入，時間起點才會涵蓋其後的第三方套件匯入。
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# 「可接收 webhook」的目標預算（毫秒），超過時記 warning
+STARTUP_READY_BUDGET_MS = float(os.getenv("STARTUP_READY_BUDGET_MS", "1000"))
+
+
+class StartupProfile:
+    """里程碑（自匯入起算）與步驟耗時；步驟可在背景任務中結束。"""
+
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self._marks: dict[str, float] = {}
+        self._steps: dict[str, float] = {}
+        self._errors: dict[str, str] = {}
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._t0) * 1000
+
+    def mark(self, name: str) -> float:
+        ms = round(self.elapsed_ms(), 1)
+        self._marks[name] = ms
+        return ms
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._errors[name] = str(e)[:200]
+            raise
+        finally:
+            ms = round((time.perf_counter() - t) * 1000, 1)
+            self._steps[name] = ms
+            logger.info("啟動步驟 %s：%.1f ms", name, ms)
+
+    def summary(self) -> dict:
+        return {
+            "marks_ms": dict(self._marks),
+            "steps_ms": dict(self._steps),
+            "errors": dict(self._errors),
+            "ready_budget_ms": STARTUP_READY_BUDGET_MS,
+        }
+
+    def log_ready(self) -> None:
+        """於 lifespan 即將開始接收請求時呼叫。"""
+        ready = self.mark("ready")
+        imported = self._marks.get("imported")
+        logger.info(
+            "啟動完成：匯入 %s ms、可接收 webhook %.1f ms（同步步驟：%s）",
+            imported if imported is not None else "?",
+            ready,
+            ", ".join(f"{k}={v}" for k, v in self._steps.items()) or "無",
+        )
+        if ready > STARTUP_READY_BUDGET_MS:
+            logger.warning(
+                "啟動耗時 %.1f ms 超過預算 %.0f ms", ready, STARTUP_READY_BUDGET_MS
+            )
+
+
+startup_profile = StartupProfile()